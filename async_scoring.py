@@ -0,0 +1,121 @@
+import time
+import asyncio
+import concurrent.futures
+
+
+class MicroBatchingScorer:
+    """An asyncio front end that gathers concurrent sent_prob requests to a model into batches.
+
+    Requests arriving within window_in_seconds of the first request of a batch (up to max_batch_size requests)
+    are evaluated together with a single model.sent_probs call, and the results are fanned out to the awaiting callers.
+    The model is evaluated in a worker thread, so the event loop keeps accepting requests during evaluation.
+
+    Example:
+        async with MicroBatchingScorer(model) as scorer:
+            log_prob = await scorer.sent_prob("This is a sentence")
+    """
+
+    def __init__(self, model, window_in_seconds=0.005, max_batch_size=64):
+        """Initialize the scorer
+
+        args:
+            model: a model_factory (or RemoteModel) object with a sent_probs method
+            window_in_seconds: how long to wait for more requests after the first request of a batch
+            max_batch_size: maximal number of requests evaluated together
+        """
+        self.model = model
+        self.window_in_seconds = window_in_seconds
+        self.max_batch_size = max_batch_size
+        self.n_batches = 0
+        self.n_requests = 0
+        self._queue = None
+        self._worker_task = None
+        self._executor = None
+        self._current_batch = []  # requests taken from the queue and not answered yet
+        self._stopped = False
+
+    async def start(self):
+        self._stopped = False
+        self._queue = asyncio.Queue()
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self._worker_task = asyncio.ensure_future(self._batching_loop())
+
+    async def stop(self):
+        """stop batching. requests that were not answered yet fail with RuntimeError (and so do later requests)"""
+        self._stopped = True
+        if self._worker_task is not None:
+            self._worker_task.cancel()
+            try:
+                await self._worker_task
+            except asyncio.CancelledError:
+                pass
+            self._worker_task = None
+        # fail the pending requests, so their callers don't wait forever
+        pending = list(self._current_batch)
+        self._current_batch = []
+        while self._queue is not None and not self._queue.empty():
+            pending.append(self._queue.get_nowait())
+        for sent, future in pending:
+            if not future.done():
+                future.set_exception(RuntimeError("scorer stopped"))
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.stop()
+
+    async def sent_prob(self, sent):
+        """return the log-probability of sent (evaluated in a batch with other concurrent requests)"""
+        if self._stopped:
+            raise RuntimeError("scorer stopped")
+        assert self._worker_task is not None, "call start() (or use 'async with') first"
+        future = asyncio.get_event_loop().create_future()
+        await self._queue.put((sent, future))
+        return await future
+
+    async def _batching_loop(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            batch = [await self._queue.get()]
+            self._current_batch = batch
+            deadline = time.monotonic() + self.window_in_seconds
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            sents = [sent for sent, future in batch]
+            try:
+                log_probs = await loop.run_in_executor(
+                    self._executor, self.model.sent_probs, sents
+                )
+            except Exception as e:
+                for sent, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            self.n_batches += 1
+            self.n_requests += len(batch)
+            for (sent, future), log_prob in zip(batch, log_probs):
+                if not future.done():
+                    future.set_result(float(log_prob))
+            self._current_batch = []
+
+    def stats(self):
+        """return the number of requests, batches and the mean batch size"""
+        return {
+            "n_requests": self.n_requests,
+            "n_batches": self.n_batches,
+            "mean_batch_size": self.n_requests / self.n_batches
+            if self.n_batches > 0
+            else 0.0,
+        }
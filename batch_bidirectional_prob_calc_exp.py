@@ -44,5 +44,8 @@ if __name__ == "__main__":
         max_non_decreasing_loss_attempts_per_word=50,
         max_replacement_attempts_per_word=50,
         max_opt_hours=12,
+        checkpoint_folder=os.path.join(
+            results_csv_folder, "checkpoints"
+        ),  # a job whose worker died is restarted once its lease expires (lease_time_in_seconds, 15 minutes by default), resuming from its last checkpoint
         verbose=3,
     )
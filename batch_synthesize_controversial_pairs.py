@@ -1,6 +1,5 @@
 import os, pickle
 import random
-import time
 
 import torch
 import numpy as np
@@ -9,11 +8,15 @@ import pandas as pd
 from model_functions import model_factory
 from sentence_optimization import (
     optimize_sentence_set,
+    optimize_sentence_sets,
     initialize_random_word_sentence,
     controversiality_loss_func,
 )
 from utils import exclusive_write_line
-from task_scheduler import TaskScheduler
+from task_scheduler import TaskScheduler, JobLeaseHeartbeat
+from model_server import RemoteModel
+from caching import WordProbsCache
+from checkpointing import get_job_checkpoint
 
 
 class NaturalSentenceAssigner:
@@ -74,6 +77,13 @@ def synthesize_controversial_sentence_pair_set(
     max_non_decreasing_loss_attempts_per_word=5,
     max_replacement_attempts_per_word=50,
     max_opt_hours=None,
+    sent_prob_cache_size=100000,
+    word_probs_cache_size_in_mb=1024,
+    model_server_address=None,
+    n_pairs_in_lockstep=1,
+    checkpoint_folder=None,
+    checkpoint_interval_in_seconds=600,
+    lease_time_in_seconds=15 * 60,
     verbose=3,
 ):
     """Synthesize a set of controversial synthetic sentence pairs.
@@ -89,7 +99,18 @@ def synthesize_controversial_sentence_pair_set(
         max_pairs: int, maximum number of sentence pairs to synthesize with each run of the script (set to None to keep running). Useful if HPC jobs are time-limited.
         natural_initialization: bool, if True, use natural sentences as initial sentences. Otherwise, initialize as random sentences.
         n_pairs_to_synthesize_per_model_pair: int, number of sentence pairs to synthesize for each model pair.
-        max_opt_hours: int, maximum number of hours to run the optimization for each sentence pair.
+        max_opt_hours: int, maximum number of hours to run the optimization for each sentence pair
+            (including the time spent before the job was resumed from its checkpoint).
+        sent_prob_cache_size: int, number of sentence log-probabilities memoized per model (None to disable memoization).
+        word_probs_cache_size_in_mb: int, memory used for memoizing word_probs outputs, shared by all models (None to disable memoization).
+        model_server_address: string, Unix socket of a running model_server.py. If not None, models are served by this
+            process (shared by all workers on the node) instead of being loaded by each worker.
+        n_pairs_in_lockstep: int, number of sentence pairs optimized together (see optimize_sentence_sets).
+            Their exact sentence probability evaluations are batched together, which improves GPU utilization.
+        checkpoint_folder: string, if not None, the state of each optimization job is saved to this folder every
+            checkpoint_interval_in_seconds seconds, and a job restarted after a timeout (or a preemption) resumes from its checkpoint.
+        lease_time_in_seconds: int, a running job renews its lease while it is optimized. a job whose lease was not renewed
+            for this long (e.g., its worker died) is restarted by another worker.
         verbose: int, verbosity level.
 
     Generates a CSV file with the following columns:
@@ -99,51 +120,49 @@ def synthesize_controversial_sentence_pair_set(
 
     n_sentences = 2  # we optimize a pair of sentences
 
+    if word_probs_cache_size_in_mb is not None:
+        # shared across model pairs, so word_probs evaluated for a natural sentence are reused by all pairs involving the same model
+        word_probs_cache = WordProbsCache(max_size_in_mb=word_probs_cache_size_in_mb)
+    else:
+        word_probs_cache = None
+
     sentences_to_change = [1]  # change the second sentence, keep the first fixed
 
-    sch = TaskScheduler(
-        max_job_time_in_seconds=3600 * 6
-    )  # tracking multiple sentence optimization jobs
-    job_df = (
-        sch.to_pandas()
-    )  # get a dataframe of jobs, this DataFrame will be non-empty if there are jobs running
-
-    try:
-        job_id_df = pd.DataFrame(list(job_df["job_id"]))
-    except:
-        job_id_df = None
-    print("job_id_df", job_id_df)
-
-    # determine which model pair has the least completed or running jobs
-    model_pairs_stats = []
-    for model_name_pair in model_pairs:
-        [model1_name, model2_name] = model_name_pair
-        if model1_name == model2_name:
-            continue
-        if job_id_df is not None and len(job_id_df) > 0:
-            n_jobs = (
-                (job_id_df["model_1"] == model1_name)
-                & (job_id_df["model_2"] == model2_name)
-            ).sum()
-        else:
-            n_jobs = 0
-        model_pairs_stats.append(
-            {
-                "model_1": model1_name,
-                "model_2": model2_name,
-                "n_jobs": n_jobs,
-                "tie_breaker": random.random(),
-            }
-        )
-    model_pairs_stats = pd.DataFrame(model_pairs_stats)
-    model_pairs_stats = model_pairs_stats.sort_values(
-        by=["n_jobs", "tie_breaker"], ascending=True
-    )
+    # tracking multiple sentence optimization jobs.
+    # running jobs renew their leases (see JobLeaseHeartbeat), so a job is restarted soon after its worker dies.
+    sch = TaskScheduler(lease_time_in_seconds=lease_time_in_seconds)
 
-    # list model pairs, pairs with less sentences first
-    model_pair_list = list(
-        zip(model_pairs_stats["model_1"], model_pairs_stats["model_2"])
-    )
+    # candidate jobs (the first n_pairs_to_synthesize_per_model_pair + 1 natural sentences assigned to each model pair).
+    # model pairs are shuffled, so workers break ties between equally served pairs differently.
+    model_pair_list = [
+        tuple(model_name_pair)
+        for model_name_pair in model_pairs
+        if model_name_pair[0] != model_name_pair[1]
+    ]
+    random.shuffle(model_pair_list)
+    candidate_jobs = {}
+    natural_sentence_info = {}  # (model pair, natural sentence) -> (i_natural_sentence, sentence_index)
+    for model_name_pair in model_pair_list:
+        [model1_name, model2_name] = model_name_pair
+        natural_sentence_df = initial_sentence_assigner.get_sentences(model_name_pair)
+        natural_sentence_df = natural_sentence_df.iloc[
+            : n_pairs_to_synthesize_per_model_pair + 1
+        ]
+        candidate_jobs[model_name_pair] = []
+        for i_natural_sentence, (sentence_index, natural_sentence) in enumerate(
+            zip(natural_sentence_df.index, natural_sentence_df["sentence"])
+        ):
+            candidate_jobs[model_name_pair].append(
+                {
+                    "natural_sentence": natural_sentence,
+                    "model_1": model1_name,
+                    "model_2": model2_name,
+                }
+            )
+            natural_sentence_info[(model_name_pair, natural_sentence)] = (
+                i_natural_sentence,
+                sentence_index,
+            )
 
     if allow_only_prepositions_to_repeat:  # load a list of prepositions
         allowed_repeating_words = set(
@@ -154,115 +173,125 @@ def synthesize_controversial_sentence_pair_set(
         allowed_repeating_words = None
         keep_words_unique = False
 
-    for model_name_pair in model_pair_list:
-        [model1_name, model2_name] = model_name_pair
-
-        if results_csv_folder is not None:
-            results_csv_fname = os.path.join(
-                results_csv_folder, model1_name + "_vs_" + model2_name + ".csv"
+    loaded_model_pair = None
+    model_name_pair = None  # keep optimizing this pair until its candidate jobs are exhausted
+    n_optimized = 0
+    while True:
+        # claim up to n_pairs_in_lockstep optimization jobs, all for the same model pair
+        n_jobs_to_claim = n_pairs_in_lockstep
+        if max_sentence_pairs_per_run is not None:
+            n_jobs_to_claim = min(
+                n_jobs_to_claim, max_sentence_pairs_per_run - n_optimized
             )
-
-        # allocate GPUs. Ideally, we'd like a separate GPU for each model.
-        model_GPU_IDs = []
-        cur_GPU_ID = 0
-        for model_name in model_name_pair:
-            model_GPU_IDs.append(cur_GPU_ID)
-            if not model_name in [
-                "bigram",
-                "trigram",
-            ]:  # bigram and trigram models run on CPU, so gpu_id will be ignored
-                cur_GPU_ID += 1
-                if cur_GPU_ID >= torch.cuda.device_count():
-                    cur_GPU_ID = 0
-
-        models_loaded = False
-
-        n_optimized = 0
-
-        natural_sentence_df = initial_sentence_assigner.get_sentences(model_name_pair)
-        for i_natural_sentence, (sentence_index, natural_sentence) in enumerate(
-            zip(natural_sentence_df.index, natural_sentence_df["sentence"])
-        ):
-
-            if i_natural_sentence >= (n_pairs_to_synthesize_per_model_pair + 1):
+        while True:
+            if model_name_pair is None:  # the least-served model pair
+                candidate_filter = candidate_jobs
+            else:
+                candidate_filter = {model_name_pair: candidate_jobs[model_name_pair]}
+            claimed = sch.claim_next_jobs(
+                candidate_filter, n_jobs=n_jobs_to_claim
+            )  # tracking the optimization jobs (useful for HPC environments)
+            if claimed is not None or model_name_pair is None:
                 break
-
-            job_id = {
-                "natural_sentence": natural_sentence,
-                "model_1": model1_name,
-                "model_2": model2_name,
-            }
-
-            success = sch.start_job(
-                job_id
-            )  # tracking the optimization job (useful for HPC environments)
-            if not success:
-                continue
-
+            model_name_pair = None  # this model pair is done, move on to another one
+
+        if claimed is None:
+            break
+
+        model_name_pair, job_ids = claimed
+        claimed_jobs = []
+        for job_id in job_ids:
+            natural_sentence = job_id["natural_sentence"]
+            i_natural_sentence, sentence_index = natural_sentence_info[
+                (model_name_pair, natural_sentence)
+            ]
             print(
                 "optimizing sentence {} ({}) for {} vs {}".format(
-                    i_natural_sentence, sentence_index, model1_name, model2_name
+                    i_natural_sentence, sentence_index, *model_name_pair
                 )
             )
-            if not models_loaded:  # load models
-                models = []
-                for model_name, model_GPU_ID in zip(model_name_pair, model_GPU_IDs):
-                    device_type = (
-                        "cpu" if model_name in ["bigram", "trigram"] else "gpu"
-                    )
-                    print(
-                        "loading "
-                        + model_name
-                        + " "
-                        + device_type
-                        + " "
-                        + str(model_GPU_ID)
-                        + "...",
-                        end="",
-                    )
-                    models.append(model_factory(model_name, model_GPU_ID))
-                    print("done.")
-                    models_loaded = True
+            claimed_jobs.append((sentence_index, natural_sentence, job_id))
+
+        [model1_name, model2_name] = model_name_pair
 
-            loss_func = controversiality_loss_func
+        if results_csv_folder is not None:
+            results_csv_fname = os.path.join(
+                results_csv_folder, model1_name + "_vs_" + model2_name + ".csv"
+            )
 
-            def monitoring_func(sentences, sentences_log_p):
-                """prints an update on optimization status"""
+        if model_name_pair != loaded_model_pair:  # load models
+            # allocate GPUs. Ideally, we'd like a separate GPU for each model.
+            model_GPU_IDs = []
+            cur_GPU_ID = 0
+            for model_name in model_name_pair:
+                model_GPU_IDs.append(cur_GPU_ID)
+                if not model_name in [
+                    "bigram",
+                    "trigram",
+                ]:  # bigram and trigram models run on CPU, so gpu_id will be ignored
+                    cur_GPU_ID += 1
+                    if cur_GPU_ID >= torch.cuda.device_count():
+                        cur_GPU_ID = 0
+
+            models = []
+            for model_name, model_GPU_ID in zip(model_name_pair, model_GPU_IDs):
+                device_type = "cpu" if model_name in ["bigram", "trigram"] else "gpu"
                 print(
-                    model1_name
-                    + ":"
-                    + "{:.2f}/{:.2f}".format(
-                        sentences_log_p[..., 0, 0], sentences_log_p[..., 0, 1]
-                    )
+                    "loading "
+                    + model_name
+                    + " "
+                    + device_type
+                    + " "
+                    + str(model_GPU_ID)
+                    + "...",
+                    end="",
                 )
-                print(
-                    model2_name
-                    + ":"
-                    + "{:.2f}/{:.2f}".format(
-                        sentences_log_p[..., 1, 0], sentences_log_p[..., 1, 1]
+                if model_server_address is not None:
+                    models.append(RemoteModel(model_name, address=model_server_address))
+                else:
+                    models.append(
+                        model_factory(
+                            model_name,
+                            model_GPU_ID,
+                            sent_prob_cache_size=sent_prob_cache_size,
+                            word_probs_cache=word_probs_cache,
+                        )
                     )
-                )
+                print("done.")
+            loaded_model_pair = model_name_pair
+
+        # renew the jobs' leases during the optimization (loading the models might have taken a while)
+        heartbeat = JobLeaseHeartbeat(sch, [job_id for _, _, job_id in claimed_jobs])
+        heartbeat.renew()
+        claimed_jobs = [
+            claimed_job
+            for claimed_job in claimed_jobs
+            if not heartbeat.is_lost(claimed_job[2])
+        ]
+        if len(claimed_jobs) == 0:
+            continue
 
-            if max_opt_hours is not None:
-                # stop optimization after max_opt_time hours
-                start_time = time.time()
+        loss_func = controversiality_loss_func
 
-                def stop_if_time_exceeded(loss):
-                    time_elapsed_in_hours = (time.time() - start_time) / 3600
-                    if time_elapsed_in_hours > max_opt_hours:
-                        print(
-                            f"time exceeded ({time_elapsed_in_hours:.2f} hours), stopping optimization"
-                        )
-                        return True
-                    else:
-                        return False
-
-                internal_stopping_condition = stop_if_time_exceeded
-            else:
-                internal_stopping_condition = (
-                    lambda loss: False
-                )  # stops optimization if condition is met
+        def monitoring_func(sentences, sentences_log_p):
+            """prints an update on optimization status"""
+            print(
+                model1_name
+                + ":"
+                + "{:.2f}/{:.2f}".format(
+                    sentences_log_p[..., 0, 0], sentences_log_p[..., 0, 1]
+                )
+            )
+            print(
+                model2_name
+                + ":"
+                + "{:.2f}/{:.2f}".format(
+                    sentences_log_p[..., 1, 0], sentences_log_p[..., 1, 1]
+                )
+            )
 
+        initial_sentence_sets = []
+        for sentence_index, natural_sentence, job_id in claimed_jobs:
             if natural_initialization:
                 initial_sentences = [natural_sentence] * n_sentences
             else:
@@ -271,29 +300,69 @@ def synthesize_controversial_sentence_pair_set(
                         sent_len, initial_sampling="uniform"
                     )
                 ] * n_sentences
-
-            results = optimize_sentence_set(
-                n_sentences,
-                models=models,
-                loss_func=loss_func,
-                sentences=initial_sentences,
-                sent_length_in_words=sent_len,
-                initial_sampling=None,
-                replacement_strategy=replacement_strategy,
-                monitoring_func=monitoring_func,
-                internal_stopping_condition=internal_stopping_condition,
-                start_with_identical_sentences=True,
-                max_steps=10000,
-                keep_words_unique=keep_words_unique,
-                allowed_repeating_words=allowed_repeating_words,
-                sentences_to_change=sentences_to_change,
-                max_replacement_attempts_per_word=max_replacement_attempts_per_word,
-                max_non_decreasing_loss_attempts_per_word=max_non_decreasing_loss_attempts_per_word,
-                verbose=verbose,
+            initial_sentence_sets.append(initial_sentences)
+
+        if checkpoint_folder is not None:
+            checkpoints = [
+                get_job_checkpoint(
+                    checkpoint_folder,
+                    job_id,
+                    interval_in_seconds=checkpoint_interval_in_seconds,
+                )
+                for sentence_index, natural_sentence, job_id in claimed_jobs
+            ]
+        else:
+            checkpoints = [None] * len(claimed_jobs)
+
+        optimization_kwargs = dict(
+            models=models,
+            loss_func=loss_func,
+            sent_length_in_words=sent_len,
+            initial_sampling=None,
+            replacement_strategy=replacement_strategy,
+            monitoring_func=monitoring_func,
+            max_opt_hours=max_opt_hours,  # includes the time spent before resuming from a checkpoint
+            start_with_identical_sentences=True,
+            max_steps=10000,
+            keep_words_unique=keep_words_unique,
+            allowed_repeating_words=allowed_repeating_words,
+            sentences_to_change=sentences_to_change,
+            max_replacement_attempts_per_word=max_replacement_attempts_per_word,
+            max_non_decreasing_loss_attempts_per_word=max_non_decreasing_loss_attempts_per_word,
+            verbose=verbose,
+        )
+        # abort an optimization if its job's lease was lost (the job was restarted by another worker)
+        external_stopping_checks = [
+            heartbeat.get_stopping_check(job_id) for _, _, job_id in claimed_jobs
+        ]
+        if len(claimed_jobs) == 1:
+            all_results = [
+                optimize_sentence_set(
+                    n_sentences,
+                    sentences=initial_sentence_sets[0],
+                    checkpoint=checkpoints[0],
+                    external_stopping_check=external_stopping_checks[0],
+                    **optimization_kwargs,
+                )
+            ]
+        else:
+            # optimize the claimed pairs together, sharing model batches
+            all_results = optimize_sentence_sets(
+                initial_sentence_sets,
+                checkpoints=checkpoints,
+                external_stopping_checks=external_stopping_checks,
+                **optimization_kwargs,
             )
+        heartbeat.renew()  # don't save the results of jobs whose lease was lost since the last renewal
 
+        done_job_ids, done_job_results = [], []
+        for (sentence_index, natural_sentence, job_id), results in zip(
+            claimed_jobs, all_results
+        ):
             if results is False:  # optimization was terminated
                 continue
+            if heartbeat.is_lost(job_id):
+                continue
 
             sentences = results["sentences"]
             sentences_log_p = results["sentences_log_p"]
@@ -311,13 +380,25 @@ def synthesize_controversial_sentence_pair_set(
             )
             line = ",".join(map(str, outputs))
             exclusive_write_line(results_csv_fname, line)
-            sch.job_done(job_id, results=results)
+            done_job_ids.append(job_id)
+            done_job_results.append(results)
 
             n_optimized += 1
-            if (max_sentence_pairs_per_run is not None) and (
-                n_optimized >= max_sentence_pairs_per_run
-            ):
-                break
+        sch.jobs_done(done_job_ids, results=done_job_results)
+
+        if verbose >= 2 and model_server_address is None:
+            if sent_prob_cache_size is not None:
+                for model in models:
+                    print(
+                        model.name, "sent_prob cache:", model.sent_prob_cache_info()
+                    )
+            if word_probs_cache is not None:
+                print("word_probs cache:", word_probs_cache.info())
+
+        if (max_sentence_pairs_per_run is not None) and (
+            n_optimized >= max_sentence_pairs_per_run
+        ):
+            break
 
 
 if __name__ == "__main__":
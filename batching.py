@@ -0,0 +1,159 @@
+import os
+
+import torch
+
+
+def is_out_of_memory_error(e):
+    """return True if the exception e was raised because a device ran out of memory"""
+    if not isinstance(e, RuntimeError):
+        return False
+    message = str(e).lower()
+    return (
+        "out of memory" in message
+        or "can't allocate memory" in message
+        or "not enough memory" in message
+    )
+
+
+def get_available_memory_in_bytes(device):
+    """return the amount of memory (in bytes) currently available on device"""
+    if device.type == "cuda":
+        if hasattr(torch.cuda, "mem_get_info"):  # torch >= 1.10 also accounts for other processes
+            return torch.cuda.mem_get_info(device)[0]
+        total = torch.cuda.get_device_properties(device).total_memory
+        return total - torch.cuda.memory_allocated(device)
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (ValueError, OSError, AttributeError):
+        return 4 * 1024**3  # can't query the system memory, assume a small workstation
+
+
+class BatchSizePolicy:
+    """Pick batch sizes for model evaluation from a memory budget and the input shape.
+
+    The batch size for a given (model, sequence length) key is first estimated from the memory budget.
+    If a batch runs out of memory, the batch size for this key is halved and the batch is retried.
+    The largest batch size that worked for each key is remembered and reused.
+    """
+
+    def __init__(
+        self,
+        device,
+        memory_budget_in_gb=None,
+        memory_fraction=0.5,
+        min_batch_size=1,
+        max_batch_size=1024,
+    ):
+        """Initialize the policy
+
+        args:
+            device: torch.device on which the model runs
+            memory_budget_in_gb: memory available for a single batch (in GB).
+                If None, the environment variable CONTSTIMLANG_MEMORY_BUDGET_GB is used.
+                If this variable is not set, memory_fraction of the device memory available when the first batch size
+                is chosen is used (measured lazily, so the weights of the models loaded by then are accounted for).
+                Memory used by other processes sharing the device is only accounted for if torch provides
+                torch.cuda.mem_get_info (torch >= 1.10).
+            memory_fraction: fraction of the available device memory to use when no budget is specified
+            min_batch_size: smallest batch size to use (a batch of this size that runs out of memory raises an error)
+            max_batch_size: largest batch size to use, regardless of the memory budget
+        """
+        self.device = device
+        if memory_budget_in_gb is None:
+            memory_budget_in_gb = os.environ.get("CONTSTIMLANG_MEMORY_BUDGET_GB")
+        if memory_budget_in_gb is not None:
+            self._memory_budget_in_bytes = int(float(memory_budget_in_gb) * 1024**3)
+        else:
+            self._memory_budget_in_bytes = None  # measured on first use
+        self.memory_fraction = memory_fraction
+        self.min_batch_size = min_batch_size
+        self.max_batch_size = max_batch_size
+
+        self.largest_successful_batch_size = dict()  # (model, length) -> batch size
+        self.batch_size_limit = dict()  # (model, length) -> batch size that must not be exceeded
+
+    @property
+    def memory_budget_in_bytes(self):
+        if self._memory_budget_in_bytes is None:
+            self._memory_budget_in_bytes = int(
+                get_available_memory_in_bytes(self.device) * self.memory_fraction
+            )
+        return self._memory_budget_in_bytes
+
+    def bytes_per_example(self, model, seq_len):
+        """a rough estimate of the peak memory (in bytes) needed to evaluate one sequence of seq_len tokens.
+
+        The estimate is dominated by the output log-probabilities (vocabulary size x sequence length)
+        and by the hidden activations and attention scores of a single layer.
+        """
+        config = getattr(getattr(model, "model", None), "config", None)
+        if config is None:  # not a transformer (e.g., an RNN). use the word vocabulary size.
+            vocab_size = getattr(model, "vocab_size", 100000)
+            hidden_size = getattr(model, "hidden_size", 1024)
+            n_heads = 0
+        else:
+            vocab_size = config.vocab_size
+            hidden_size = getattr(config, "hidden_size", None) or getattr(
+                config, "n_embd", None
+            ) or getattr(config, "emb_dim", 1024)
+            n_heads = getattr(config, "num_attention_heads", None) or getattr(
+                config, "n_head", None
+            ) or getattr(config, "n_heads", 16)
+        bytes_per_float = 4
+        floats_per_token = 3 * vocab_size + 16 * hidden_size + n_heads * seq_len
+        return bytes_per_float * floats_per_token * seq_len
+
+    def get_batch_size(self, model, seq_len):
+        """return the batch size to use for model with inputs of seq_len tokens"""
+        key = (model.name, int(seq_len))
+        estimated_batch_size = self.memory_budget_in_bytes // max(
+            self.bytes_per_example(model, seq_len), 1
+        )
+        batch_size = max(
+            estimated_batch_size, self.largest_successful_batch_size.get(key, 0)
+        )
+        batch_size = min(
+            batch_size, self.batch_size_limit.get(key, self.max_batch_size)
+        )
+        return int(max(batch_size, self.min_batch_size))
+
+    def on_success(self, model, seq_len, batch_size):
+        key = (model.name, int(seq_len))
+        if batch_size > self.largest_successful_batch_size.get(key, 0):
+            self.largest_successful_batch_size[key] = batch_size
+
+    def on_out_of_memory(self, model, seq_len, batch_size):
+        key = (model.name, int(seq_len))
+        if batch_size <= self.min_batch_size:
+            return False  # can't back off any further
+        self.batch_size_limit[key] = max(batch_size // 2, self.min_batch_size)
+        if self.largest_successful_batch_size.get(key, 0) > self.batch_size_limit[key]:
+            self.largest_successful_batch_size[key] = self.batch_size_limit[key]
+        if self.device.type == "cuda":
+            torch.cuda.empty_cache()
+        return True
+
+    def run(self, model, batch_func, n_examples, seq_len):
+        """evaluate n_examples in consecutive batches.
+
+        args:
+            model: the model_factory object evaluated by batch_func
+            batch_func: a function called with (start, end) for each batch of examples [start, end).
+                If it runs out of memory, it is called again for the same start with a smaller batch.
+            n_examples: total number of examples
+            seq_len: number of tokens per example (after padding)
+        """
+        start = 0
+        while start < n_examples:
+            batch_size = self.get_batch_size(model, seq_len)
+            end = min(start + batch_size, n_examples)
+            try:
+                batch_func(start, end)
+            except RuntimeError as e:
+                if is_out_of_memory_error(e) and self.on_out_of_memory(
+                    model, seq_len, end - start
+                ):
+                    continue
+                raise
+            self.on_success(model, seq_len, end - start)
+            start = end
@@ -0,0 +1,101 @@
+# Throughput of sentence scoring through MicroBatchingScorer as a function of the number of concurrent callers.
+#
+# run from the repository root:
+# python -m benchmarks.benchmark_micro_batching --model plain_gpt2 --gpu 0
+#
+# for each number of concurrent callers, every caller scores its own sentences one at a time (awaiting each result),
+# once with micro-batching and once with batches of a single request (the baseline).
+
+import os
+import time
+import asyncio
+import argparse
+
+import pandas as pd
+
+from async_scoring import MicroBatchingScorer
+
+default_txt_fname = os.path.join(
+    "resources",
+    "sentence_corpora",
+    "natural_sentences_for_synthetic_controversial_sentence_pair_optimization.txt",
+)
+
+
+async def run_callers(scorer, sentences, n_callers):
+    """split sentences across n_callers concurrent callers and score them. returns the elapsed time."""
+
+    async def caller(caller_sentences):
+        for sent in caller_sentences:
+            await scorer.sent_prob(sent)
+
+    start_time = time.perf_counter()
+    await asyncio.gather(*[caller(sentences[i::n_callers]) for i in range(n_callers)])
+    return time.perf_counter() - start_time
+
+
+async def benchmark(model, sentences, n_callers_list, window_in_seconds, max_batch_size):
+    results = []
+    for n_callers in n_callers_list:
+        for mode, scorer_kwargs in [
+            ("baseline", {"window_in_seconds": 0.0, "max_batch_size": 1}),
+            (
+                "micro-batching",
+                {
+                    "window_in_seconds": window_in_seconds,
+                    "max_batch_size": max_batch_size,
+                },
+            ),
+        ]:
+            async with MicroBatchingScorer(model, **scorer_kwargs) as scorer:
+                elapsed = await run_callers(scorer, sentences, n_callers)
+                stats = scorer.stats()
+            results.append(
+                {
+                    "mode": mode,
+                    "n_callers": n_callers,
+                    "sentences_per_second": len(sentences) / elapsed,
+                    "mean_batch_size": stats["mean_batch_size"],
+                }
+            )
+            print(results[-1])
+    return pd.DataFrame(results)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", type=str, default="plain_gpt2")
+    parser.add_argument("--gpu", type=int, default=None)
+    parser.add_argument("--sentences_file", type=str, default=default_txt_fname)
+    parser.add_argument("--n_sentences", type=int, default=256)
+    parser.add_argument(
+        "--n_callers", type=int, nargs="+", default=[1, 2, 4, 8, 16, 32, 64]
+    )
+    parser.add_argument("--window_in_seconds", type=float, default=0.005)
+    parser.add_argument("--max_batch_size", type=int, default=64)
+    parser.add_argument("--output_csv", type=str, default=None)
+    args = parser.parse_args()
+
+    from model_functions import model_factory
+
+    model = model_factory(args.model, args.gpu)
+
+    with open(args.sentences_file) as f:
+        sentences = [l.strip().rstrip(".") for l in f][: args.n_sentences]
+
+    results = asyncio.run(
+        benchmark(
+            model,
+            sentences,
+            args.n_callers,
+            args.window_in_seconds,
+            args.max_batch_size,
+        )
+    )
+    print(
+        results.pivot(
+            index="n_callers", columns="mode", values="sentences_per_second"
+        )
+    )
+    if args.output_csv is not None:
+        results.to_csv(args.output_csv)
@@ -0,0 +1,228 @@
+# Wall time, model calls and final loss of optimize_sentence_set, replayed from recorded model outputs.
+#
+# run from the repository root. first, record optimizations of natural sentences (requires the models):
+# python -m benchmarks.benchmark_optimizer_replay record --models bert_has_a_mouth bert --gpus 0 1 --trace_folder optimizer_trace
+#
+# then, rerun the same optimizations with the recorded outputs standing in for the models (CPU only, no model evaluations):
+# python -m benchmarks.benchmark_optimizer_replay replay --trace_folder optimizer_trace
+#
+# replay options (e.g., --n_speculative_candidates 4 or --h_method IsotonicRegression) change the optimizer's settings.
+# an optimization that requests a model call that was not recorded is reported as diverged.
+
+import os
+import json
+import time
+import random
+import pickle
+import argparse
+
+import numpy as np
+import pandas as pd
+
+from model_recording import RecordingModel, ReplayModel, ModelCallNotRecordedError
+from sentence_optimization import optimize_sentence_set, controversiality_loss_func
+
+default_txt_fname = os.path.join(
+    "resources",
+    "sentence_corpora",
+    "natural_sentences_for_synthetic_controversial_sentence_pair_optimization.txt",
+)
+
+
+def get_optimizer_kwargs(allow_only_prepositions_to_repeat, max_steps, **overrides):
+    """the settings of synthesize_one_controversial_sentence_pair.py (the second sentence of a pair is optimized)"""
+    if allow_only_prepositions_to_repeat:
+        with open(os.path.join("resources", "preps.pkl"), "rb") as f:
+            allowed_repeating_words = set(pickle.load(f))
+    else:
+        allowed_repeating_words = None
+    kwargs = {
+        "sentences_to_change": [1],
+        "replacement_strategy": "cyclic",
+        "keep_words_unique": allow_only_prepositions_to_repeat,
+        "allowed_repeating_words": allowed_repeating_words,
+        "max_steps": max_steps,
+        "max_replacement_attempts_per_word": 50,
+        "max_non_decreasing_loss_attempts_per_word": 5,
+    }
+    kwargs.update(overrides)
+    return kwargs
+
+
+def run_optimization(models, initial_sentence, seed, optimizer_kwargs):
+    """optimize a sentence pair from a natural sentence. returns a dictionary of measurements"""
+    random.seed(seed)
+    np.random.seed(seed)
+    n_calls_before = [dict(model.n_calls) for model in models]
+    start_time = time.perf_counter()
+    try:
+        results = optimize_sentence_set(
+            2,
+            models,
+            controversiality_loss_func,
+            sentences=[initial_sentence] * 2,
+            sent_length_in_words=len(initial_sentence.split(" ")),
+            verbose=0,
+            **optimizer_kwargs,
+        )
+        diverged = False
+    except ModelCallNotRecordedError:
+        results = None
+        diverged = True
+    measurements = {
+        "initial_sentence": initial_sentence,
+        "seed": seed,
+        "wall_time": time.perf_counter() - start_time,
+        "diverged": diverged,
+        "n_sent_prob_calls": sum(
+            model.n_calls["sent_prob"] - before["sent_prob"]
+            for model, before in zip(models, n_calls_before)
+        ),
+        "n_word_probs_calls": sum(
+            model.n_calls["word_probs"] - before["word_probs"]
+            for model, before in zip(models, n_calls_before)
+        ),
+    }
+    if results is not None:
+        measurements.update(
+            {
+                "model_wall_time": results["model_wall_time"],
+                "n_steps": results["step"],
+                "final_loss": results["loss"],
+                "final_sentence": results["sentences"][1],
+            }
+        )
+    return measurements
+
+
+def record(models, initial_sentences, trace_folder, seed, optimizer_settings):
+    recording_models = [RecordingModel(model) for model in models]
+    runs = []
+    for i_sentence, initial_sentence in enumerate(initial_sentences):
+        runs.append(
+            run_optimization(
+                recording_models,
+                initial_sentence,
+                seed + i_sentence,
+                get_optimizer_kwargs(**optimizer_settings),
+            )
+        )
+        print(runs[-1])
+    for i_model, model in enumerate(recording_models):
+        model.save(os.path.join(trace_folder, f"model_{i_model}.pkl.gz"))
+    with open(os.path.join(trace_folder, "runs.json"), "w") as f:
+        json.dump(
+            {
+                "models": [model.name for model in models],
+                "optimizer_settings": optimizer_settings,
+                "runs": runs,
+            },
+            f,
+            indent=1,
+        )
+    return pd.DataFrame(runs)
+
+
+def replay(trace_folder, optimizer_overrides):
+    """rerun the recorded optimizations with ReplayModels. returns a DataFrame with one row per optimization"""
+    with open(os.path.join(trace_folder, "runs.json")) as f:
+        trace = json.load(f)
+    models = [
+        ReplayModel(os.path.join(trace_folder, f"model_{i_model}.pkl.gz"))
+        for i_model in range(len(trace["models"]))
+    ]
+    optimizer_kwargs = get_optimizer_kwargs(
+        **trace["optimizer_settings"], **optimizer_overrides
+    )
+    results = []
+    for recorded_run in trace["runs"]:
+        result = run_optimization(
+            models,
+            recorded_run["initial_sentence"],
+            recorded_run["seed"],
+            optimizer_kwargs,
+        )
+        result["recorded_wall_time"] = recorded_run["wall_time"]
+        result["recorded_final_loss"] = recorded_run.get("final_loss")
+        result["same_final_sentence"] = result.get("final_sentence") == recorded_run.get(
+            "final_sentence"
+        )
+        results.append(result)
+        print(result)
+    return pd.DataFrame(results)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("mode", choices=["record", "replay"])
+    parser.add_argument("--trace_folder", type=str, default="optimizer_trace")
+    # record
+    parser.add_argument("--models", type=str, nargs=2, default=["bert_has_a_mouth", "bert"])
+    parser.add_argument("--gpus", type=int, nargs=2, default=[None, None])
+    parser.add_argument("--sentences_file", type=str, default=default_txt_fname)
+    parser.add_argument("--n_sentences", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--max_steps", type=int, default=10000)
+    parser.add_argument(
+        "--allow_repeating_words", action="store_true", help="don't restrict repeating words to prepositions"
+    )
+    # replay
+    parser.add_argument("--n_speculative_candidates", type=int, default=None)
+    parser.add_argument("--h_method", type=str, default=None)
+    parser.add_argument("--no_concurrent_models", action="store_true")
+    parser.add_argument("--output_csv", type=str, default=None)
+    args = parser.parse_args()
+
+    if args.mode == "record":
+        from model_functions import model_factory
+
+        models = [
+            model_factory(model_name, gpu_id)
+            for model_name, gpu_id in zip(args.models, args.gpus)
+        ]
+        with open(args.sentences_file) as f:
+            initial_sentences = [l.strip().rstrip(".") for l in f][: args.n_sentences]
+        results = record(
+            models,
+            initial_sentences,
+            args.trace_folder,
+            args.seed,
+            {
+                "allow_only_prepositions_to_repeat": not args.allow_repeating_words,
+                "max_steps": args.max_steps,
+            },
+        )
+    else:
+        overrides = dict()
+        if args.n_speculative_candidates is not None:
+            overrides["n_speculative_candidates"] = args.n_speculative_candidates
+        if args.h_method is not None:
+            overrides["h_method"] = args.h_method
+        if args.no_concurrent_models:
+            overrides["concurrent_models"] = False
+        results = replay(args.trace_folder, overrides)
+
+    columns = [
+        column
+        for column in [
+            "wall_time",
+            "model_wall_time",
+            "n_sent_prob_calls",
+            "n_word_probs_calls",
+            "final_loss",
+            "diverged",
+            "same_final_sentence",
+        ]
+        if column in results.columns
+    ]
+    with pd.option_context("display.width", 200, "display.max_columns", 20):
+        print(results[columns])
+        total_columns = [
+            column
+            for column in columns
+            if column
+            in ["wall_time", "model_wall_time", "n_sent_prob_calls", "n_word_probs_calls"]
+        ]
+        print(results[total_columns].sum().rename("total"))
+    if args.output_csv is not None:
+        results.to_csv(args.output_csv)
@@ -0,0 +1,185 @@
+# Throughput and memory of the sent_prob and word_probs implementations of model_factory.
+#
+# run from the repository root. first, build randomly initialized stand-ins of the models (once, no downloads):
+# python tiny_models.py --checkpoint_folder tiny_model_checkpoints
+#
+# then benchmark every scorer on the stand-ins (CPU):
+# python -m benchmarks.benchmark_scorers --checkpoint_folder tiny_model_checkpoints
+#
+# --models bert gpt2 benchmarks a subset, --gpu 0 runs the models on a GPU,
+# and omitting --checkpoint_folder benchmarks the real checkpoints (model_checkpoints and the pretrained transformers).
+#
+# each model is benchmarked in a fresh process, so its peak memory (max RSS, and max allocated GPU memory) is its own.
+# loading includes the tokenization of the vocabulary (get_starts_suffs and get_token_info).
+
+import os
+import time
+import random
+import argparse
+import resource
+import multiprocessing
+
+import pandas as pd
+
+default_txt_fname = os.path.join(
+    "resources",
+    "sentence_corpora",
+    "natural_sentences_for_synthetic_controversial_sentence_pair_optimization.txt",
+)
+
+# every model_factory model with sent_prob and word_probs implementations
+scorer_names = [
+    "bert",
+    "bert_new_implementation",
+    "bert_has_a_mouth",
+    "bert_whole_word",
+    "roberta",
+    "roberta_new_implementation",
+    "roberta_has_a_mouth",
+    "xlm",
+    "electra",
+    "electra_new_implementation",
+    "electra_has_a_mouth",
+    "gpt2",
+    "naive_gpt2",
+    "plain_gpt2",
+    "bilstm",
+    "lstm",
+    "rnn",
+    "trigram",
+    "bigram",
+]
+
+
+def get_max_rss_in_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # ru_maxrss is in kilobytes (on Linux)
+
+
+def load_sentences(sentences_file, sent_len, n_sentences, seed=0):
+    """sample natural sentences of sent_len words, made of vocabulary words only (all of the models can score them)"""
+    from vocabulary import vocab_low, vocab_cap
+
+    vocab_low, vocab_cap = set(vocab_low), set(vocab_cap)
+    with open(sentences_file) as f:
+        sentences = [l.strip().rstrip(".") for l in f]
+    sentences = [
+        sentence
+        for sentence in sentences
+        if len(sentence.split(" ")) == sent_len
+        and sentence.split(" ")[0] in vocab_cap
+        and all(word in vocab_low for word in sentence.split(" ")[1:])
+    ]
+    return random.Random(seed).sample(sentences, min(n_sentences, len(sentences)))
+
+
+def benchmark_scorer(
+    model_name, sentences, n_word_probs, gpu_id=None, checkpoint_folder=None, seed=0
+):
+    """load a model and time its sent_prob, sent_probs and word_probs calls.
+
+    args:
+        model_name (str) model_factory model name
+        sentences (list) of sentences to score (the first one is used as a warm-up)
+        n_word_probs (int) number of word_probs calls (on random words of the sentences)
+        gpu_id (int) or None for CPU
+        checkpoint_folder (str) see model_factory
+
+    returns a dictionary of measurements
+    """
+    import torch
+
+    from model_functions import model_factory
+
+    measurements = {"model": model_name}
+    start_time = time.perf_counter()
+    model = model_factory(model_name, gpu_id, checkpoint_folder=checkpoint_folder)
+    measurements["load_time"] = time.perf_counter() - start_time
+    measurements["max_rss_after_load_mb"] = get_max_rss_in_mb()
+
+    warm_up_sentence, sentences = sentences[0], sentences[1:]
+    model.sent_prob(warm_up_sentence)
+    model.word_probs(warm_up_sentence.split(" "), 0)
+
+    start_time = time.perf_counter()
+    for sentence in sentences:
+        model.sent_prob(sentence)
+    elapsed = time.perf_counter() - start_time
+    measurements["sent_prob_per_second"] = len(sentences) / elapsed
+
+    start_time = time.perf_counter()
+    model.sent_probs(sentences)
+    elapsed = time.perf_counter() - start_time
+    measurements["sent_probs_sentences_per_second"] = len(sentences) / elapsed
+
+    rng = random.Random(seed)
+    n_scored_sentences = 0
+    start_time = time.perf_counter()
+    for i_call in range(n_word_probs):
+        words = sentences[i_call % len(sentences)].split(" ")
+        probs = model.word_probs(words, rng.randrange(len(words)))
+        if isinstance(probs, tuple):  # (probs, vocabulary indices)
+            probs = probs[0]
+        n_scored_sentences += len(probs)
+    elapsed = time.perf_counter() - start_time
+    measurements["word_probs_per_second"] = n_word_probs / elapsed
+    measurements["word_probs_sentences_per_second"] = n_scored_sentences / elapsed
+
+    measurements["max_rss_mb"] = get_max_rss_in_mb()
+    if gpu_id is not None:
+        measurements["max_gpu_memory_mb"] = torch.cuda.max_memory_allocated(
+            torch.device(f"cuda:{gpu_id}")
+        ) / (1024 ** 2)
+    return measurements
+
+
+def benchmark_scorer_in_subprocess(*args, **kwargs):
+    """run benchmark_scorer in a fresh process (so its memory measurements are not affected by previous models)"""
+    with multiprocessing.get_context("spawn").Pool(1) as pool:
+        return pool.apply(benchmark_scorer, args, kwargs)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--models", type=str, nargs="+", default=scorer_names)
+    parser.add_argument("--checkpoint_folder", type=str, default=None)
+    parser.add_argument("--gpu", type=int, default=None)
+    parser.add_argument("--sentences_file", type=str, default=default_txt_fname)
+    parser.add_argument("--sent_len", type=int, default=8)
+    parser.add_argument("--n_sentences", type=int, default=11)
+    parser.add_argument("--n_word_probs", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output_csv", type=str, default=None)
+    args = parser.parse_args()
+
+    sentences = load_sentences(
+        args.sentences_file, args.sent_len, args.n_sentences, seed=args.seed
+    )
+    results = []
+    for model_name in args.models:
+        try:
+            result = benchmark_scorer_in_subprocess(
+                model_name,
+                sentences,
+                args.n_word_probs,
+                gpu_id=args.gpu,
+                checkpoint_folder=args.checkpoint_folder,
+                seed=args.seed,
+            )
+        except Exception as e:
+            print(f"{model_name} failed: {e!r}")
+            result = {"model": model_name, "error": repr(e)}
+        print(result)
+        results.append(result)
+    results = pd.DataFrame(results).set_index("model")
+
+    with pd.option_context(
+        "display.width",
+        250,
+        "display.max_columns",
+        20,
+        "display.float_format",
+        "{:.2f}".format,
+    ):
+        print(results)
+    if args.output_csv is not None:
+        results.to_csv(args.output_csv)
@@ -0,0 +1,298 @@
+# Exact model evaluations per accepted word replacement for each SetInterpolationSearch surrogate (h_method).
+#
+# run from the repository root. first, record word replacement problems (requires the models):
+# python -m benchmarks.benchmark_surrogates record --models bert_has_a_mouth bert --gpus 0 1 --trace surrogate_trace.pkl
+# (add --history_csv <files> to also record problems from later stages of recorded optimizations,
+# e.g., files written by synthesize_one_controversial_sentence_pair.py --history_csv_fname)
+#
+# then, replay the problems with each surrogate (CPU only):
+# python -m benchmarks.benchmark_surrogates replay --trace surrogate_trace.pkl
+#
+# a problem is a word location of the optimized sentence of a pair, as the optimizer encounters it.
+# since replaying needs the exact log-probability of any candidate the surrogate might propose, each problem is restricted
+# to a random subset of the candidates (plus the ones the optimizer always evaluates), whose exact log-probabilities are recorded.
+
+import os
+import time
+import pickle
+import argparse
+import contextlib
+
+import numpy as np
+import pandas as pd
+
+from interpolation_search import SetInterpolationSearch
+from sentence_optimization import (
+    CandidateWordTable,
+    controversiality_loss_func,
+    get_loss_fun_with_respect_to_sentence_i,
+)
+
+default_txt_fname = os.path.join(
+    "resources",
+    "sentence_corpora",
+    "natural_sentences_for_synthetic_controversial_sentence_pair_optimization.txt",
+)
+
+default_h_methods = [
+    "LinearRegression",
+    "IsotonicRegression",
+    "HuberRegression",
+    "KNeighborsRegression",
+]
+
+
+def record_problems(models, sentence_pairs, n_candidates=2000, seed=0):
+    """record the word replacement problems of the second sentence of each sentence pair.
+
+    args:
+        models (list) two model objects (the first one should accept the optimized sentence, the second reject it)
+        sentence_pairs (list) of (reference sentence, optimized sentence) tuples
+        n_candidates (int) number of randomly sampled replacement words per problem
+        seed (int) random seed for sampling the candidates
+
+    returns a list of problems (dictionaries)
+    """
+    rng = np.random.RandomState(seed)
+    i_sentence = 1
+    problems = []
+    for sentences in sentence_pairs:
+        sentences = list(sentences)
+        sentences_log_p = np.asarray(
+            [[model.sent_prob(sentence) for sentence in sentences] for model in models]
+        )
+        words = sentences[i_sentence].split(" ")
+        for wordi in range(len(words)):
+            candidates = CandidateWordTable(
+                wordi,
+                words[wordi],
+                [model.word_probs(list(words), wordi) for model in models],
+                [model.is_word_prob_exact for model in models],
+                sentences_log_p[:, i_sentence],
+            )
+
+            # a random subset of the candidates, plus the ones evaluated before any prediction is made
+            # (the current word and the extremes of the approximate log-probabilities)
+            idxs = set(
+                rng.choice(len(candidates), min(n_candidates, len(candidates)), replace=False)
+            )
+            idxs.update(np.flatnonzero(np.logical_not(np.isnan(candidates.exact)).all(axis=1)))
+            for i_model, model in enumerate(models):
+                if not model.is_word_prob_exact:
+                    idxs.add(np.nanargmax(candidates.approximate[:, i_model]))
+                    idxs.add(np.nanargmin(candidates.approximate[:, i_model]))
+            idxs = np.sort(np.asarray(list(idxs), dtype=int))
+
+            is_initially_observed = np.logical_not(np.isnan(candidates.exact[idxs]))
+            f = candidates.exact[idxs].copy()
+            for i_model, model in enumerate(models):
+                missing = np.flatnonzero(np.isnan(f[:, i_model]))
+                modified_sents = []
+                for idx in idxs[missing]:
+                    modified_words = list(words)
+                    modified_words[wordi] = candidates.get_word(idx)
+                    modified_sents.append(" ".join(modified_words))
+                if len(modified_sents) > 0:
+                    f[missing, i_model] = model.sent_probs(modified_sents)
+
+            problems.append(
+                {
+                    "sentences": sentences,
+                    "i_sentence": i_sentence,
+                    "wordi": wordi,
+                    "words": [candidates.get_word(idx) for idx in idxs],
+                    "sentences_log_p": sentences_log_p,
+                    "g": candidates.approximate[idxs],
+                    "f": f,
+                    "is_initially_observed": is_initially_observed,
+                }
+            )
+            print(
+                "recorded {} / word {} ({} candidates)".format(
+                    sentences[i_sentence], wordi, len(idxs)
+                )
+            )
+    return problems
+
+
+def replay_problem(
+    problem,
+    h_method,
+    max_replacement_attempts_per_word=50,
+    max_non_decreasing_loss_attempts_per_word=5,
+):
+    """search for a loss-decreasing replacement as optimize_sentence_set does (with n_speculative_candidates=1),
+    taking exact log-probabilities from the recorded problem.
+
+    returns a dictionary with the number of exact evaluations and the outcome of the search.
+    """
+    sentences_log_p = problem["sentences_log_p"]
+    i_sentence = problem["i_sentence"]
+    g, f = problem["g"], problem["f"]
+    current_loss = controversiality_loss_func(sentences_log_p).item()
+    loss_func_i = get_loss_fun_with_respect_to_sentence_i(
+        sentences_log_p, i_sentence, controversiality_loss_func
+    )
+    best_possible_loss = np.min(loss_func_i(f))
+
+    start_time = time.perf_counter()
+    n_evaluations = 0
+    ys = np.where(problem["is_initially_observed"], f, np.nan)
+    for k in range(g.shape[1]):
+        if np.isnan(g[:, k]).all():
+            continue
+        for idx in [np.nanargmax(g[:, k]), np.nanargmin(g[:, k])]:
+            if np.isnan(ys[idx, k]):
+                ys[idx, k] = f[idx, k]
+                n_evaluations += 1
+    is_observed = np.logical_not(np.isnan(ys)).any(axis=1)
+    opt = SetInterpolationSearch(
+        loss_fun=loss_func_i,
+        g=g,
+        initial_observed_xs=np.flatnonzero(is_observed),
+        initial_observed_ys=ys[is_observed],
+        h_method=h_method,
+    )
+
+    idx, loss, _ = opt.get_observed_loss_minimum()
+    accepted = idx is not None and loss < current_loss
+    if not accepted:
+        best_loss = np.inf
+        n_non_decreasing_loss_attempts = 0
+        for _ in range(max_replacement_attempts_per_word):
+            idx, _, missing_variables = opt.get_unobserved_loss_minimum()
+            if idx is None:
+                break
+            for k in missing_variables:
+                opt.update_query_result(xs=[idx], ys=[f[idx, k]], k=k)
+                n_evaluations += 1
+            loss, _ = opt.get_loss_for_x(idx)
+            if loss < current_loss:
+                accepted = True
+                break
+            if loss < best_loss:
+                best_loss = loss
+                n_non_decreasing_loss_attempts = 0
+            else:
+                n_non_decreasing_loss_attempts += 1
+                if (
+                    n_non_decreasing_loss_attempts
+                    > max_non_decreasing_loss_attempts_per_word
+                ):
+                    break
+
+    return {
+        "h_method": h_method,
+        "n_evaluations": n_evaluations,
+        "accepted": accepted,
+        "loss_decrease": current_loss - loss if accepted else 0.0,
+        "possible_loss_decrease": max(current_loss - best_possible_loss, 0.0),
+        "search_time": time.perf_counter() - start_time,
+    }
+
+
+def benchmark(problems, h_methods, **kwargs):
+    """replay all problems with each h_method. returns a summary DataFrame (one row per h_method)"""
+    results = []
+    for h_method in h_methods:
+        for i_problem, problem in enumerate(problems):
+            with contextlib.redirect_stdout(None):  # SetInterpolationSearch reports ties
+                result = replay_problem(problem, h_method, **kwargs)
+            result["i_problem"] = i_problem
+            results.append(result)
+    results = pd.DataFrame(results)
+
+    improvable = results["possible_loss_decrease"] > 0
+    summary = results.groupby("h_method", sort=False).agg(
+        n_problems=("i_problem", "count"),
+        n_accepted=("accepted", "sum"),
+        n_evaluations=("n_evaluations", "sum"),
+        search_time=("search_time", "sum"),
+    )
+    summary["evaluations_per_accepted_replacement"] = (
+        summary["n_evaluations"] / summary["n_accepted"]
+    )
+    summary["acceptance_rate_when_possible"] = (
+        results[improvable].groupby("h_method", sort=False)["accepted"].mean()
+    )
+    loss_decreases = (
+        results[improvable]
+        .groupby("h_method", sort=False)[["loss_decrease", "possible_loss_decrease"]]
+        .sum()
+    )
+    summary["fraction_of_possible_loss_decrease"] = (
+        loss_decreases["loss_decrease"] / loss_decreases["possible_loss_decrease"]
+    )
+    return summary
+
+
+def load_sentence_pairs(sentences_file, n_sentences, history_csvs, n_history_rows, seed):
+    """natural sentences (as identical pairs, the optimizer's starting point) and rows sampled from optimization histories"""
+    with open(sentences_file) as f:
+        natural_sentences = [l.strip().rstrip(".") for l in f][:n_sentences]
+    sentence_pairs = [(sentence, sentence) for sentence in natural_sentences]
+    for history_csv in history_csvs:
+        history = pd.read_csv(history_csv)
+        history = history.sample(min(n_history_rows, len(history)), random_state=seed)
+        sentence_pairs += list(zip(history["s0"], history["s1"]))
+    return sentence_pairs
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("mode", choices=["record", "replay"])
+    parser.add_argument("--trace", type=str, default="surrogate_trace.pkl")
+    # record
+    parser.add_argument("--models", type=str, nargs=2, default=["bert_has_a_mouth", "bert"])
+    parser.add_argument("--gpus", type=int, nargs=2, default=[None, None])
+    parser.add_argument("--sentences_file", type=str, default=default_txt_fname)
+    parser.add_argument("--n_sentences", type=int, default=10)
+    parser.add_argument("--history_csv", type=str, nargs="*", default=[])
+    parser.add_argument("--n_history_rows", type=int, default=10)
+    parser.add_argument("--n_candidates", type=int, default=2000)
+    parser.add_argument("--seed", type=int, default=0)
+    # replay
+    parser.add_argument("--h_methods", type=str, nargs="+", default=default_h_methods)
+    parser.add_argument("--max_replacement_attempts_per_word", type=int, default=50)
+    parser.add_argument("--max_non_decreasing_loss_attempts_per_word", type=int, default=5)
+    parser.add_argument("--output_csv", type=str, default=None)
+    args = parser.parse_args()
+
+    if args.mode == "record":
+        from model_functions import model_factory
+
+        models = [
+            model_factory(model_name, gpu_id)
+            for model_name, gpu_id in zip(args.models, args.gpus)
+        ]
+        sentence_pairs = load_sentence_pairs(
+            args.sentences_file,
+            args.n_sentences,
+            args.history_csv,
+            args.n_history_rows,
+            args.seed,
+        )
+        problems = record_problems(
+            models, sentence_pairs, n_candidates=args.n_candidates, seed=args.seed
+        )
+        with open(args.trace, "wb") as f:
+            pickle.dump({"models": args.models, "problems": problems}, f)
+        print("saved {} problems to {}".format(len(problems), args.trace))
+    else:
+        with open(args.trace, "rb") as f:
+            trace = pickle.load(f)
+        print(
+            "replaying {} problems recorded with {}".format(
+                len(trace["problems"]), " vs ".join(trace["models"])
+            )
+        )
+        summary = benchmark(
+            trace["problems"],
+            args.h_methods,
+            max_replacement_attempts_per_word=args.max_replacement_attempts_per_word,
+            max_non_decreasing_loss_attempts_per_word=args.max_non_decreasing_loss_attempts_per_word,
+        )
+        with pd.option_context("display.width", 200, "display.max_columns", 20):
+            print(summary)
+        if args.output_csv is not None:
+            summary.to_csv(args.output_csv)
@@ -0,0 +1,153 @@
+# Concurrency stress test of TaskScheduler: many local processes claim and complete jobs from a shared database.
+#
+# run from the repository root:
+# python -m benchmarks.benchmark_task_scheduler --n_processes 64 --db_path /tmp/scheduler_stress.db
+#
+# every process repeatedly claims up to --n_jobs_per_claim jobs of the least-served group (claim_next_jobs),
+# holds them for --job_time_in_seconds (renewing their leases through a JobLeaseHeartbeat's stopping checks),
+# and marks them as completed (jobs_done), until all jobs are claimed.
+# the test fails if a job is claimed twice, if a job is never completed, if a lease is lost, or if a worker fails.
+# --journal_mode DELETE tests the rollback journal (used on network file systems).
+
+import os
+import json
+import time
+import argparse
+import multiprocessing
+from collections import Counter
+
+import pandas as pd
+
+from task_scheduler import TaskScheduler, JobLeaseHeartbeat
+
+
+def get_candidate_jobs(n_groups, n_jobs_per_group):
+    return {
+        f"group_{i_group}": [
+            {"group": i_group, "job": i_job} for i_job in range(n_jobs_per_group)
+        ]
+        for i_group in range(n_groups)
+    }
+
+
+def run_worker(
+    db_path,
+    n_groups,
+    n_jobs_per_group,
+    n_jobs_per_claim,
+    job_time_in_seconds,
+    scheduler_kwargs,
+):
+    """claim and complete jobs until none are left. returns the claimed job ids (JSON) and call timings"""
+    sch = TaskScheduler(db_path=db_path, **scheduler_kwargs)
+    candidate_jobs = get_candidate_jobs(n_groups, n_jobs_per_group)
+    claimed_job_ids = []
+    claim_times, done_times = [], []
+    n_lost_leases = 0
+    while True:
+        start_time = time.perf_counter()
+        claimed = sch.claim_next_jobs(candidate_jobs, n_jobs=n_jobs_per_claim)
+        claim_times.append(time.perf_counter() - start_time)
+        if claimed is None:
+            break
+        group, job_ids = claimed
+        claimed_job_ids.extend(json.dumps(job_id) for job_id in job_ids)
+        heartbeat = JobLeaseHeartbeat(sch, job_ids)
+        stopping_checks = [heartbeat.get_stopping_check(job_id) for job_id in job_ids]
+        end_time = time.monotonic() + job_time_in_seconds
+        while time.monotonic() < end_time:  # optimization steps
+            time.sleep(min(0.1, job_time_in_seconds))
+            if any(stopping_check() for stopping_check in stopping_checks):
+                break
+        lost_job_ids = heartbeat.renew()
+        start_time = time.perf_counter()
+        lost_job_ids += sch.jobs_done(job_ids, results=[group] * len(job_ids))
+        done_times.append(time.perf_counter() - start_time)
+        n_lost_leases += len(set(json.dumps(job_id) for job_id in lost_job_ids))
+    sch.close()
+    return {
+        "claimed_job_ids": claimed_job_ids,
+        "claim_times": claim_times,
+        "done_times": done_times,
+        "n_lost_leases": n_lost_leases,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--db_path", type=str, default="scheduler_stress.db")
+    parser.add_argument("--n_processes", type=int, default=32)
+    parser.add_argument("--n_groups", type=int, default=100)
+    parser.add_argument("--n_jobs_per_group", type=int, default=50)
+    parser.add_argument("--n_jobs_per_claim", type=int, default=1)
+    parser.add_argument("--job_time_in_seconds", type=float, default=0.0)
+    parser.add_argument("--lease_time_in_seconds", type=float, default=15 * 60)
+    parser.add_argument("--timeout", type=float, default=600)
+    parser.add_argument("--max_retries", type=int, default=10)
+    parser.add_argument("--journal_mode", type=str, default="WAL")
+    args = parser.parse_args()
+
+    for suffix in ["", "-wal", "-shm", "-journal"]:
+        if os.path.isfile(args.db_path + suffix):
+            os.remove(args.db_path + suffix)
+
+    scheduler_kwargs = {
+        "lease_time_in_seconds": args.lease_time_in_seconds,
+        "timeout": args.timeout,
+        "max_retries": args.max_retries,
+        "journal_mode": args.journal_mode,
+    }
+    worker_args = (
+        args.db_path,
+        args.n_groups,
+        args.n_jobs_per_group,
+        args.n_jobs_per_claim,
+        args.job_time_in_seconds,
+        scheduler_kwargs,
+    )
+    start_time = time.perf_counter()
+    with multiprocessing.get_context("spawn").Pool(args.n_processes) as pool:
+        async_results = [
+            pool.apply_async(run_worker, worker_args) for _ in range(args.n_processes)
+        ]
+        results, n_failed_workers = [], 0
+        for async_result in async_results:
+            try:
+                results.append(async_result.get())
+            except Exception as e:
+                print(f"worker failed: {e!r}")
+                n_failed_workers += 1
+    elapsed = time.perf_counter() - start_time
+
+    claim_counts = Counter(
+        job_id for result in results for job_id in result["claimed_job_ids"]
+    )
+    n_jobs = args.n_groups * args.n_jobs_per_group
+    jobs = TaskScheduler(db_path=args.db_path, **scheduler_kwargs).to_pandas()
+    claim_times = pd.Series([t for result in results for t in result["claim_times"]])
+    done_times = pd.Series([t for result in results for t in result["done_times"]])
+
+    summary = {
+        "n_processes": args.n_processes,
+        "journal_mode": args.journal_mode,
+        "n_jobs": n_jobs,
+        "n_claimed_jobs": len(claim_counts),
+        "n_jobs_claimed_more_than_once": sum(n > 1 for n in claim_counts.values()),
+        "n_completed_jobs": int(jobs["is_completed"].sum()),
+        "n_lost_leases": sum(result["n_lost_leases"] for result in results),
+        "n_failed_workers": n_failed_workers,
+        "elapsed": elapsed,
+        "claimed_jobs_per_second": sum(claim_counts.values()) / elapsed,
+        "median_claim_time": claim_times.median(),
+        "max_claim_time": claim_times.max(),
+        "median_done_time": done_times.median(),
+        "max_done_time": done_times.max(),
+    }
+    for key, value in summary.items():
+        print(f"{key}: {value}")
+
+    assert n_failed_workers == 0, "some workers failed"
+    assert summary["n_jobs_claimed_more_than_once"] == 0, "jobs were claimed twice"
+    assert summary["n_lost_leases"] == 0, "leases were lost"
+    assert summary["n_claimed_jobs"] == n_jobs, "some jobs were never claimed"
+    assert summary["n_completed_jobs"] == n_jobs, "some jobs were never completed"
@@ -0,0 +1,162 @@
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+
+def normalize_sentence(sent):
+    """normalize a sentence for use as a cache key (strip and collapse whitespace)"""
+    return " ".join(sent.split())
+
+
+class LRUCache:
+    """A bounded least-recently-used cache with hit/miss counters.
+
+    Thread-safe: a cache can be shared by models that are evaluated concurrently (in threads).
+    """
+
+    def __init__(self, maxsize=100000):
+        """Initialize the cache
+
+        args:
+            maxsize: maximal number of cached items (the least recently used item is evicted first)
+        """
+        assert maxsize > 0, "maxsize must be positive"
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()  # guards _data and the counters
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key, default=None):
+        """return the cached value for key (and mark it as recently used), or default if key is not cached"""
+        with self._lock:
+            try:
+                value = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def info(self):
+        """return a dictionary of cache statistics"""
+        with self._lock:
+            n_requests = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / n_requests if n_requests > 0 else 0.0,
+                "evictions": self.evictions,
+                "size": len(self._data),
+                "maxsize": self.maxsize,
+            }
+
+
+def get_masked_context(words, wordi):
+    """return a hashable key of the context of the word at wordi (all the other words and the masked position)"""
+    return (wordi, tuple(words[:wordi]), tuple(words[wordi + 1 :]))
+
+
+def compact_word_probs(output, exact=False):
+    """convert a word_probs output to read-only float32 log-probabilities (and int32 vocabulary indices)
+
+    args:
+        output: a word_probs output (log-probabilities, or a tuple of log-probabilities and vocabulary indices)
+        exact: if True, the log-probabilities are kept as float64 (for models whose word_probs are exact sentence
+            log-probabilities, which the optimizer uses as such)
+    """
+    dtype = np.float64 if exact else np.float32
+    if isinstance(output, tuple) and len(output) == 2:
+        probs = np.array(output[0], dtype=dtype)
+        inds = np.array(output[1], dtype=np.int32)
+        probs.setflags(write=False)
+        inds.setflags(write=False)
+        return probs, inds
+    probs = np.array(output, dtype=dtype)
+    probs.setflags(write=False)
+    return probs
+
+
+def _nbytes(value):
+    if isinstance(value, tuple):
+        return sum(v.nbytes for v in value)
+    return value.nbytes
+
+
+class WordProbsCache(LRUCache):
+    """A bounded LRU cache of word_probs outputs keyed by (model name, masked context).
+
+    Outputs are stored as compact read-only float32 arrays (and int32 vocabulary indices),
+    except for the outputs of models whose word_probs are exact, which are stored as float64.
+    The cache is bounded both by the number of entries and by the total size of the stored arrays,
+    and can be shared by several models.
+    """
+
+    def __init__(self, maxsize=10000, max_size_in_mb=1024):
+        """Initialize the cache
+
+        args:
+            maxsize: maximal number of cached word_probs outputs
+            max_size_in_mb: maximal total size of the cached arrays (the least recently used outputs are evicted first)
+        """
+        super().__init__(maxsize=maxsize)
+        self.max_size_in_bytes = int(max_size_in_mb * 2 ** 20)
+        self.size_in_bytes = 0
+
+    def get_word_probs(self, model_name, words, wordi):
+        """return the cached word_probs output of model_name for words, wordi (or None)"""
+        return self.get((model_name, get_masked_context(words, wordi)))
+
+    def put_word_probs(self, model_name, words, wordi, output, exact=False):
+        """cache a word_probs output and return its compact version (float64 if exact, see compact_word_probs)"""
+        value = compact_word_probs(output, exact=exact)
+        self.put((model_name, get_masked_context(words, wordi)), value)
+        return value
+
+    def put(self, key, value):
+        with self._lock:
+            if key in self._data:
+                self.size_in_bytes -= _nbytes(self._data[key])
+            self._data[key] = value
+            self._data.move_to_end(key)
+            self.size_in_bytes += _nbytes(value)
+            while len(self._data) > 0 and (
+                len(self._data) > self.maxsize
+                or self.size_in_bytes > self.max_size_in_bytes
+            ):
+                _, evicted_value = self._data.popitem(last=False)
+                self.size_in_bytes -= _nbytes(evicted_value)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.size_in_bytes = 0
+
+    def info(self):
+        """return a dictionary of cache statistics"""
+        info = super().info()
+        info["size_in_mb"] = self.size_in_bytes / 2 ** 20
+        info["max_size_in_mb"] = self.max_size_in_bytes / 2 ** 20
+        return info
@@ -0,0 +1,78 @@
+import os
+import time
+import pickle
+import pathlib
+import warnings
+
+from utils import hash_dict
+
+
+class OptimizationCheckpoint:
+    """Periodically saves the state of a sentence optimization to a small file, so a restarted job can resume it.
+
+    The file is replaced atomically (written to a temporary file, then renamed),
+    so a job killed while saving leaves the previous checkpoint intact.
+
+    Example:
+        checkpoint = get_job_checkpoint("checkpoints", job_id)
+        results = optimize_sentence_set(..., checkpoint=checkpoint)  # resumes if a checkpoint of job_id exists
+    """
+
+    def __init__(self, fname, key=None, interval_in_seconds=600):
+        """Initialize the checkpoint
+
+        args:
+            fname: path of the checkpoint file
+            key: any picklable object identifying the optimization (e.g., the job id).
+                A checkpoint saved with a different key is ignored.
+            interval_in_seconds: minimal time between saves (0 saves at every opportunity)
+        """
+        self.fname = fname
+        self.key = key
+        self.interval_in_seconds = interval_in_seconds
+        self.last_save_time = time.time()
+
+    def load(self):
+        """return the saved state (a dictionary), or None if there is no usable checkpoint"""
+        if not os.path.isfile(self.fname):
+            return None
+        try:
+            with open(self.fname, "rb") as f:
+                checkpoint = pickle.load(f)
+        except Exception as e:
+            warnings.warn(f"could not read checkpoint {self.fname} ({e}), starting over.")
+            return None
+        if checkpoint["key"] != self.key:
+            warnings.warn(
+                f"checkpoint {self.fname} belongs to {checkpoint['key']}, not {self.key}. starting over."
+            )
+            return None
+        return checkpoint["state"]
+
+    def is_due(self):
+        """return True if interval_in_seconds passed since the last save"""
+        return time.time() - self.last_save_time >= self.interval_in_seconds
+
+    def save(self, state):
+        """save state (a picklable dictionary)"""
+        target_folder = os.path.dirname(self.fname)
+        if target_folder != "":
+            pathlib.Path(target_folder).mkdir(parents=True, exist_ok=True)
+        tmp_fname = "{}.{}.tmp".format(self.fname, os.getpid())
+        with open(tmp_fname, "wb") as f:
+            pickle.dump({"key": self.key, "state": state}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_fname, self.fname)
+        self.last_save_time = time.time()
+
+    def remove(self):
+        """delete the checkpoint file (call when the optimization is completed)"""
+        if os.path.isfile(self.fname):
+            os.remove(self.fname)
+
+
+def get_job_checkpoint(checkpoint_folder, job_id, interval_in_seconds=600):
+    """return an OptimizationCheckpoint for a TaskScheduler job id (any JSONable object)"""
+    fname = os.path.join(checkpoint_folder, hash_dict(job_id) + ".pkl")
+    return OptimizationCheckpoint(fname, key=job_id, interval_in_seconds=interval_in_seconds)
@@ -1,15 +1,22 @@
 # evaluate sentence probabilities of reddit sentences (needed for natural controversial sentence pair selection)
 # this script should be run for each candidate model
+#
+# sentences are read and scored in chunks. results are written into a preallocated memory-mapped .npy file,
+# and a small progress file is updated after each chunk, so if the script is killed, running it again
+# with the same arguments resumes from the last completed chunk.
+#
+# on CPU nodes, --n_workers splits the corpus across worker processes, each with its own copy of the model.
 
-import numpy as np
 import os
+import json
+import time
 import argparse
 import pathlib
+import multiprocessing
 
+import numpy as np
 from tqdm import tqdm
 
-from model_functions import model_factory
-
 default_txt_fname = os.path.join(
     "resources",
     "sentence_corpora",
@@ -22,36 +29,310 @@ default_output_file = os.path.join(
     "natural_sentences_for_natural_controversial_sentence_pair_selection_probs",
 )
 
-parser = argparse.ArgumentParser()
-parser.add_argument("--natural_sentences_file", type=str, default=default_txt_fname)
-parser.add_argument("--model", type=str, required=True)
-parser.add_argument("--gpu", default=0)
-parser.add_argument("--output_file", type=str, default=default_output_file)
 
-args = parser.parse_args()
+def count_sentences(fname):
+    with open(fname, "r") as f:
+        return sum(1 for line in f)
 
-model = args.model
 
-model1 = model_factory(model, args.gpu)
+def iterate_sentence_chunks(fname, chunk_size, start=0, stop=None):
+    """yield (index of first sentence, list of sentences) chunks of the sentences in lines [start, stop) of fname"""
+    chunk = []
+    chunk_start = start
+    with open(fname, "r") as f:
+        for i_line, line in enumerate(f):
+            if i_line < start:
+                continue
+            if stop is not None and i_line >= stop:
+                break
+            chunk.append(line.rstrip("\n"))
+            if len(chunk) == chunk_size:
+                yield chunk_start, chunk
+                chunk_start += len(chunk)
+                chunk = []
+    if len(chunk) > 0:
+        yield chunk_start, chunk
 
-file = open(
-    args.natural_sentences_file,
-    "r",
-)
-sents = file.read()
-sents = sents.split("\n")
 
-probs = []
-for sent in tqdm(sents):
-    prob = model1.sent_prob(sent)
-    probs.append(prob)
+def read_progress(progress_fname):
+    if not os.path.isfile(progress_fname):
+        return None
+    with open(progress_fname, "r") as f:
+        return json.load(f)
 
-probs = np.array(probs)
 
-target_folder = os.path.dirname(args.output_file)
-pathlib.Path(target_folder).mkdir(parents=True, exist_ok=True)
+def write_progress(progress_fname, progress):
+    # write to a temporary file and rename it, so a crash never leaves a partially written progress file
+    tmp_fname = progress_fname + ".tmp"
+    with open(tmp_fname, "w") as f:
+        json.dump(progress, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_fname, progress_fname)
 
-np.save(
-    args.output_file + "_" + model + ".npy",
-    probs,
-)
+
+def get_shard_limits(n_sentences, n_shards):
+    """return a list of (start, stop) sentence index ranges splitting n_sentences into n_shards contiguous shards"""
+    limits = [int(x) for x in np.linspace(0, n_sentences, n_shards + 1).round()]
+    return list(zip(limits[:-1], limits[1:]))
+
+
+def get_progress_fname(output_fname, i_shard=None):
+    if i_shard is None:
+        return output_fname + ".progress.json"
+    return output_fname + ".shard{}.progress.json".format(i_shard)
+
+
+def open_output_array(output_fname, n_sentences, n_shards=1, resume=True):
+    """open (or create) a memory-mapped float64 .npy vector of n_sentences log-probabilities.
+
+    returns the memory-mapped array and, for each shard, the index of the next sentence to score.
+    """
+    progress_fname = get_progress_fname(output_fname)
+    progress = read_progress(progress_fname) if resume else None
+    shard_limits = get_shard_limits(n_sentences, n_shards)
+    if progress is not None and os.path.isfile(output_fname):
+        assert (
+            progress["n_sentences"] == n_sentences
+        ), f"{output_fname} was started with a different number of sentences"
+        n_shards_started = progress["n_shards"]
+        assert (
+            n_shards_started == n_shards
+        ), f"{output_fname} was started with {n_shards_started} workers, use the same number of workers to resume (or --restart)"
+        log_probs = np.lib.format.open_memmap(output_fname, mode="r+")
+        assert log_probs.shape == (n_sentences,)
+        next_sentences = []
+        for i_shard, (shard_start, shard_stop) in enumerate(shard_limits):
+            shard_progress = read_progress(get_progress_fname(output_fname, i_shard))
+            if shard_progress is None:
+                next_sentences.append(shard_start)
+            else:
+                next_sentences.append(shard_progress["n_scored"])
+        return log_probs, next_sentences
+
+    target_folder = os.path.dirname(output_fname)
+    if target_folder != "":
+        pathlib.Path(target_folder).mkdir(parents=True, exist_ok=True)
+    log_probs = np.lib.format.open_memmap(
+        output_fname, mode="w+", dtype=np.float64, shape=(n_sentences,)
+    )
+    log_probs[:] = np.nan
+    log_probs.flush()
+    for i_shard in range(n_shards):
+        shard_progress_fname = get_progress_fname(output_fname, i_shard)
+        if os.path.isfile(shard_progress_fname):
+            os.remove(shard_progress_fname)
+    write_progress(progress_fname, {"n_sentences": n_sentences, "n_shards": n_shards})
+    return log_probs, [shard_start for shard_start, shard_stop in shard_limits]
+
+
+def score_sentence_range(
+    model,
+    natural_sentences_file,
+    log_probs,
+    progress_fname,
+    start,
+    stop,
+    chunk_size=256,
+    verbose=True,
+    pbar_position=0,
+):
+    """score the sentences in lines [start, stop) of natural_sentences_file into log_probs[start:stop].
+
+    after each chunk, the memory map is flushed and the index of the next sentence to score is saved to progress_fname.
+    returns the number of scored sentences.
+    """
+    n_scored_now = 0
+    with tqdm(
+        total=stop - start,
+        unit="sent",
+        disable=not verbose,
+        position=pbar_position,
+    ) as pbar:
+        for chunk_start, chunk in iterate_sentence_chunks(
+            natural_sentences_file, chunk_size, start=start, stop=stop
+        ):
+            log_probs[chunk_start : chunk_start + len(chunk)] = model.sent_probs(chunk)
+            log_probs.flush()
+            write_progress(progress_fname, {"n_scored": chunk_start + len(chunk)})
+            n_scored_now += len(chunk)
+            pbar.update(len(chunk))
+    return n_scored_now
+
+
+def _score_shard(
+    model_name,
+    natural_sentences_file,
+    output_fname,
+    i_shard,
+    start,
+    stop,
+    n_threads,
+    chunk_size,
+    verbose,
+):
+    """worker process: load a CPU copy of the model and score one shard of the corpus"""
+    import torch
+    from model_functions import model_factory
+
+    # limit torch's intra-op parallelism so n_workers x n_threads matches the number of cores
+    torch.set_num_threads(n_threads)
+    model = model_factory(model_name, None)
+    log_probs = np.lib.format.open_memmap(output_fname, mode="r+")
+    return score_sentence_range(
+        model,
+        natural_sentences_file,
+        log_probs,
+        get_progress_fname(output_fname, i_shard),
+        start,
+        stop,
+        chunk_size=chunk_size,
+        verbose=verbose,
+        pbar_position=i_shard,
+    )
+
+
+def score_corpus(
+    model,
+    natural_sentences_file,
+    output_fname,
+    chunk_size=256,
+    resume=True,
+    n_workers=1,
+    n_threads_per_worker=1,
+    verbose=True,
+):
+    """score all sentences in natural_sentences_file (one sentence per line) with model, streaming the results into output_fname.
+
+    args:
+        model: a model_factory object, or, if n_workers > 1, a model name (each worker process loads its own CPU copy)
+        natural_sentences_file: text file, one sentence per line
+        output_fname: .npy file to write (progress files output_fname + '*.progress.json' are kept next to it)
+        chunk_size: number of sentences read, scored and checkpointed together
+        resume: if True, continue a previous run from its last completed chunk
+        n_workers: number of worker processes. The corpus is split into n_workers contiguous shards,
+            and each worker writes its results into its own part of the output array.
+        n_threads_per_worker: number of torch threads used by each worker process
+    """
+    n_sentences = count_sentences(natural_sentences_file)
+    log_probs, next_sentences = open_output_array(
+        output_fname, n_sentences, n_shards=n_workers, resume=resume
+    )
+    shard_limits = get_shard_limits(n_sentences, n_workers)
+    n_already_scored = sum(
+        next_sentence - shard_start
+        for next_sentence, (shard_start, shard_stop) in zip(next_sentences, shard_limits)
+    )
+    if verbose and n_already_scored > 0:
+        print(f"resuming ({n_already_scored}/{n_sentences} sentences already scored).")
+
+    start_time = time.time()
+    if n_workers == 1:
+        n_scored_now = score_sentence_range(
+            model,
+            natural_sentences_file,
+            log_probs,
+            get_progress_fname(output_fname, 0),
+            next_sentences[0],
+            n_sentences,
+            chunk_size=chunk_size,
+            verbose=verbose,
+        )
+    else:
+        assert isinstance(
+            model, str
+        ), "for multi-process scoring, pass a model name rather than a loaded model"
+        del log_probs  # each worker opens its own memory map
+        ctx = multiprocessing.get_context("spawn")
+        with ctx.Pool(n_workers) as pool:
+            n_scored_per_shard = pool.starmap(
+                _score_shard,
+                [
+                    (
+                        model,
+                        natural_sentences_file,
+                        output_fname,
+                        i_shard,
+                        next_sentence,
+                        shard_stop,
+                        n_threads_per_worker,
+                        chunk_size,
+                        verbose,
+                    )
+                    for i_shard, (next_sentence, (shard_start, shard_stop)) in enumerate(
+                        zip(next_sentences, shard_limits)
+                    )
+                ],
+            )
+        n_scored_now = sum(n_scored_per_shard)
+
+    elapsed = time.time() - start_time
+    if verbose:
+        print(
+            "scored {} sentences in {:.1f} seconds ({:.2f} sentences/second).".format(
+                n_scored_now, elapsed, n_scored_now / max(elapsed, 1e-9)
+            )
+        )
+    # done. remove progress files.
+    for i_shard in range(n_workers):
+        shard_progress_fname = get_progress_fname(output_fname, i_shard)
+        if os.path.isfile(shard_progress_fname):
+            os.remove(shard_progress_fname)
+    os.remove(get_progress_fname(output_fname))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--natural_sentences_file", type=str, default=default_txt_fname)
+    parser.add_argument("--model", type=str, required=True)
+    parser.add_argument("--gpu", default=0)
+    parser.add_argument("--output_file", type=str, default=default_output_file)
+    parser.add_argument(
+        "--chunk_size",
+        type=int,
+        default=256,
+        help="number of sentences scored between checkpoints",
+    )
+    parser.add_argument(
+        "--restart",
+        action="store_true",
+        help="ignore the progress of a previous run and start from the first sentence",
+    )
+    parser.add_argument(
+        "--n_workers",
+        type=int,
+        default=1,
+        help="number of CPU worker processes (each loads its own copy of the model). --gpu is ignored if > 1",
+    )
+    parser.add_argument(
+        "--n_threads_per_worker",
+        type=int,
+        default=1,
+        help="number of torch threads per worker process",
+    )
+
+    args = parser.parse_args()
+
+    output_fname = args.output_file + "_" + args.model + ".npy"
+    if args.n_workers > 1:
+        score_corpus(
+            args.model,
+            args.natural_sentences_file,
+            output_fname,
+            chunk_size=args.chunk_size,
+            resume=not args.restart,
+            n_workers=args.n_workers,
+            n_threads_per_worker=args.n_threads_per_worker,
+        )
+    else:
+        from model_functions import model_factory
+
+        model1 = model_factory(args.model, args.gpu)
+
+        score_corpus(
+            model1,
+            args.natural_sentences_file,
+            output_fname,
+            chunk_size=args.chunk_size,
+            resume=not args.restart,
+        )
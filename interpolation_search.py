@@ -1,5 +1,4 @@
 import numpy as np
-import sklearn.linear_model
 import matplotlib.pyplot as plt
 import pandas as pd
 
@@ -13,6 +12,109 @@ def expand_to_matrix(x):
     return x
 
 
+def fit_line(x, y):
+    """return the least-squares (intercept, slope) of y as a function of x (slope is 0 if x is constant)"""
+    mean_x, mean_y = np.mean(x), np.mean(y)
+    var_x = np.mean((x - mean_x) ** 2)
+    if var_x > 0:
+        slope = np.mean((x - mean_x) * (y - mean_y)) / var_x
+    else:
+        slope = 0.0
+    return mean_y - slope * mean_x, slope
+
+
+# non-linear surrogates predicting f_k(x) from g_k(x) (see SetInterpolationSearch's h_method).
+# they follow scikit-learn's fit(X, y)/predict(X) interface, where X is an (n, 1) array of g_k(x) values,
+# and import scikit-learn only when fitted.
+
+
+class IsotonicSurrogate:
+    """A monotone fit within the observed range of g_k(x), extrapolated linearly beyond it.
+
+    increasing=True assumes f_k(x) grows with g_k(x) (as an exact log-probability with its approximation).
+    """
+
+    def __init__(self, increasing=True):
+        self.increasing = increasing
+
+    def fit(self, X, y):
+        from sklearn.isotonic import IsotonicRegression
+
+        x = np.asarray(X)[:, 0]
+        self._isotonic = IsotonicRegression(
+            increasing=self.increasing, out_of_bounds="clip"
+        )
+        self._isotonic.fit(x, y)
+        _, slope = fit_line(x, y)
+        # extrapolate in the direction of the monotone fit
+        self._slope = max(slope, 0.0) if self._isotonic.increasing_ else min(slope, 0.0)
+        self._x_min, self._x_max = x.min(), x.max()
+        return self
+
+    def predict(self, X):
+        x = np.asarray(X)[:, 0]
+        x_clipped = np.clip(x, self._x_min, self._x_max)
+        return self._isotonic.predict(x_clipped) + self._slope * (x - x_clipped)
+
+
+class HuberSurrogate:
+    """A linear fit with the Huber loss, so a few badly approximated observations don't skew the line."""
+
+    def __init__(self, epsilon=1.35):
+        self.epsilon = epsilon
+
+    def fit(self, X, y):
+        from sklearn.linear_model import HuberRegressor
+
+        x = np.asarray(X)[:, 0]
+        self._intercept, self._slope = fit_line(x, y)
+        if len(x) < 3:
+            return self  # too few observations to tell outliers
+        # standardize, so the solver works at the same scale regardless of the range of log-probabilities
+        x_mean, x_std = np.mean(x), np.std(x)
+        y_mean, y_std = np.mean(y), np.std(y)
+        if x_std == 0 or y_std == 0:
+            return self
+        huber = HuberRegressor(epsilon=self.epsilon, max_iter=1000)
+        try:
+            huber.fit(((x - x_mean) / x_std)[:, None], (y - y_mean) / y_std)
+        except ValueError:  # the solver did not converge, keep the least-squares line
+            return self
+        self._slope = huber.coef_[0] * y_std / x_std
+        self._intercept = y_mean + huber.intercept_ * y_std - self._slope * x_mean
+        return self
+
+    def predict(self, X):
+        return self._intercept + self._slope * np.asarray(X)[:, 0]
+
+
+class KNeighborsSurrogate:
+    """A linear fit corrected by the mean residual of the observations with the nearest g_k(x) values."""
+
+    def __init__(self, n_neighbors=5):
+        self.n_neighbors = n_neighbors
+
+    def fit(self, X, y):
+        from sklearn.neighbors import KNeighborsRegressor
+
+        x = np.asarray(X)[:, 0]
+        self._intercept, self._slope = fit_line(x, y)
+        self._knn = KNeighborsRegressor(n_neighbors=min(self.n_neighbors, len(x)))
+        self._knn.fit(np.asarray(X), y - (self._intercept + self._slope * x))
+        return self
+
+    def predict(self, X):
+        x = np.asarray(X)[:, 0]
+        return self._intercept + self._slope * x + self._knn.predict(np.asarray(X))
+
+
+h_methods = {
+    "IsotonicRegression": IsotonicSurrogate,
+    "HuberRegression": HuberSurrogate,
+    "KNeighborsRegression": KNeighborsSurrogate,
+}
+
+
 class SetInterpolationSearch:
     def __init__(
         self,
@@ -50,7 +152,11 @@ class SetInterpolationSearch:
         initial_observed_xs: array_like, (M,) numpy array of x indecis for which we already observed f_k(x)
         initial_observed_ys: array_like (M,K) numpy array of observed f_k(x) values
         initial_xs_guesses: list, x indecis to evaluate before approximating f (first index is evaluated first)
-        h_method: str, name of regression class used. default - 'LinearRegression'
+        h_method: 'LinearRegression' (default) - a least-squares line fitted in closed form
+            from incrementally updated sums, one of the surrogates in h_methods
+            ('IsotonicRegression', 'HuberRegression', 'KNeighborsRegression', these require scikit-learn),
+            or a regression class with scikit-learn's fit(X, y)/predict(X) interface
+            for non-linear predictions of f_k(x) from g_k(x).
         """
 
         self.loss_fun = loss_fun
@@ -58,9 +164,37 @@ class SetInterpolationSearch:
         self._N = self.g.shape[0]
         self._K = self.g.shape[1]
 
+        self.h_method = h_method
+        if h_method == "LinearRegression":
+            self._h_class = None
+        elif isinstance(h_method, str):
+            if h_method not in h_methods:
+                raise ValueError(f"unsupported h_method {h_method}")
+            self._h_class = h_methods[h_method]
+        else:
+            self._h_class = h_method
+
         self.ys = np.empty(shape=(self._N, self._K))
         self.ys[:] = np.nan
 
+        # the observed and unobserved sets are updated incrementally by update_query_result:
+        self._n_missing = np.full(self._N, self._K)  # number of unobserved variables of each x
+        self._fully_observed_xs = []  # xs for which all of the variables are observed
+        self._unobserved_obs = None  # xs with at least one unobserved variable (recomputed when needed)
+        self._g_is_observed = np.logical_not(np.isnan(self.g))
+        self._regression_xs = [
+            [] for _ in range(self._K)
+        ]  # for each variable, the xs with both observed g(x) and f(x)
+        self._h = [None] * self._K  # fitted regressions (None when outdated)
+        # for each variable, the sums n, Σg, Σf, Σgf and Σg² over the observed pairs (for the closed-form linear fit)
+        self._regression_sums = np.zeros((self._K, 5))
+
+        # predictions and predicted losses for all xs, updated only where they can have changed
+        self._y_aprx = None
+        self._predicted_loss = None
+        self._is_outdated_x = np.zeros(self._N, dtype=bool)
+        self._is_outdated_k = np.zeros(self._K, dtype=bool)
+
         if initial_observed_xs is not None:
             assert (
                 initial_observed_ys is not None
@@ -75,11 +209,6 @@ class SetInterpolationSearch:
         else:
             self.initial_xs_guesses = []
 
-        self.h_method = h_method
-        self._h_class = {
-            "LinearRegression": sklearn.linear_model.LinearRegression,
-        }[h_method]
-
     def update_query_result(self, xs, ys, k=None):
         """
         Record observed results.
@@ -98,15 +227,95 @@ class SetInterpolationSearch:
         xs = np.atleast_1d(np.asarray(xs, dtype=int))
 
         if k is not None:  # update particular variable
-            ys = np.atleast_1d(np.asarray(ys))
+            ys = np.atleast_1d(np.asarray(ys, dtype=float))
             assert ys.ndim == 1
-            not_nan_mask = np.logical_not(np.isnan(ys))
-            self.ys[xs, k] = np.where(not_nan_mask, ys, self.ys[xs, k])
+            ks = np.full(len(xs), k)
         else:
             ys = expand_to_matrix(ys)
             assert ys.shape[1] == self._K
-            not_nan_mask = np.logical_not(np.isnan(ys))
-            self.ys[xs] = np.where(not_nan_mask, ys, self.ys[xs])
+            ks = np.tile(np.arange(self._K), len(xs))
+            xs = np.repeat(xs, self._K)
+            ys = ys.reshape(-1)
+
+        # keep only new values (the last one, if an (x,k) pair is repeated)
+        _, last_indices = np.unique((xs * self._K + ks)[::-1], return_index=True)
+        last_indices = len(xs) - 1 - last_indices
+        xs, ks, ys = xs[last_indices], ks[last_indices], ys[last_indices]
+        is_new = np.logical_and(np.logical_not(np.isnan(ys)), self.ys[xs, ks] != ys)
+        xs, ks, ys = xs[is_new], ks[is_new], ys[is_new]
+        if len(xs) == 0:
+            return
+
+        previous_ys = self.ys[xs, ks]
+        was_missing = np.isnan(previous_ys)
+        is_regression_pair = self._g_is_observed[xs, ks]
+        self.ys[xs, ks] = ys
+
+        # update the regression sums (replacing the contribution of previously observed values)
+        pair_ks = ks[is_regression_pair]
+        pair_gs = self.g[xs[is_regression_pair], pair_ks]
+        pair_dn = was_missing[is_regression_pair].astype(float)
+        pair_dys = ys[is_regression_pair] - np.where(
+            was_missing, 0.0, previous_ys
+        )[is_regression_pair]
+        for i_sum, d_sum in enumerate(
+            [pair_dn, pair_dn * pair_gs, pair_dys, pair_gs * pair_dys, pair_dn * pair_gs**2]
+        ):
+            np.add.at(self._regression_sums[:, i_sum], pair_ks, d_sum)
+
+        np.subtract.at(self._n_missing, xs[was_missing], 1)
+        newly_fully_observed = np.unique(xs[was_missing])
+        newly_fully_observed = newly_fully_observed[
+            self._n_missing[newly_fully_observed] == 0
+        ]
+        if len(newly_fully_observed) > 0:
+            self._fully_observed_xs.extend(newly_fully_observed)
+            self._unobserved_obs = None
+        self._is_outdated_x[xs] = True
+
+        for k in np.unique(ks[is_regression_pair]):
+            # the regression of variable k changed, so did its predictions
+            self._regression_xs[k].extend(
+                xs[np.logical_and(ks == k, np.logical_and(was_missing, is_regression_pair))]
+            )
+            self._h[k] = None
+            self._is_outdated_k[k] = True
+
+    def _fit_h(self, k):
+        """return a regression predicting f_k(x) from g_k(x), fitted on the observed pairs (refitted only when they changed).
+
+        for h_method='LinearRegression', the regression is an (intercept, slope) tuple.
+        """
+        if self._h[k] is None:
+            if self._h_class is None:
+                n, sum_g, sum_f, sum_gf, sum_gg = self._regression_sums[k]
+                assert (
+                    n >= 2
+                ), "insufficient number of observed predictor-criterion pairs for fitting a regression."
+                mean_g, mean_f = sum_g / n, sum_f / n
+                var_g = sum_gg / n - mean_g**2
+                if var_g > 1e-12 * max(mean_g**2, 1.0):
+                    slope = (sum_gf / n - mean_g * mean_f) / var_g
+                else:  # all observed g_k(x) are equal (as scikit-learn, predict the mean)
+                    slope = 0.0
+                self._h[k] = (mean_f - slope * mean_g, slope)
+            else:
+                regression_xs = np.sort(np.asarray(self._regression_xs[k], dtype=int))
+                assert (
+                    len(regression_xs) >= 2
+                ), "insufficient number of observed predictor-criterion pairs for fitting a regression."
+                h = self._h_class()
+                h.fit(expand_to_matrix(self.g[regression_xs, k]), self.ys[regression_xs, k])
+                self._h[k] = h
+        return self._h[k]
+
+    def _predict_h(self, k, g_k):
+        """predict f_k(x) from a vector of g_k(x) values"""
+        h = self._fit_h(k)
+        if self._h_class is None:
+            intercept, slope = h
+            return intercept + slope * g_k
+        return h.predict(expand_to_matrix(g_k))
 
     def _calc_y_aprx(self, xs_to_predict, return_ground_truth_when_available=True):
         xs_to_predict = np.asarray(xs_to_predict, dtype=int)
@@ -123,30 +332,58 @@ class SetInterpolationSearch:
                 is_observed_xs = np.zeros_like(xs_to_predict, dtype=bool)
 
             # some values are missing, or return_ground_truth_when_available is False. Run regression.
-            # for fitting the regression, select only values for which we have both the predictor and criterion.
-            not_nan_mask = np.logical_and(
-                np.logical_not(np.isnan(self.ys[:, k])),
-                np.logical_not(np.isnan(self.g[:, k])),
-            )
-            assert (
-                not_nan_mask.sum() >= 2
-            ), "insufficient number of observed predictor-criterion pairs for fitting a regression."
-            h = self._h_class()
-            h.fit(
-                X=expand_to_matrix(self.g[not_nan_mask, k]), y=self.ys[not_nan_mask, k]
-            )
             should_predict_xs = np.logical_and(
                 np.logical_not(is_observed_xs),
-                np.logical_not(np.isnan(self.g[xs_to_predict, k])),
+                self._g_is_observed[xs_to_predict, k],
             )
-            y_aprx[should_predict_xs, k] = h.predict(
-                X=expand_to_matrix(self.g[xs_to_predict[should_predict_xs], k])
+            if not should_predict_xs.any():
+                self._fit_h(k)  # as before, assert that the regression can be fitted
+                continue
+            y_aprx[should_predict_xs, k] = self._predict_h(
+                k, self.g[xs_to_predict[should_predict_xs], k]
             )
         return y_aprx
 
+    def _get_predicted_loss(self):
+        """return the (N,) predicted loss of all xs (exact for fully observed xs).
+
+        Only the losses of xs whose predictions might have changed since the previous call are re-evaluated.
+        """
+        if self._predicted_loss is None:
+            self._y_aprx = self._calc_y_aprx(np.arange(self._N))
+            self._predicted_loss = np.asarray(self.loss_fun(self._y_aprx), dtype=float)
+        else:
+            is_outdated_x = self._is_outdated_x
+            for k in np.flatnonzero(self._is_outdated_k):
+                # the predictions of variable k changed wherever it is unobserved
+                is_predicted = np.logical_and(
+                    np.isnan(self.ys[:, k]), self._g_is_observed[:, k]
+                )
+                if is_predicted.any():
+                    self._y_aprx[is_predicted, k] = self._predict_h(
+                        k, self.g[is_predicted, k]
+                    )
+                is_outdated_x = np.logical_or(is_outdated_x, is_predicted)
+            outdated_xs = np.flatnonzero(is_outdated_x)
+            if len(outdated_xs) > 0:
+                self._y_aprx[self._is_outdated_x] = self._calc_y_aprx(
+                    np.flatnonzero(self._is_outdated_x)
+                )
+                self._predicted_loss[outdated_xs] = self.loss_fun(
+                    self._y_aprx[outdated_xs]
+                )
+        self._is_outdated_x[:] = False
+        self._is_outdated_k[:] = False
+        return self._predicted_loss
+
+    def unobserved_obs(self):
+        """return the xs with at least one unobserved variable"""
+        if self._unobserved_obs is None:
+            self._unobserved_obs = np.flatnonzero(self._n_missing > 0)
+        return self._unobserved_obs
+
     def fully_observed_obs(self):
-        # this line can be optimized for speed by incremental updating
-        return np.flatnonzero(np.all(np.logical_not(np.isnan(self.ys)), axis=1))
+        return np.sort(np.asarray(self._fully_observed_xs, dtype=int))
 
     def get_observed_loss_minimum(self):
         """
@@ -186,13 +423,11 @@ class SetInterpolationSearch:
             minimum_index = self.initial_xs_guesses.pop(0)
             minimum_loss = None
         else:
-            # this line can be optimized for speed by incremental updating
-            unobserved_obs = np.flatnonzero(np.any(np.isnan(self.ys), axis=1))
+            unobserved_obs = self.unobserved_obs()
 
             if len(unobserved_obs) == 0:
                 return None, None, []
-            y_aprx = self._calc_y_aprx(unobserved_obs)
-            predicted_loss = self.loss_fun(y_aprx)
+            predicted_loss = self._get_predicted_loss()[unobserved_obs]
 
             minimum_loss = np.nanmin(predicted_loss)
             minima_indices_in_unobserved_xs = np.flatnonzero(
@@ -210,6 +445,76 @@ class SetInterpolationSearch:
         which_variables_are_missing = np.flatnonzero(np.isnan(self.ys[minimum_index]))
         return minimum_index, minimum_loss, which_variables_are_missing
 
+    def get_unobserved_loss_minima(self, k, diversity=0.0):
+        """
+        yield the k best yet unobserved xs that minimize loss_fun (lowest predicted loss first)
+
+        Parameters
+        ----------
+        k : int, maximal number of xs to return
+        diversity : float, if > 0, skip xs whose predicted f(x) values are all within diversity
+            of those of an already selected x (in the units of f, e.g., log-probability).
+            Such xs are expected to behave alike, so evaluating both rarely pays off.
+
+        returns the (sorted) indices of the loss minimizers, the *predicted* losses at these points
+        (NaN for initial guesses), and a (k, K) boolean mask of the missing variables at each point
+        """
+
+        xs = []
+        predicted_losses = []
+        # use initial guesses first, if available
+        while len(self.initial_xs_guesses) > 0 and len(xs) < k:
+            xs.append(self.initial_xs_guesses.pop(0))
+            predicted_losses.append(np.nan)
+
+        if len(xs) < k:
+            unobserved_obs = self.unobserved_obs()
+            unobserved_obs = unobserved_obs[np.logical_not(np.isin(unobserved_obs, xs))]
+            predicted_loss = self._get_predicted_loss()[unobserved_obs]
+            is_valid = np.logical_not(np.isnan(predicted_loss))
+            unobserved_obs, predicted_loss = unobserved_obs[is_valid], predicted_loss[is_valid]
+
+            selected_xs = []
+            n_pool = k - len(xs)
+            while len(selected_xs) < k - len(xs):
+                # sort only the best n_pool candidates (ties are broken by index, as in a stable sort)
+                if n_pool < len(predicted_loss):
+                    kth_loss = np.partition(predicted_loss, n_pool - 1)[n_pool - 1]
+                    pool = np.flatnonzero(predicted_loss <= kth_loss)
+                else:
+                    pool = np.arange(len(predicted_loss))
+                pool = pool[np.argsort(predicted_loss[pool], kind="stable")]
+
+                if diversity > 0:
+                    selected_xs, selected_losses = [], []
+                    selected_y_aprx = np.empty((0, self._K))
+                    for i in pool:
+                        y_aprx = self._y_aprx[unobserved_obs[i]]
+                        is_similar = np.all(
+                            np.abs(selected_y_aprx - y_aprx) <= diversity, axis=1
+                        )
+                        if is_similar.any():
+                            continue
+                        selected_xs.append(unobserved_obs[i])
+                        selected_losses.append(predicted_loss[i])
+                        selected_y_aprx = np.concatenate([selected_y_aprx, y_aprx[None]])
+                        if len(selected_xs) == k - len(xs):
+                            break
+                else:
+                    pool = pool[: k - len(xs)]
+                    selected_xs = list(unobserved_obs[pool])
+                    selected_losses = list(predicted_loss[pool])
+
+                if len(pool) >= len(predicted_loss):
+                    break  # all candidates were considered
+                n_pool *= 4
+            xs.extend(selected_xs)
+            predicted_losses.extend(selected_losses)
+
+        xs = np.asarray(xs, dtype=int)
+        is_variable_missing = np.isnan(self.ys[xs]).reshape(len(xs), self._K)
+        return xs, np.asarray(predicted_losses, dtype=float), is_variable_missing
+
     def get_loss_for_x(self, x):
         """
         yield the exact loss for scalar index x.
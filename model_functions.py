@@ -4,6 +4,7 @@ import itertools
 import random
 import pickle
 import re
+import time
 import warnings
 
 import pandas as pd
@@ -30,6 +31,14 @@ from transformers import (
 from knlm import KneserNey
 
 from recurrent_NNs import RNNLM, RNNLM_bilstm, RNNModel
+from batching import BatchSizePolicy
+from caching import LRUCache, WordProbsCache, normalize_sentence
+from sentence_prob_store import (
+    SentenceProbabilityStore,
+    get_model_key,
+    get_checkpoint_path,
+)
+from profiling import profiled
 
 logsoftmax = torch.nn.LogSoftmax(dim=-1)
 
@@ -40,9 +49,12 @@ from vocabulary import vocab_low, vocab_cap
 ###############################################################
 
 
-def get_word2id_dict():
+def get_word2id_dict(checkpoint_folder=None):
     with open(
-        os.path.join("model_checkpoints", "neuralnet_word2id_dict.pkl"),
+        get_checkpoint_path(
+            os.path.join("model_checkpoints", "neuralnet_word2id_dict.pkl"),
+            checkpoint_folder,
+        ),
         "rb",
     ) as file:
         word2id = pickle.load(file)
@@ -55,18 +67,68 @@ def get_word2id_dict():
 
 
 # word2id, nn_vocab_size, id2word = get_word2id_dict()
+
+
+def get_rnn_sizes(state_dict, rnn_name):
+    """return the constructor arguments of a recurrent_NNs model, read from the shapes of its state dict
+
+    args:
+        state_dict: the model's state dict
+        rnn_name: the name of the model's recurrent module ('lstm' or 'rnn')
+
+    returns a dictionary with vocab_size, embed_size, hidden_size and num_layers.
+    """
+    vocab_size, embed_size = state_dict["embed.weight"].shape
+    return {
+        "vocab_size": int(vocab_size),
+        "embed_size": int(embed_size),
+        "hidden_size": int(state_dict[rnn_name + ".weight_hh_l0"].shape[1]),
+        "num_layers": len(
+            [
+                key
+                for key in state_dict
+                if key.startswith(rnn_name + ".weight_hh_l")
+                and not key.endswith("_reverse")
+            ]
+        ),
+    }
+
+
 ########################################################
 
 
 class model_factory:
     """Factory class for creating models"""
 
-    def __init__(self, name, gpu_id, only_tokenizer=False):
+    def __init__(
+        self,
+        name,
+        gpu_id,
+        only_tokenizer=False,
+        memory_budget_in_gb=None,
+        sent_prob_cache_size=None,
+        sent_prob_store=None,
+        word_probs_cache=None,
+        profiler=None,
+        checkpoint_folder=None,
+    ):
         """Initialize the model
 
         args:
             name: name of the model
             gpu_id: integer id of the gpu to use (or None for cpu)
+            memory_budget_in_gb: memory available for a single batch of model evaluations (see batching.BatchSizePolicy)
+            sent_prob_cache_size: if not None, memoize up to this many sent_prob results (least recently used are evicted)
+            sent_prob_store: a SentenceProbabilityStore (or a path to its database) shared across processes.
+                If None, the environment variable CONTSTIMLANG_SENT_PROB_STORE is used (if set).
+            word_probs_cache: a caching.WordProbsCache (which can be shared by several models),
+                or an integer - memoize up to this many word_probs outputs in a cache owned by this model.
+            profiler: a profiling.Profiler recording the time, batch sizes and tokens of model evaluations
+                (phases 'evaluate_sent_prob' and 'evaluate_word_probs'; cache and store hits are not included).
+            checkpoint_folder: load the checkpoints from local copies in this folder instead of the pretrained checkpoints
+                and model_checkpoints (see sentence_prob_store.get_checkpoint_path), e.g., the randomly initialized
+                stand-ins built by tiny_models.py. If None, the environment variable CONTSTIMLANG_CHECKPOINT_FOLDER
+                is used (if set).
         """
 
         self.name = name
@@ -75,180 +137,252 @@ class model_factory:
         else:
             self.device = torch.device(f"cuda:{gpu_id}")
 
+        # the default memory budget is measured when the first batch size is chosen, after the weights are loaded
+        self.batch_size_policy = BatchSizePolicy(
+            self.device, memory_budget_in_gb=memory_budget_in_gb
+        )
+
+        self.sent_prob_cache = None
+        if sent_prob_cache_size is not None:
+            self.enable_sent_prob_cache(sent_prob_cache_size)
+
+        self.word_probs_cache = None
+        if isinstance(word_probs_cache, WordProbsCache):
+            self.word_probs_cache = word_probs_cache
+        elif word_probs_cache is not None:
+            self.enable_word_probs_cache(word_probs_cache)
+
+        self.profiler = profiler
+
+        if checkpoint_folder is None:
+            checkpoint_folder = os.environ.get("CONTSTIMLANG_CHECKPOINT_FOLDER")
+        self.checkpoint_folder = checkpoint_folder
+
+        if sent_prob_store is None:
+            sent_prob_store = os.environ.get("CONTSTIMLANG_SENT_PROB_STORE")
+        if isinstance(sent_prob_store, str):
+            sent_prob_store = SentenceProbabilityStore(sent_prob_store)
+        self.sent_prob_store = sent_prob_store
+        if self.sent_prob_store is not None:
+            self.model_key = get_model_key(name, checkpoint_folder)
+
         if name == "bert":
-            self.tokenizer = BertTokenizer.from_pretrained("bert-large-cased")
+            self.tokenizer = BertTokenizer.from_pretrained(
+                get_checkpoint_path("bert-large-cased", checkpoint_folder)
+            )
             if not only_tokenizer:
-                self.model = BertForMaskedLM.from_pretrained("bert-large-cased").to(
-                    self.device
-                )
+                self.model = BertForMaskedLM.from_pretrained(
+                    get_checkpoint_path("bert-large-cased", checkpoint_folder)
+                ).to(self.device)
             self.is_word_prob_exact = False
         elif name == "bert_new_implementation":
-            self.tokenizer = BertTokenizerFast.from_pretrained("bert-large-cased")
+            self.tokenizer = BertTokenizerFast.from_pretrained(
+                get_checkpoint_path("bert-large-cased", checkpoint_folder)
+            )
             if not only_tokenizer:
-                self.model = BertForMaskedLM.from_pretrained("bert-large-cased").to(
-                    self.device
-                )
+                self.model = BertForMaskedLM.from_pretrained(
+                    get_checkpoint_path("bert-large-cased", checkpoint_folder)
+                ).to(self.device)
             self.is_word_prob_exact = False
         elif name == "bert_has_a_mouth":
-            self.tokenizer = BertTokenizer.from_pretrained("bert-large-cased")
+            self.tokenizer = BertTokenizer.from_pretrained(
+                get_checkpoint_path("bert-large-cased", checkpoint_folder)
+            )
             if not only_tokenizer:
-                self.model = BertForMaskedLM.from_pretrained("bert-large-cased").to(
-                    self.device
-                )
+                self.model = BertForMaskedLM.from_pretrained(
+                    get_checkpoint_path("bert-large-cased", checkpoint_folder)
+                ).to(self.device)
             self.is_word_prob_exact = False
 
         elif name == "bert_whole_word":
-            self.tokenizer = BertTokenizer.from_pretrained("bert-large-cased")
+            self.tokenizer = BertTokenizer.from_pretrained(
+                get_checkpoint_path("bert-large-cased", checkpoint_folder)
+            )
             if not only_tokenizer:
                 self.model = BertForMaskedLM.from_pretrained(
-                    "bert-large-cased-whole-word-masking"
+                    get_checkpoint_path("bert-large-cased-whole-word-masking", checkpoint_folder)
                 ).to(self.device)
             self.is_word_prob_exact = False
 
         elif name == "bert_whole_word_has_a_mouth":
-            self.tokenizer = BertTokenizer.from_pretrained("bert-large-cased")
+            self.tokenizer = BertTokenizer.from_pretrained(
+                get_checkpoint_path("bert-large-cased", checkpoint_folder)
+            )
             if not only_tokenizer:
                 self.model = BertForMaskedLM.from_pretrained(
-                    "bert-large-cased-whole-word-masking"
+                    get_checkpoint_path("bert-large-cased-whole-word-masking", checkpoint_folder)
                 ).to(self.device)
             self.is_word_prob_exact = False
 
         elif name == "roberta":
-            self.tokenizer = RobertaTokenizer.from_pretrained("roberta-large")
+            self.tokenizer = RobertaTokenizer.from_pretrained(
+                get_checkpoint_path("roberta-large", checkpoint_folder)
+            )
             if not only_tokenizer:
-                self.model = RobertaForMaskedLM.from_pretrained("roberta-large").to(
-                    self.device
-                )
+                self.model = RobertaForMaskedLM.from_pretrained(
+                    get_checkpoint_path("roberta-large", checkpoint_folder)
+                ).to(self.device)
             self.is_word_prob_exact = False
 
         elif name == "roberta_new_implementation":
-            self.tokenizer = RobertaTokenizerFast.from_pretrained("roberta-large")
+            self.tokenizer = RobertaTokenizerFast.from_pretrained(
+                get_checkpoint_path("roberta-large", checkpoint_folder)
+            )
             if not only_tokenizer:
-                self.model = RobertaForMaskedLM.from_pretrained("roberta-large").to(
-                    self.device
-                )
+                self.model = RobertaForMaskedLM.from_pretrained(
+                    get_checkpoint_path("roberta-large", checkpoint_folder)
+                ).to(self.device)
             self.is_word_prob_exact = False
         elif name == "roberta_has_a_mouth":
-            self.tokenizer = RobertaTokenizer.from_pretrained("roberta-large")
+            self.tokenizer = RobertaTokenizer.from_pretrained(
+                get_checkpoint_path("roberta-large", checkpoint_folder)
+            )
             if not only_tokenizer:
-                self.model = RobertaForMaskedLM.from_pretrained("roberta-large").to(
-                    self.device
-                )
+                self.model = RobertaForMaskedLM.from_pretrained(
+                    get_checkpoint_path("roberta-large", checkpoint_folder)
+                ).to(self.device)
             self.is_word_prob_exact = False
 
         elif name == "xlm":
-            self.tokenizer = XLMTokenizer.from_pretrained("xlm-mlm-en-2048")
+            self.tokenizer = XLMTokenizer.from_pretrained(
+                get_checkpoint_path("xlm-mlm-en-2048", checkpoint_folder)
+            )
             if not only_tokenizer:
-                self.model = XLMWithLMHeadModel.from_pretrained("xlm-mlm-en-2048").to(
-                    self.device
-                )
+                self.model = XLMWithLMHeadModel.from_pretrained(
+                    get_checkpoint_path("xlm-mlm-en-2048", checkpoint_folder)
+                ).to(self.device)
             self.is_word_prob_exact = False
 
         elif name == "electra":
             self.tokenizer = ElectraTokenizer.from_pretrained(
-                "google/electra-large-generator"
+                get_checkpoint_path("google/electra-large-generator", checkpoint_folder)
             )
             if not only_tokenizer:
                 self.model = ElectraForMaskedLM.from_pretrained(
-                    "google/electra-large-generator"
+                    get_checkpoint_path("google/electra-large-generator", checkpoint_folder)
                 ).to(self.device)
             self.is_word_prob_exact = False
 
         elif name == "electra_new_implementation":
             self.tokenizer = ElectraTokenizerFast.from_pretrained(
-                "google/electra-large-generator"
+                get_checkpoint_path("google/electra-large-generator", checkpoint_folder)
             )
             if not only_tokenizer:
                 self.model = ElectraForMaskedLM.from_pretrained(
-                    "google/electra-large-generator"
+                    get_checkpoint_path("google/electra-large-generator", checkpoint_folder)
                 ).to(self.device)
             self.is_word_prob_exact = False
         elif name == "electra_has_a_mouth":
             self.tokenizer = ElectraTokenizer.from_pretrained(
-                "google/electra-large-generator"
+                get_checkpoint_path("google/electra-large-generator", checkpoint_folder)
             )
             if not only_tokenizer:
                 self.model = ElectraForMaskedLM.from_pretrained(
-                    "google/electra-large-generator"
+                    get_checkpoint_path("google/electra-large-generator", checkpoint_folder)
                 ).to(self.device)
             self.is_word_prob_exact = False
 
         elif name == "gpt2":
-            self.tokenizer = GPT2Tokenizer.from_pretrained("gpt2-xl")
+            self.tokenizer = GPT2Tokenizer.from_pretrained(
+                get_checkpoint_path("gpt2-xl", checkpoint_folder)
+            )
             if not only_tokenizer:
-                self.model = GPT2LMHeadModel.from_pretrained("gpt2-xl").to(self.device)
+                self.model = GPT2LMHeadModel.from_pretrained(
+                    get_checkpoint_path("gpt2-xl", checkpoint_folder)
+                ).to(self.device)
             self.is_word_prob_exact = False
 
         elif name == "naive_gpt2":
-            self.tokenizer = GPT2Tokenizer.from_pretrained("gpt2-xl")
+            self.tokenizer = GPT2Tokenizer.from_pretrained(
+                get_checkpoint_path("gpt2-xl", checkpoint_folder)
+            )
             if not only_tokenizer:
-                self.model = GPT2LMHeadModel.from_pretrained("gpt2-xl").to(self.device)
+                self.model = GPT2LMHeadModel.from_pretrained(
+                    get_checkpoint_path("gpt2-xl", checkpoint_folder)
+                ).to(self.device)
             self.is_word_prob_exact = False
         elif name == "plain_gpt2":
-            self.tokenizer = GPT2Tokenizer.from_pretrained("gpt2-xl")
+            self.tokenizer = GPT2Tokenizer.from_pretrained(
+                get_checkpoint_path("gpt2-xl", checkpoint_folder)
+            )
             if not only_tokenizer:
-                self.model = GPT2LMHeadModel.from_pretrained("gpt2-xl").to(self.device)
+                self.model = GPT2LMHeadModel.from_pretrained(
+                    get_checkpoint_path("gpt2-xl", checkpoint_folder)
+                ).to(self.device)
             self.is_word_prob_exact = False
         elif name == "bilstm":
-            self.model = RNNLM_bilstm(
-                vocab_size=94608, embed_size=256, hidden_size=256, num_layers=1
-            )
-            self.model.load_state_dict(
-                torch.load(os.path.join("model_checkpoints", "bilstm_state_dict.pt"))
+            state_dict = torch.load(
+                get_checkpoint_path(
+                    os.path.join("model_checkpoints", "bilstm_state_dict.pt"),
+                    checkpoint_folder,
+                )
             )
+            rnn_sizes = get_rnn_sizes(state_dict, "lstm")
+            self.model = RNNLM_bilstm(**rnn_sizes)
+            self.model.load_state_dict(state_dict)
             self.model = self.model.to(self.device)
-            word2id, nn_vocab_size, id2word = get_word2id_dict()
+            word2id, nn_vocab_size, id2word = get_word2id_dict(checkpoint_folder)
             self.word2id = word2id
             self.id2word = id2word
-            self.embed_size = 256
-            self.hidden_size = 256
+            self.embed_size = rnn_sizes["embed_size"]
+            self.hidden_size = rnn_sizes["hidden_size"]
             self.vocab_size = nn_vocab_size
-            self.num_layers = 1
+            self.num_layers = rnn_sizes["num_layers"]
             self.is_word_prob_exact = False
 
         elif name == "lstm":
-            self.model = RNNLM(
-                vocab_size=94607, embed_size=256, hidden_size=512, num_layers=1
-            )
-            self.model.load_state_dict(
-                torch.load(os.path.join("model_checkpoints", "lstm_state_dict.pt"))
+            state_dict = torch.load(
+                get_checkpoint_path(
+                    os.path.join("model_checkpoints", "lstm_state_dict.pt"),
+                    checkpoint_folder,
+                )
             )
+            rnn_sizes = get_rnn_sizes(state_dict, "lstm")
+            self.model = RNNLM(**rnn_sizes)
+            self.model.load_state_dict(state_dict)
             self.model = self.model.to(self.device)
-            word2id, nn_vocab_size, id2word = get_word2id_dict()
+            word2id, nn_vocab_size, id2word = get_word2id_dict(checkpoint_folder)
             self.word2id = word2id
             self.id2word = id2word
-            self.embed_size = 256
-            self.hidden_size = 512
+            self.embed_size = rnn_sizes["embed_size"]
+            self.hidden_size = rnn_sizes["hidden_size"]
             self.vocab_size = nn_vocab_size
-            self.num_layers = 1
+            self.num_layers = rnn_sizes["num_layers"]
             self.is_word_prob_exact = False
 
         elif name == "rnn":
-            self.model = RNNModel(
-                vocab_size=94607, embed_size=256, hidden_size=512, num_layers=1
-            )
-            self.model.load_state_dict(
-                torch.load(os.path.join("model_checkpoints", "rnn_state_dict.pt"))
+            state_dict = torch.load(
+                get_checkpoint_path(
+                    os.path.join("model_checkpoints", "rnn_state_dict.pt"),
+                    checkpoint_folder,
+                )
             )
+            rnn_sizes = get_rnn_sizes(state_dict, "rnn")
+            self.model = RNNModel(**rnn_sizes)
+            self.model.load_state_dict(state_dict)
             self.model = self.model.to(self.device)
-            word2id, nn_vocab_size, id2word = get_word2id_dict()
+            word2id, nn_vocab_size, id2word = get_word2id_dict(checkpoint_folder)
             self.word2id = word2id
             self.id2word = id2word
-            self.embed_size = 256
-            self.hidden_size = 512
+            self.embed_size = rnn_sizes["embed_size"]
+            self.hidden_size = rnn_sizes["hidden_size"]
             self.vocab_size = nn_vocab_size
-            self.num_layers = 1
+            self.num_layers = rnn_sizes["num_layers"]
             self.is_word_prob_exact = True
 
         elif name == "trigram":
             self.model = KneserNey.load(
-                os.path.join("model_checkpoints", "trigram.model")
+                get_checkpoint_path(
+                    os.path.join("model_checkpoints", "trigram.model"), checkpoint_folder
+                )
             )
             self.is_word_prob_exact = True
 
         elif name == "bigram":
             self.model = KneserNey.load(
-                os.path.join("model_checkpoints", "bigram.model")
+                get_checkpoint_path(
+                    os.path.join("model_checkpoints", "bigram.model"), checkpoint_folder
+                )
             )
             self.is_word_prob_exact = True
         else:
@@ -269,48 +403,165 @@ class model_factory:
                 len_toks = len(sent)
             return len_toks
 
+    def count_profiled_tokens(self, sents):
+        """return the total number of tokens in a list of sentences (words for models without a tokenizer)"""
+        if hasattr(self, "tokenizer"):
+            return sum(len(self.tokenizer.tokenize(sent)) for sent in sents)
+        return sum(len(sent.split(" ")) for sent in sents)
+
+    def enable_sent_prob_cache(self, maxsize=100000):
+        """memoize sent_prob results in a bounded LRU cache keyed by the normalized sentence"""
+        self.sent_prob_cache = LRUCache(maxsize=maxsize)
+
+    def sent_prob_cache_info(self):
+        """return hit/miss statistics of the sent_prob cache (None if caching is disabled)"""
+        if self.sent_prob_cache is None:
+            return None
+        return self.sent_prob_cache.info()
+
+    def enable_word_probs_cache(self, maxsize=10000, max_size_in_mb=1024):
+        """memoize word_probs outputs in a bounded LRU cache keyed by the masked context (see caching.WordProbsCache)"""
+        self.word_probs_cache = WordProbsCache(
+            maxsize=maxsize, max_size_in_mb=max_size_in_mb
+        )
+
+    def word_probs_cache_info(self):
+        """return hit/miss/eviction statistics of the word_probs cache (None if caching is disabled)"""
+        if self.word_probs_cache is None:
+            return None
+        return self.word_probs_cache.info()
+
     def sent_prob(self, sent):
+        """return the log-probability of sent.
 
-        if self.name in [
-            "bert_has_a_mouth",
-            "roberta_has_a_mouth",
-            "electra_has_a_mouth",
-        ]:
-            prob = has_a_mouth_sent_prob(self, sent)
+        If the sent_prob cache or the sentence probability store are enabled, the sentence is normalized
+        (whitespace is stripped and collapsed) and previously evaluated sentences are looked up instead of re-evaluated.
+        """
+        if self.sent_prob_cache is None and self.sent_prob_store is None:
+            return self._evaluate_sent_prob(sent)
+
+        sent = normalize_sentence(sent)
+        prob = None
+        if self.sent_prob_cache is not None:
+            prob = self.sent_prob_cache.get(sent)
+        if prob is None and self.sent_prob_store is not None:
+            prob = self.sent_prob_store.get(self.model_key, sent)
+            if prob is None:
+                prob = self._evaluate_sent_prob(sent)
+                self.sent_prob_store.put(self.model_key, sent, prob)
+        if prob is None:
+            prob = self._evaluate_sent_prob(sent)
+        if self.sent_prob_cache is not None:
+            self.sent_prob_cache.put(sent, prob)
+        return prob
 
-        elif self.name in ["bert", "bert_whole_word", "roberta", "xlm", "electra"]:
-            prob = bidirectional_transformer_sent_prob(self, sent)
+    def sent_probs(self, sents):
+        """return the log-probabilities of a list of sentences as a numpy array.
 
-        elif self.name in [
-            "bert_new_implementation",
-            "roberta_new_implementation",
-            "electra_new_implementation",
-        ]:
-            prob = bidirectional_transformer_sent_prob_new_implementation(self, sent)
-        elif self.name == "gpt2":
-            prob = gpt2_sent_prob(self, sent)
-        elif self.name == "naive_gpt2":
-            prob = naive_gpt2_sent_prob(self, sent)
-        elif self.name == "plain_gpt2":
-            prob = gpt2_sent_scoring_plain(self, sent)
-        elif self.name == "bilstm":
-            prob = bilstm_sent_prob(self, sent)
-        elif self.name == "lstm":
-            prob = lstm_sent_prob(self, sent)
-        elif self.name == "rnn":
-            prob = rnn_sent_prob(self, sent)
-        elif self.name == "trigram":
-            prob = trigram_sent_prob(self, sent)
-        elif self.name == "bigram":
-            prob = bigram_sent_prob(self, sent)
-        else:
-            raise ValueError
+        Cached and stored sentences are looked up in bulk. The remaining sentences are evaluated
+        in batches if the model's sent_prob implementation supports it, and one at a time otherwise.
+        """
+        use_lookup = self.sent_prob_cache is not None or self.sent_prob_store is not None
+        if use_lookup:
+            sents = [normalize_sentence(sent) for sent in sents]
+        log_probs = np.full(len(sents), np.nan)
+
+        if self.sent_prob_cache is not None:
+            for i_sent, sent in enumerate(sents):
+                prob = self.sent_prob_cache.get(sent)
+                if prob is not None:
+                    log_probs[i_sent] = prob
+        if self.sent_prob_store is not None:
+            missing = np.flatnonzero(np.isnan(log_probs))
+            log_probs[missing] = self.sent_prob_store.get_many(
+                self.model_key, [sents[i] for i in missing]
+            )
+
+        missing = np.flatnonzero(np.isnan(log_probs))
+        missing_sents = [sents[i] for i in missing]
+        if len(missing_sents) > 0:
+            if get_sent_prob_function(self.name) is gpt2_sent_scoring_plain:
+                with profiled(
+                    self.profiler,
+                    "evaluate_sent_prob",
+                    model_name=self.name,
+                    batch_size=len(missing_sents),
+                    n_tokens=self.count_profiled_tokens(missing_sents)
+                    if self.profiler is not None
+                    else None,
+                ):
+                    log_probs[missing] = gpt2_sent_scoring_plain(self, missing_sents)
+            else:
+                log_probs[missing] = [
+                    self._evaluate_sent_prob(sent) for sent in missing_sents
+                ]
+            if self.sent_prob_store is not None:
+                self.sent_prob_store.put_many(
+                    self.model_key, missing_sents, log_probs[missing]
+                )
+
+        if self.sent_prob_cache is not None:
+            for sent, prob in zip(sents, log_probs):
+                self.sent_prob_cache.put(sent, float(prob))
+        return log_probs
+
+    def _evaluate_sent_prob(self, sent):
+
+        with profiled(
+            self.profiler,
+            "evaluate_sent_prob",
+            model_name=self.name,
+            batch_size=1,
+            n_tokens=self.count_profiled_tokens([sent])
+            if self.profiler is not None
+            else None,
+        ):
+            prob = get_sent_prob_function(self.name)(self, sent)
         if type(prob) is np.ndarray:
             prob = prob.item()  # return a scalar!
 
-        return prob
+        return float(prob)
 
     def word_probs(self, words, wordi):
+        """return the log-probabilities of the sentences resulting from replacing words[wordi] with each vocabulary word.
+
+        If the word_probs cache is enabled, outputs are memoized by the context of words[wordi].
+        The cached log-probabilities of models whose word_probs are approximate (is_word_prob_exact is False) are
+        stored and returned as float32, so they lose precision. Exact models' outputs are kept as float64.
+        """
+        if self.word_probs_cache is None:
+            return self._evaluate_word_probs(words, wordi)
+
+        output = self.word_probs_cache.get_word_probs(self.name, words, wordi)
+        if output is None:
+            output = self._evaluate_word_probs(list(words), wordi)
+            output = self.word_probs_cache.put_word_probs(
+                self.name, words, wordi, output, exact=self.is_word_prob_exact
+            )
+        return output
+
+    def _evaluate_word_probs(self, words, wordi):
+        if self.profiler is None:
+            return self._dispatch_word_probs(words, wordi)
+
+        # batch_size is the number of scored replacement sentences, n_tokens is the number of tokens in the input sentence
+        n_tokens = self.count_profiled_tokens([" ".join(words)])
+        start_time = time.perf_counter()
+        probs = self._dispatch_word_probs(words, wordi)
+        if len(probs) == 2 and isinstance(probs, tuple):
+            batch_size = len(probs[0])
+        else:
+            batch_size = len(probs)
+        self.profiler.record(
+            "evaluate_word_probs",
+            time.perf_counter() - start_time,
+            model_name=self.name,
+            batch_size=batch_size,
+            n_tokens=n_tokens,
+        )
+        return probs
+
+    def _dispatch_word_probs(self, words, wordi):
 
         if self.name in [
             "bert",
@@ -357,6 +608,42 @@ class model_factory:
         return probs
 
 
+def get_sent_prob_function(name):
+    """return the function implementing sent_prob for the model name"""
+    if name in [
+        "bert_has_a_mouth",
+        "roberta_has_a_mouth",
+        "electra_has_a_mouth",
+    ]:
+        return has_a_mouth_sent_prob
+    elif name in ["bert", "bert_whole_word", "roberta", "xlm", "electra"]:
+        return bidirectional_transformer_sent_prob
+    elif name in [
+        "bert_new_implementation",
+        "roberta_new_implementation",
+        "electra_new_implementation",
+    ]:
+        return bidirectional_transformer_sent_prob_new_implementation
+    elif name == "gpt2":
+        return gpt2_sent_prob
+    elif name == "naive_gpt2":
+        return naive_gpt2_sent_prob
+    elif name == "plain_gpt2":
+        return gpt2_sent_scoring_plain
+    elif name == "bilstm":
+        return bilstm_sent_prob
+    elif name == "lstm":
+        return lstm_sent_prob
+    elif name == "rnn":
+        return rnn_sent_prob
+    elif name == "trigram":
+        return trigram_sent_prob
+    elif name == "bigram":
+        return bigram_sent_prob
+    else:
+        raise ValueError(f"Model {name} not found")
+
+
 def get_starts_suffs(self):
 
     name = self.name
@@ -367,6 +654,7 @@ def get_starts_suffs(self):
         "rnn",
         "bigram",
         "trigram",
+        "naive_gpt2",
         "plain_gpt2",
     ]:
         return self
@@ -527,8 +815,6 @@ def get_token_info(self):
 
         ######################################################################
 
-        batchsize = 100
-
         unique_tokparts_low = [list(x) for x in set(tuple(x) for x in tps_low)]
 
         tokparts_inds_low = []
@@ -537,9 +823,7 @@ def get_token_info(self):
 
         vocab_to_tokparts_inds_low = []
 
-        vocab_to_tokparts_inds_map_low = [
-            [] for i in range(int(np.ceil(len(unique_tokparts_low) / batchsize)))
-        ]
+        vocab_to_tokparts_inds_map_low = []
 
         for vocind, tokparts_all in enumerate(tokparts_all_low):
 
@@ -570,12 +854,8 @@ def get_token_info(self):
 
                     vocab_to_inds_low.append([ind, ti_all, ti])
 
-                    batchnum = int(np.floor(ind / batchsize))
-
-                    unique_ind_batch = ind % batchsize
-
-                    vocab_to_tokparts_inds_map_low[batchnum].append(
-                        [[vocind, ti_all, ti], [unique_ind_batch, tokind, toks[tokind]]]
+                    vocab_to_tokparts_inds_map_low.append(
+                        [vocind, ti_all, ti, ind, tokind, toks[tokind]]
                     )
 
                 inds_low_all.append(inds_low)
@@ -596,9 +876,7 @@ def get_token_info(self):
 
         vocab_to_tokparts_inds_cap = []
 
-        vocab_to_tokparts_inds_map_cap = [
-            [] for i in range(int(np.ceil(len(unique_tokparts_cap) / batchsize)))
-        ]
+        vocab_to_tokparts_inds_map_cap = []
 
         for vocind, tokparts_all in enumerate(tokparts_all_cap):
 
@@ -630,12 +908,8 @@ def get_token_info(self):
 
                     vocab_to_inds_cap.append([ind, ti_all, ti])
 
-                    batchnum = int(np.floor(ind / batchsize))
-
-                    unique_ind_batch = ind % batchsize
-
-                    vocab_to_tokparts_inds_map_cap[batchnum].append(
-                        [[vocind, ti_all, ti], [unique_ind_batch, tokind, toks[tokind]]]
+                    vocab_to_tokparts_inds_map_cap.append(
+                        [vocind, ti_all, ti, ind, tokind, toks[tokind]]
                     )
 
                 inds_cap_all.append(inds_cap)
@@ -646,19 +920,61 @@ def get_token_info(self):
 
             vocab_to_tokparts_inds_cap.append(vocab_to_inds_cap)
 
-            self.vocab_low = vocab_low
-            self.unique_tokparts_low = unique_tokparts_low
-            self.vocab_probs_sheet_low = vocab_probs_sheet_low
-            self.vocab_to_tokparts_inds_map_low = vocab_to_tokparts_inds_map_low
+        self.vocab_low = vocab_low
+        self.unique_tokparts_low = unique_tokparts_low
+        self.vocab_probs_sheet_low = vocab_probs_sheet_low
+        self.vocab_to_tokparts_inds_map_low = sort_tokparts_inds_map(
+            vocab_to_tokparts_inds_map_low
+        )
 
-            self.vocab_cap = vocab_cap
-            self.unique_tokparts_cap = unique_tokparts_cap
-            self.vocab_probs_sheet_cap = vocab_probs_sheet_cap
-            self.vocab_to_tokparts_inds_map_cap = vocab_to_tokparts_inds_map_cap
+        self.vocab_cap = vocab_cap
+        self.unique_tokparts_cap = unique_tokparts_cap
+        self.vocab_probs_sheet_cap = vocab_probs_sheet_cap
+        self.vocab_to_tokparts_inds_map_cap = sort_tokparts_inds_map(
+            vocab_to_tokparts_inds_map_cap
+        )
 
         return self
 
 
+def sort_tokparts_inds_map(vocab_to_tokparts_inds_map):
+    """convert a list of [vocind, ti_all, ti, unique_tokpart_ind, tokind, token_id] rows into
+    an integer array sorted by unique_tokpart_ind, so the rows of any batch of unique token parts
+    can be found with np.searchsorted."""
+    vocab_to_tokparts_inds_map = np.asarray(vocab_to_tokparts_inds_map, dtype=np.int64)
+    order = np.argsort(vocab_to_tokparts_inds_map[:, 3], kind="stable")
+    return vocab_to_tokparts_inds_map[order]
+
+
+def fill_vocab_probs_sheet(
+    vocab_probs_sheet, vocab_to_tokparts_inds_map, soft, batch_start, batch_end
+):
+    """copy the log-probabilities of a batch of unique token parts [batch_start, batch_end) into vocab_probs_sheet
+
+    args:
+        vocab_probs_sheet: nested list, vocab_probs_sheet[vocind][ti_all][ti] is the log-probability of a word token
+        vocab_to_tokparts_inds_map: integer array returned by sort_tokparts_inds_map
+        soft: (batch, token position, vocab) log-probabilities tensor of the batch
+    """
+    lo, hi = np.searchsorted(
+        vocab_to_tokparts_inds_map[:, 3], [batch_start, batch_end], side="left"
+    )
+    batch_map = vocab_to_tokparts_inds_map[lo:hi]
+    if len(batch_map) == 0:
+        return
+    log_probs = (
+        soft[
+            torch.as_tensor(batch_map[:, 3] - batch_start, device=soft.device),
+            torch.as_tensor(batch_map[:, 4], device=soft.device),
+            torch.as_tensor(batch_map[:, 5], device=soft.device),
+        ]
+        .cpu()
+        .numpy()
+    )
+    for (vocind, ti_all, ti), log_prob in zip(batch_map[:, :3], log_probs):
+        vocab_probs_sheet[vocind][ti_all][ti] = float(log_prob)
+
+
 def has_a_mouth_sent_prob(self, sent):
 
     tokenizer = self.tokenizer
@@ -1003,55 +1319,28 @@ def bidirectional_transformer_sent_prob(self, sent):
 
     inputs = torch.tensor(tokens_all).to(self.device)
 
-    batchsize = 100
-
-    with torch.no_grad():
-
-        if len(inputs) < batchsize:
-
-            out = model(input_ids=inputs)[0]
+    soft_batches = []
 
-            out = out[:, 1:-2, :]
+    def evaluate_batch(batch_start, batch_end):
+        out1 = model(input_ids=inputs[batch_start:batch_end])[0]
 
-            for x in range(out.shape[1]):
-                if x in start_inds[1:]:
-                    out[:, x - 1, suffs] = math.inf * -1
-                elif x in suff_inds[1:]:
-                    out[:, x - 1, starts] = math.inf * -1
+        out1 = out1[:, 1:-2, :]
 
-            soft = logsoftmax(out)
-
-            soft = soft[:, :, word_tokens]
-
-        else:
+        for x in range(out1.shape[1]):
+            if x in start_inds[1:]:
+                out1[:, x - 1, suffs] = math.inf * -1
+            elif x in suff_inds[1:]:
+                out1[:, x - 1, starts] = math.inf * -1
 
-            for b in range(int(np.ceil(len(inputs) / batchsize))):
-                in1 = inputs[batchsize * b : batchsize * (b + 1)]
-                lab1 = labels_all[batchsize * b : batchsize * (b + 1)]
-                out1 = model(input_ids=in1)[0]
+        soft1 = logsoftmax(out1)
 
-                out1 = out1[:, 1:-2, :]
+        soft_batches.append(soft1[:, :, word_tokens])
 
-                for x in range(out1.shape[1]):
-                    if x in start_inds[1:]:
-                        out1[:, x - 1, suffs] = math.inf * -1
-                    elif x in suff_inds[1:]:
-                        out1[:, x - 1, starts] = math.inf * -1
-
-                soft1 = logsoftmax(out1)
-
-                soft1 = soft1[:, :, word_tokens]
-
-                if b == 0:
-                    soft = soft1
+    with torch.no_grad():
 
-                else:
-                    soft = torch.cat((soft, soft1))
+        self.batch_size_policy.run(self, evaluate_batch, len(inputs), inputs.shape[1])
 
-                try:
-                    torch.cuda.empty_cache()
-                except:
-                    pass
+        soft = torch.cat(soft_batches)
 
         orders = list(itertools.permutations(word_inds, i))
 
@@ -1158,15 +1447,11 @@ def bidirectional_transformer_word_probs(self, words, wordi):
     inputs = torch.tensor(inputs).to(self.device)
     att_mask = torch.tensor(att_mask, dtype=torch.float32).to(self.device)
 
-    batchsize = 100
+    def evaluate_batch(batch_start, batch_end):
 
-    for i in range(int(np.ceil(len(inputs) / batchsize))):
+        inputs1 = inputs[batch_start:batch_end]
 
-        vocab_to_tokparts_inds_map_batch = vocab_to_tokparts_inds_map[i]
-
-        inputs1 = inputs[batchsize * i : batchsize * (i + 1)]
-
-        att_mask1 = att_mask[batchsize * i : batchsize * (i + 1)]
+        att_mask1 = att_mask[batch_start:batch_end]
 
         with torch.no_grad():
 
@@ -1179,14 +1464,14 @@ def bidirectional_transformer_word_probs(self, words, wordi):
 
             soft = logsoftmax(out1)
 
-            for vti in vocab_to_tokparts_inds_map_batch:
-
-                vocab_probs_sheet[vti[0][0]][vti[0][1]][vti[0][2]] = float(
-                    soft[vti[1][0], vti[1][1], vti[1][2]]
-                )
+            fill_vocab_probs_sheet(
+                vocab_probs_sheet, vocab_to_tokparts_inds_map, soft, batch_start, batch_end
+            )
 
             del soft
 
+    self.batch_size_policy.run(self, evaluate_batch, len(inputs), maxlen)
+
     vocab_probs = []
     for x in range(len(vocab_probs_sheet)):
 
@@ -1252,17 +1537,13 @@ def xlm_word_probs(self, words, wordi):
     inputs = torch.tensor(inputs).to(self.device)
     att_mask = torch.tensor(att_mask, dtype=torch.float32).to(self.device)
 
-    batchsize = 100
+    def evaluate_batch(batch_start, batch_end):
 
-    for i in range(int(np.ceil(len(inputs) / batchsize))):
+        inputs1 = inputs[batch_start:batch_end]
 
-        vocab_to_tokparts_inds_map_batch = vocab_to_tokparts_inds_map[i]
+        att0s = att0s_all[batch_start:batch_end]
 
-        inputs1 = inputs[batchsize * i : batchsize * (i + 1)]
-
-        att0s = att0s_all[batchsize * i : batchsize * (i + 1)]
-
-        att_mask1 = att_mask[batchsize * i : batchsize * (i + 1)]
+        att_mask1 = att_mask[batch_start:batch_end]
 
         with torch.no_grad():
 
@@ -1271,7 +1552,7 @@ def xlm_word_probs(self, words, wordi):
             out1[:, -1 * (len(tokens) - mask_ind), starts] = math.inf * -1
             out1[:, : -1 * (len(tokens) - mask_ind) - 1, suffs] = math.inf * -1
 
-            out2 = torch.zeros([batchsize, 6, out1.shape[2]])
+            out2 = torch.zeros([len(inputs1), 6, out1.shape[2]])
 
             for x in range(len(inputs1)):
 
@@ -1285,14 +1566,14 @@ def xlm_word_probs(self, words, wordi):
 
             soft = logsoftmax(out2)
 
-            for vti in vocab_to_tokparts_inds_map_batch:
-
-                vocab_probs_sheet[vti[0][0]][vti[0][1]][vti[0][2]] = float(
-                    soft[vti[1][0], vti[1][1], vti[1][2]]
-                )
+            fill_vocab_probs_sheet(
+                vocab_probs_sheet, vocab_to_tokparts_inds_map, soft, batch_start, batch_end
+            )
 
             del soft
 
+    self.batch_size_policy.run(self, evaluate_batch, len(inputs), maxlen)
+
     vocab_probs = []
     for x in range(len(vocab_probs_sheet)):
 
@@ -1421,13 +1702,13 @@ def gpt2_word_probs(self, words, wordi):
 
     inputs = [i + [tokenizer.pad_token_id] * (maxlen - len(i)) for i in inputs]
 
-    batchsize = 64
+    vocab_probs = []
 
-    for i in range(int(np.ceil(len(inputs) / batchsize))):
+    def evaluate_batch(batch_start, batch_end):
 
-        inputs1 = np.array(inputs[batchsize * i : batchsize * (i + 1)])
+        inputs1 = np.array(inputs[batch_start:batch_end])
 
-        att_mask1 = att_mask[batchsize * i : batchsize * (i + 1)]
+        att_mask1 = att_mask[batch_start:batch_end]
 
         inputs2 = torch.tensor(inputs1).to(self.device)
         att_mask1 = torch.tensor(att_mask1, dtype=torch.float32).to(self.device)
@@ -1462,6 +1743,7 @@ def gpt2_word_probs(self, words, wordi):
 
             soft = logsoftmax(out1)
 
+            batch_vocab_probs = []
             for v in range(len(inputs1)):
 
                 numwords = len(np.where(inputs1[v] < tokenizer.pad_token_id)[0]) - 1
@@ -1472,12 +1754,13 @@ def gpt2_word_probs(self, words, wordi):
 
                 prob = torch.sum(probs)
 
-                if i == 0 and v == 0:
-                    vocab_probs = prob.unsqueeze(0)
-                else:
-                    vocab_probs = torch.cat((vocab_probs, prob.unsqueeze(0)), 0)
+                batch_vocab_probs.append(prob)
 
-    vocab_probs = vocab_probs.cpu().data.numpy()
+            vocab_probs.extend(batch_vocab_probs)
+
+    self.batch_size_policy.run(self, evaluate_batch, len(inputs), maxlen)
+
+    vocab_probs = torch.stack(vocab_probs).cpu().data.numpy()
 
     return vocab_probs, vocab_tops_ind
 
@@ -1591,13 +1874,13 @@ def naive_gpt2_word_probs(self, words, wordi):
 
     inputs = [i + [tokenizer.pad_token_id] * (maxlen - len(i)) for i in inputs]
 
-    batchsize = 64
+    vocab_probs = []
 
-    for i in range(int(np.ceil(len(inputs) / batchsize))):
+    def evaluate_batch(batch_start, batch_end):
 
-        inputs1 = np.array(inputs[batchsize * i : batchsize * (i + 1)])
+        inputs1 = np.array(inputs[batch_start:batch_end])
 
-        att_mask1 = att_mask[batchsize * i : batchsize * (i + 1)]
+        att_mask1 = att_mask[batch_start:batch_end]
 
         inputs2 = torch.tensor(inputs1).to(self.device)
         att_mask1 = torch.tensor(att_mask1, dtype=torch.float32).to(self.device)
@@ -1607,6 +1890,7 @@ def naive_gpt2_word_probs(self, words, wordi):
             out1 = model(input_ids=inputs2, attention_mask=att_mask1)[0]
             soft = logsoftmax(out1)
 
+            batch_vocab_probs = []
             for v in range(len(inputs1)):
 
                 numwords = len(np.where(inputs1[v] < tokenizer.pad_token_id)[0]) - 1
@@ -1619,17 +1903,24 @@ def naive_gpt2_word_probs(self, words, wordi):
 
                 prob = torch.sum(probs)  # .cpu().data.numpy())
 
-                if i == 0 and v == 0:
-                    vocab_probs = prob.unsqueeze(0)
-                else:
-                    vocab_probs = torch.cat((vocab_probs, prob.unsqueeze(0)), 0)
+                batch_vocab_probs.append(prob)
+
+            vocab_probs.extend(batch_vocab_probs)
+
+    self.batch_size_policy.run(self, evaluate_batch, len(inputs), maxlen)
 
-    vocab_probs = vocab_probs.cpu().data.numpy()
+    vocab_probs = torch.stack(vocab_probs).cpu().data.numpy()
 
     return vocab_probs, vocab_tops_ind
 
 
-def gpt2_sent_scoring_plain(self, lines, batch_size=32):
+def gpt2_sent_scoring_plain(self, lines, batch_size=None):
+    """score a sentence (or a list of sentences) with GPT-2, without restricting the vocabulary.
+
+    args:
+        lines: a sentence (str) or a list of sentences
+        batch_size: number of sentences per forward pass. If None, it is chosen by self.batch_size_policy.
+    """
 
     if type(lines) == str:
         return gpt2_sent_scoring_plain(self, [lines], batch_size=batch_size)[0]
@@ -1639,46 +1930,40 @@ def gpt2_sent_scoring_plain(self, lines, batch_size=32):
     tokenizer = self.tokenizer
     model = self.model
 
-    if len(lines) > batch_size:
-
-        def chunks(l, n):
-            for i in range(0, len(l), n):
-                yield l[i : i + n]
-
-        chunks = list(chunks(lines, batch_size))
-        scores, n_tokens = [], []
-        for chunk in chunks:
-            scores_, n_tokens_ = gpt2_sent_scoring_plain(
-                tokenizer, model, chunk, batch_size
-            )
-            scores.extend(scores_)
-            n_tokens.extend(n_tokens_)
-        return scores
-
     # lines = [tokenizer.eos_token + line for line in lines]
     tok_res = tokenizer.batch_encode_plus(lines, return_tensors="pt", padding=True)
     input_ids = tok_res["input_ids"]
     attention_mask = tok_res["attention_mask"]
-    with torch.no_grad():
-        lines_len = torch.sum(tok_res["attention_mask"], dim=1)
+    lines_len = torch.sum(attention_mask, dim=1)
+
+    scores = []
 
-        outputs = model(
-            input_ids=input_ids.to(model.device),
-            attention_mask=attention_mask.to(model.device),
-            labels=input_ids.to(model.device),
+    def evaluate_batch(batch_start, batch_end):
+        with torch.no_grad():
+            outputs = model(
+                input_ids=input_ids[batch_start:batch_end].to(model.device),
+                attention_mask=attention_mask[batch_start:batch_end].to(model.device),
+            )
+            logits = outputs[0]
+            batch_scores = []
+            for line_ind in range(batch_end - batch_start):
+                line_log_prob = 0.0
+                for token_ind in range(lines_len[batch_start + line_ind] - 1):
+                    token_prob = torch.nn.functional.softmax(
+                        logits[line_ind, token_ind], dim=0
+                    )
+                    token_id = input_ids[batch_start + line_ind, token_ind + 1]
+                    line_log_prob += torch.log(token_prob[token_id])
+                batch_scores.append(line_log_prob.item())
+            scores.extend(batch_scores)
+
+    if batch_size is None:
+        self.batch_size_policy.run(
+            self, evaluate_batch, len(lines), input_ids.shape[1]
         )
-        loss, logits = outputs[:2]
-        scores, n_tokens = [], []
-        for line_ind in range(len(lines)):
-            line_log_prob = 0.0
-            for token_ind in range(lines_len[line_ind] - 1):
-                token_prob = torch.nn.functional.softmax(
-                    logits[line_ind, token_ind], dim=0
-                )
-                token_id = input_ids[line_ind, token_ind + 1]
-                line_log_prob += torch.log(token_prob[token_id])
-            scores.append(line_log_prob.item())
-            n_tokens.append(lines_len[line_ind].item() - 1)
+    else:
+        for batch_start in range(0, len(lines), batch_size):
+            evaluate_batch(batch_start, min(batch_start + batch_size, len(lines)))
     return scores
 
 
@@ -0,0 +1,127 @@
+import os
+import gzip
+import pickle
+import pathlib
+
+import numpy as np
+
+from caching import normalize_sentence, get_masked_context, compact_word_probs
+
+
+class ModelCallNotRecordedError(KeyError):
+    """raised by ReplayModel for a call that was not recorded (and there is no fallback model)"""
+
+
+class RecordingModel:
+    """Wraps a model and records the inputs and outputs of its sent_prob, sent_probs and word_probs calls,
+    so the model can later be replaced by a ReplayModel (e.g., to tune the optimizer without GPUs).
+
+    word_probs outputs are recorded (and returned) as compact arrays (float32, or float64 for exact models;
+    see caching.compact_word_probs),
+    so a replayed optimization follows exactly the same path as the recorded one.
+
+    Example:
+        models = [RecordingModel(model_factory(name, gpu_id)) for ...]
+        results = optimize_sentence_set(2, models, ...)
+        for model in models:
+            model.save(os.path.join("recordings", model.name + ".pkl.gz"))
+    """
+
+    def __init__(self, model):
+        self.model = model
+        self.name = model.name
+        self.is_word_prob_exact = model.is_word_prob_exact
+        self.sent_log_probs = dict()  # normalized sentence -> log-probability
+        self.word_probs_outputs = dict()  # masked context -> word_probs output
+        self.n_calls = {"sent_prob": 0, "word_probs": 0}
+
+    def sent_prob(self, sent):
+        self.n_calls["sent_prob"] += 1
+        prob = float(self.model.sent_prob(sent))
+        self.sent_log_probs[normalize_sentence(sent)] = prob
+        return prob
+
+    def sent_probs(self, sents):
+        self.n_calls["sent_prob"] += len(sents)
+        log_probs = np.asarray(self.model.sent_probs(sents), dtype=float)
+        for sent, prob in zip(sents, log_probs):
+            self.sent_log_probs[normalize_sentence(sent)] = float(prob)
+        return log_probs
+
+    def word_probs(self, words, wordi):
+        self.n_calls["word_probs"] += 1
+        key = get_masked_context(words, wordi)
+        output = compact_word_probs(
+            self.model.word_probs(list(words), wordi), exact=self.is_word_prob_exact
+        )
+        self.word_probs_outputs[key] = output
+        return output
+
+    def save(self, fname):
+        """save the recorded calls (a gzip-compressed pickle)"""
+        target_folder = os.path.dirname(fname)
+        if target_folder != "":
+            pathlib.Path(target_folder).mkdir(parents=True, exist_ok=True)
+        with gzip.open(fname, "wb") as f:
+            pickle.dump(
+                {
+                    "name": self.name,
+                    "is_word_prob_exact": self.is_word_prob_exact,
+                    "sent_log_probs": self.sent_log_probs,
+                    "word_probs_outputs": self.word_probs_outputs,
+                },
+                f,
+                protocol=pickle.HIGHEST_PROTOCOL,
+            )
+
+
+class ReplayModel:
+    """A stand-in for model_factory that answers sent_prob, sent_probs and word_probs calls from a RecordingModel file.
+
+    Calls that were not recorded are passed to fallback_model if it is provided,
+    and raise ModelCallNotRecordedError otherwise. n_calls and n_misses count the calls of each type.
+    """
+
+    def __init__(self, fname, fallback_model=None):
+        with gzip.open(fname, "rb") as f:
+            recording = pickle.load(f)
+        self.name = recording["name"]
+        self.is_word_prob_exact = recording["is_word_prob_exact"]
+        self.sent_log_probs = recording["sent_log_probs"]
+        self.word_probs_outputs = recording["word_probs_outputs"]
+        for output in self.word_probs_outputs.values():
+            for array in output if isinstance(output, tuple) else (output,):
+                array.setflags(write=False)
+        self.fallback_model = fallback_model
+        self.n_calls = {"sent_prob": 0, "word_probs": 0}
+        self.n_misses = {"sent_prob": 0, "word_probs": 0}
+
+    def sent_prob(self, sent):
+        self.n_calls["sent_prob"] += 1
+        prob = self.sent_log_probs.get(normalize_sentence(sent))
+        if prob is None:
+            self.n_misses["sent_prob"] += 1
+            if self.fallback_model is None:
+                raise ModelCallNotRecordedError(
+                    f"sent_prob('{sent}') was not recorded for model {self.name}"
+                )
+            prob = float(self.fallback_model.sent_prob(sent))
+        return prob
+
+    def sent_probs(self, sents):
+        return np.asarray([self.sent_prob(sent) for sent in sents])
+
+    def word_probs(self, words, wordi):
+        self.n_calls["word_probs"] += 1
+        output = self.word_probs_outputs.get(get_masked_context(words, wordi))
+        if output is None:
+            self.n_misses["word_probs"] += 1
+            if self.fallback_model is None:
+                raise ModelCallNotRecordedError(
+                    f"word_probs({words}, {wordi}) was not recorded for model {self.name}"
+                )
+            output = compact_word_probs(
+                self.fallback_model.word_probs(list(words), wordi),
+                exact=self.is_word_prob_exact,
+            )
+        return output
@@ -0,0 +1,309 @@
+# A local daemon that keeps model_factory models resident in memory and serves them to many optimizer processes.
+#
+# Start the server once per node (models are loaded on first request, one instance per model name):
+# python model_server.py --gpu_ids 0 1
+#
+# Then, in each worker (run by the same user), use RemoteModel instead of model_factory:
+# model = RemoteModel("gpt2")
+# model.sent_prob("This is a sentence")
+#
+# By default, the socket is created in a per-user directory that only its owner can access
+# ($XDG_RUNTIME_DIR/contstimlang, or /tmp/contstimlang-<uid>), and the server generates a random authentication key,
+# saved next to the socket in a file only its owner can read (<socket>.authkey). Clients read the key from this file.
+# Set CONTSTIMLANG_MODEL_SERVER_AUTHKEY to use a fixed key instead (e.g., for clients run by another user).
+# With a fixed key and a shared socket path (--socket), the socket's mode is left as created; use --socket_mode
+# (e.g., 660 for the socket's group) to let other users connect, since connecting requires write permission.
+
+import os
+import stat
+import time
+import socket
+import secrets
+import argparse
+import tempfile
+import threading
+from multiprocessing.managers import BaseManager
+
+cpu_models = ["bigram", "trigram"]
+
+
+def get_private_folder():
+    """return (and create) a per-user folder that only its owner can access, for the default socket and key"""
+    if os.environ.get("XDG_RUNTIME_DIR"):
+        folder = os.path.join(os.environ["XDG_RUNTIME_DIR"], "contstimlang")
+    else:
+        folder = os.path.join(tempfile.gettempdir(), f"contstimlang-{os.getuid()}")
+    try:
+        os.mkdir(folder, 0o700)
+    except FileExistsError:
+        pass
+    folder_stat = os.lstat(folder)
+    if (
+        not stat.S_ISDIR(folder_stat.st_mode)
+        or folder_stat.st_uid != os.getuid()
+        or folder_stat.st_mode & 0o077
+    ):
+        raise RuntimeError(
+            f"{folder} must be a directory owned by the current user and accessible only by it (mode 0700)"
+        )
+    return folder
+
+
+def get_default_address():
+    if os.environ.get("CONTSTIMLANG_MODEL_SERVER"):
+        return os.environ["CONTSTIMLANG_MODEL_SERVER"]
+    return os.path.join(get_private_folder(), "models.sock")
+
+
+def get_authkey_fname(address):
+    return address + ".authkey"
+
+
+def create_authkey(address):
+    """generate a random authentication key and save it to a file readable only by its owner"""
+    authkey = secrets.token_hex(32)
+    tmp_fname = get_authkey_fname(address) + f".{os.getpid()}.tmp"
+    fd = os.open(tmp_fname, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(fd, "w") as f:
+        f.write(authkey)
+    os.replace(tmp_fname, get_authkey_fname(address))
+    return authkey.encode("utf-8")
+
+
+def read_authkey(address):
+    """return the key saved by the server (None if it was not saved yet)"""
+    try:
+        with open(get_authkey_fname(address)) as f:
+            return f.read().strip().encode("utf-8")
+    except FileNotFoundError:
+        return None
+
+
+class ModelServer:
+    """Owns one model_factory instance per model name and evaluates requests on them.
+
+    Each client connection is handled by its own thread. Requests to the same model are serialized,
+    requests to different models (typically on different devices) run concurrently.
+    """
+
+    def __init__(self, gpu_ids=None, model_kwargs=None):
+        """Initialize the server
+
+        args:
+            gpu_ids: list of GPU ids. Models are assigned to GPUs in a round-robin manner as they are loaded.
+                If None or empty, all models run on the CPU.
+            model_kwargs: additional keyword arguments passed to model_factory
+        """
+        self.gpu_ids = list(gpu_ids) if gpu_ids else []
+        self.model_kwargs = model_kwargs if model_kwargs is not None else dict()
+        self.models = dict()
+        self.model_locks = dict()
+        self.loading_lock = threading.Lock()
+        self.n_requests = dict()
+
+    def _get_model(self, name):
+        if name not in self.models:
+            with self.loading_lock:
+                if name not in self.models:
+                    from model_functions import model_factory
+
+                    if name in cpu_models or len(self.gpu_ids) == 0:
+                        gpu_id = None
+                    else:
+                        n_gpu_models = len(
+                            [m for m in self.models if m not in cpu_models]
+                        )
+                        gpu_id = self.gpu_ids[n_gpu_models % len(self.gpu_ids)]
+                    print(f"loading {name} (gpu {gpu_id})...", end="", flush=True)
+                    model = model_factory(name, gpu_id, **self.model_kwargs)
+                    print("done.", flush=True)
+                    self.model_locks[name] = threading.Lock()
+                    self.n_requests[name] = 0
+                    self.models[name] = model
+        return self.models[name]
+
+    def _call(self, name, method_name, *args):
+        model = self._get_model(name)
+        with self.model_locks[name]:
+            self.n_requests[name] += 1
+            return getattr(model, method_name)(*args)
+
+    def load_model(self, name):
+        """load the model (if not loaded yet) and return its attributes needed by the client"""
+        model = self._get_model(name)
+        return {
+            "name": model.name,
+            "is_word_prob_exact": model.is_word_prob_exact,
+            "device": str(model.device),
+        }
+
+    def sent_prob(self, name, sent):
+        return self._call(name, "sent_prob", sent)
+
+    def sent_probs(self, name, sents):
+        return self._call(name, "sent_probs", sents)
+
+    def word_probs(self, name, words, wordi):
+        return self._call(name, "word_probs", words, wordi)
+
+    def count_tokens(self, name, sent):
+        return self._call(name, "count_tokens", sent)
+
+    def stats(self):
+        """return the number of requests served per model"""
+        return dict(self.n_requests)
+
+
+class ModelServerManager(BaseManager):
+    pass
+
+
+class RemoteModel:
+    """A client of ModelServer with the same interface as model_factory (name, is_word_prob_exact, sent_prob, sent_probs, word_probs, count_tokens)"""
+
+    def __init__(self, name, address=None, authkey=None, connection_timeout=600):
+        """Connect to the server and ask it to load the model
+
+        args:
+            name: model name (as in model_factory)
+            address: Unix socket path of the server (default: $CONTSTIMLANG_MODEL_SERVER, or a socket in a per-user folder)
+            authkey: server authentication key (default: $CONTSTIMLANG_MODEL_SERVER_AUTHKEY, or the key saved by the server)
+            connection_timeout: seconds to wait for the server to come up
+        """
+        if address is None:
+            address = get_default_address()
+        if authkey is None and os.environ.get("CONTSTIMLANG_MODEL_SERVER_AUTHKEY"):
+            authkey = os.environ["CONTSTIMLANG_MODEL_SERVER_AUTHKEY"].encode("utf-8")
+
+        ModelServerManager.register("get_model_server")
+        start_time = time.time()
+        while True:
+            try:
+                # the key file is written when the server starts
+                cur_authkey = authkey if authkey is not None else read_authkey(address)
+                if cur_authkey is None:
+                    raise FileNotFoundError(get_authkey_fname(address))
+                manager = ModelServerManager(address=address, authkey=cur_authkey)
+                manager.connect()
+                break
+            except (FileNotFoundError, ConnectionRefusedError):
+                if time.time() - start_time > connection_timeout:
+                    raise
+                time.sleep(1)
+        self._server = manager.get_model_server()
+        info = self._server.load_model(name)
+        self.name = info["name"]
+        self.is_word_prob_exact = info["is_word_prob_exact"]
+        self.device = info["device"]
+
+    def sent_prob(self, sent):
+        return self._server.sent_prob(self.name, sent)
+
+    def sent_probs(self, sents):
+        return self._server.sent_probs(self.name, list(sents))
+
+    def word_probs(self, words, wordi):
+        return self._server.word_probs(self.name, list(words), wordi)
+
+    def count_tokens(self, sent):
+        return self._server.count_tokens(self.name, sent)
+
+
+def remove_stale_socket(address):
+    """remove a socket left by a server that is no longer running. raises RuntimeError if a server is still using it"""
+    if not os.path.exists(address):
+        return
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(address)
+    except ConnectionRefusedError:
+        os.remove(address)  # nobody is listening
+        return
+    finally:
+        client.close()
+    raise RuntimeError(f"a model server is already running on {address}")
+
+
+def serve(
+    address=None,
+    authkey=None,
+    gpu_ids=None,
+    preload_models=None,
+    model_kwargs=None,
+    socket_mode=None,
+):
+    """run a ModelServer until the process is killed
+
+    args:
+        address: Unix socket path (default: $CONTSTIMLANG_MODEL_SERVER, or a socket in a per-user folder)
+        authkey: authentication key (default: $CONTSTIMLANG_MODEL_SERVER_AUTHKEY, or a random key saved next to the socket)
+        gpu_ids: list of GPU ids (see ModelServer)
+        preload_models: names of models to load before accepting requests
+        model_kwargs: additional keyword arguments passed to model_factory
+        socket_mode: permissions of the socket (e.g., 0o660 to serve the members of the socket's group).
+            if None, the socket is accessible only by its owner (0o600), unless a shared key is configured and the
+            socket is not in the per-user folder, in which case its mode is left as created (determined by the umask).
+    """
+    in_private_folder = address is None and not os.environ.get(
+        "CONTSTIMLANG_MODEL_SERVER"
+    )
+    if address is None:
+        address = get_default_address()
+    if authkey is None and os.environ.get("CONTSTIMLANG_MODEL_SERVER_AUTHKEY"):
+        authkey = os.environ["CONTSTIMLANG_MODEL_SERVER_AUTHKEY"].encode("utf-8")
+    if socket_mode is None and (authkey is None or in_private_folder):
+        socket_mode = 0o600  # only the owner can connect
+    remove_stale_socket(address)
+
+    server = ModelServer(gpu_ids=gpu_ids, model_kwargs=model_kwargs)
+    for name in preload_models or []:
+        server.load_model(name)
+
+    if authkey is None:
+        authkey = create_authkey(address)  # a new random key for each server
+    ModelServerManager.register("get_model_server", callable=lambda: server)
+    manager = ModelServerManager(address=address, authkey=authkey)
+    manager_server = manager.get_server()
+    if socket_mode is not None:
+        os.chmod(address, socket_mode)
+    print(f"serving models on {address}", flush=True)
+    manager_server.serve_forever()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--socket", type=str, default=None)
+    parser.add_argument(
+        "--socket_mode",
+        type=lambda mode: int(mode, 8),
+        default=None,
+        help="octal permissions of the socket (e.g., 660). default: 600, unless a shared key and socket path are used",
+    )
+    parser.add_argument("--gpu_ids", type=int, nargs="*", default=None)
+    parser.add_argument(
+        "--preload_models",
+        type=str,
+        nargs="*",
+        default=None,
+        help="models to load before accepting requests (other models are loaded on first request)",
+    )
+    parser.add_argument(
+        "--sent_prob_cache_size",
+        type=int,
+        default=None,
+        help="number of sentence log-probabilities memoized per model",
+    )
+    args = parser.parse_args()
+
+    if args.gpu_ids is None:
+        import torch
+
+        args.gpu_ids = list(range(torch.cuda.device_count()))
+
+    serve(
+        address=args.socket,
+        socket_mode=args.socket_mode,
+        gpu_ids=args.gpu_ids,
+        preload_models=args.preload_models,
+        model_kwargs={"sent_prob_cache_size": args.sent_prob_cache_size},
+    )
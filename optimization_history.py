@@ -0,0 +1,220 @@
+import os
+import csv
+import pathlib
+
+import numpy as np
+import pandas as pd
+
+
+class OptimizationHistory:
+    """An append-only, columnar record of a sentence optimization.
+
+    Each row holds the sentences, their log-probabilities under each model and the loss.
+    Rows are written into preallocated numpy columns (grown by doubling), so appending is O(1),
+    and can also be streamed to a CSV or Parquet file as they are produced.
+    A pandas DataFrame is only built when to_pandas() is called.
+
+    Columns (as in the DataFrames returned by to_pandas):
+        s{i}: sentence i
+        p_s{i}_{model_name}: log-probability of sentence i according to the model
+        loss
+    """
+
+    def __init__(
+        self,
+        n_sentences,
+        n_models,
+        model_names=None,
+        stream_fname=None,
+        keep_in_memory=True,
+        initial_capacity=256,
+        parquet_row_group_size=256,
+    ):
+        """Initialize the history
+
+        args:
+            n_sentences: number of optimized sentences
+            n_models: number of models
+            model_names: used for column headers (default: m0, m1, ...)
+            stream_fname: if not None, rows are appended to this file as they are produced.
+                Files ending with .parquet are written as Parquet (requires pyarrow), other files as CSV.
+            keep_in_memory: if False (and stream_fname is given), rows are only written to the file
+            initial_capacity: number of preallocated rows
+            parquet_row_group_size: number of rows buffered before writing a Parquet row group
+        """
+        if model_names is None:
+            model_names = [f"m{i_model}" for i_model in range(n_models)]
+        assert len(model_names) == n_models
+        assert keep_in_memory or stream_fname is not None, "rows must be kept somewhere"
+
+        self.n_sentences = n_sentences
+        self.n_models = n_models
+        self.sentence_columns = [f"s{i_sentence}" for i_sentence in range(n_sentences)]
+        self.log_p_columns = [
+            f"p_s{i_sentence}_{model_name}"
+            for model_name in model_names
+            for i_sentence in range(n_sentences)
+        ]
+        self.columns = self.sentence_columns + self.log_p_columns + ["loss"]
+
+        self.keep_in_memory = keep_in_memory
+        self.closed = False
+        self.n_rows = 0
+        self._capacity = 0
+        self._sentences = np.empty((0, n_sentences), dtype=object)
+        self._log_p = np.empty((0, n_models * n_sentences), dtype=np.float64)
+        self._loss = np.empty((0,), dtype=np.float64)
+        if keep_in_memory:
+            self._grow(initial_capacity)
+
+        self.stream_fname = stream_fname
+        self.parquet_row_group_size = parquet_row_group_size
+        self._csv_file = None
+        self._csv_writer = None
+        self._parquet_writer = None
+        self._parquet_buffer = []
+        if stream_fname is not None:
+            target_folder = os.path.dirname(stream_fname)
+            if target_folder != "":
+                pathlib.Path(target_folder).mkdir(parents=True, exist_ok=True)
+            if not self._is_parquet():
+                self._csv_file = open(stream_fname, "w", newline="")
+                self._csv_writer = csv.writer(self._csv_file)
+                self._csv_writer.writerow(self.columns)
+                self._csv_file.flush()
+
+    def _is_parquet(self):
+        return self.stream_fname is not None and self.stream_fname.endswith(".parquet")
+
+    def _grow(self, capacity):
+        capacity = max(capacity, 1)
+        sentences = np.empty((capacity, self.n_sentences), dtype=object)
+        log_p = np.full((capacity, self._log_p.shape[1]), np.nan)
+        loss = np.full((capacity,), np.nan)
+        sentences[: self.n_rows] = self._sentences[: self.n_rows]
+        log_p[: self.n_rows] = self._log_p[: self.n_rows]
+        loss[: self.n_rows] = self._loss[: self.n_rows]
+        self._sentences, self._log_p, self._loss = sentences, log_p, loss
+        self._capacity = capacity
+
+    def append(self, sentences, sentences_log_p=None, loss=None):
+        """record a row
+
+        args:
+            sentences (list of strings)
+            sentences_log_p (numpy.array, optional) sentences_log_p[m,s] is the log-probability assigned to sentence s by model m.
+            loss (float, optional)
+        """
+        if self.closed:
+            raise ValueError("cannot append to a closed OptimizationHistory")
+        assert len(sentences) == self.n_sentences
+        if sentences_log_p is None:
+            log_p_row = np.full(self.n_models * self.n_sentences, np.nan)
+        else:
+            sentences_log_p = np.asarray(sentences_log_p, dtype=np.float64)
+            assert sentences_log_p.shape == (self.n_models, self.n_sentences)
+            log_p_row = sentences_log_p.reshape(-1)
+        loss = np.nan if loss is None else float(loss)
+
+        if self.keep_in_memory:
+            if self.n_rows == self._capacity:
+                self._grow(2 * self._capacity)
+            self._sentences[self.n_rows] = list(sentences)
+            self._log_p[self.n_rows] = log_p_row
+            self._loss[self.n_rows] = loss
+        self.n_rows += 1
+
+        if self._csv_writer is not None:
+            self._csv_writer.writerow(list(sentences) + list(log_p_row) + [loss])
+            self._csv_file.flush()
+        elif self._is_parquet():
+            self._parquet_buffer.append(list(sentences) + list(log_p_row) + [loss])
+            if len(self._parquet_buffer) >= self.parquet_row_group_size:
+                self._write_parquet_row_group()
+
+    def get_rows(self):
+        """return the recorded rows as a list of (sentences, sentences_log_p, loss) tuples (see append)"""
+        assert self.keep_in_memory, "rows were not kept in memory"
+        return [
+            (
+                list(self._sentences[i_row]),
+                self._log_p[i_row].reshape(self.n_models, self.n_sentences).copy(),
+                self._loss[i_row],
+            )
+            for i_row in range(self.n_rows)
+        ]
+
+    def __len__(self):
+        return self.n_rows
+
+    def _rows_to_pandas(self, rows):
+        df = pd.DataFrame(rows, columns=self.columns)
+        df[self.log_p_columns + ["loss"]] = df[self.log_p_columns + ["loss"]].astype(
+            np.float64
+        )
+        return df
+
+    def _write_parquet_row_group(self):
+        if len(self._parquet_buffer) == 0:
+            return
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        table = pa.Table.from_pandas(
+            self._rows_to_pandas(self._parquet_buffer), preserve_index=False
+        )
+        if self._parquet_writer is None:
+            self._parquet_writer = pq.ParquetWriter(self.stream_fname, table.schema)
+        self._parquet_writer.write_table(table)
+        self._parquet_buffer = []
+
+    def flush(self):
+        """write buffered rows to the stream file"""
+        if self._csv_file is not None:
+            self._csv_file.flush()
+        if self._is_parquet():
+            self._write_parquet_row_group()
+
+    def close(self):
+        """flush and close the stream file. No rows can be appended afterwards (recorded rows remain available)."""
+        if self.closed:
+            return
+        self.closed = True
+        self.flush()
+        if self._csv_file is not None:
+            self._csv_file.close()
+            self._csv_file = None
+            self._csv_writer = None
+        if self._parquet_writer is not None:
+            self._parquet_writer.close()
+            self._parquet_writer = None
+
+    def to_pandas(self):
+        """return the history as a pandas DataFrame (one row per recorded step)
+
+        If rows are not kept in memory, they are read back from the stream file.
+        A Parquet file can only be read once its footer is written, so in this case the history is closed.
+        """
+        if not self.keep_in_memory:
+            if self._is_parquet():
+                self.close()
+                return pd.read_parquet(self.stream_fname)
+            self.flush()
+            return pd.read_csv(self.stream_fname)
+
+        n = self.n_rows
+        data = {}
+        for i_column, column in enumerate(self.sentence_columns):
+            data[column] = self._sentences[:n, i_column]
+        for i_column, column in enumerate(self.log_p_columns):
+            data[column] = self._log_p[:n, i_column]
+        data["loss"] = self._loss[:n]
+        return pd.DataFrame(data, columns=self.columns)
+
+    def to_csv(self, fname, **kwargs):
+        """save the history as a CSV file (kwargs are passed to pandas.DataFrame.to_csv)"""
+        self.to_pandas().to_csv(fname, **kwargs)
+
+    def to_parquet(self, fname, **kwargs):
+        """save the history as a Parquet file (requires pyarrow)"""
+        self.to_pandas().to_parquet(fname, **kwargs)
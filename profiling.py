@@ -0,0 +1,164 @@
+import os
+import json
+import time
+import pathlib
+import threading
+import contextlib
+
+
+class Profiler:
+    """Records where the time of a sentence optimization goes.
+
+    Each record is a timed phase (e.g., "word_probs", "sent_prob", "surrogate_search"), optionally attributed to a model,
+    with the number of items it processed (batch_size) and the number of tokens it processed (n_tokens).
+    Records are aggregated per phase and per (phase, model), and can also be streamed to a JSONL trace file.
+    Recording is thread-safe, so models evaluated concurrently can share a profiler.
+
+    Example:
+        profiler = Profiler(trace_fname="trace.jsonl")
+        models = [model_factory(name, gpu_id, profiler=profiler) for ...]
+        results = optimize_sentence_set(..., profiler=profiler)
+        print_profile_summary(results["profile"])
+    """
+
+    def __init__(self, trace_fname=None):
+        """Initialize the profiler
+
+        args:
+            trace_fname: if not None, every record is appended to this JSONL file (one JSON object per line)
+        """
+        self.start_time = time.perf_counter()
+        self._lock = threading.Lock()
+        self._stats = dict()  # (phase, model_name) -> [n_calls, total_time, total_batch_size, total_n_tokens]
+        self.trace_fname = trace_fname
+        self._trace_file = None
+        if trace_fname is not None:
+            target_folder = os.path.dirname(trace_fname)
+            if target_folder != "":
+                pathlib.Path(target_folder).mkdir(parents=True, exist_ok=True)
+            self._trace_file = open(trace_fname, "a")
+
+    def record(self, phase, elapsed, model_name=None, batch_size=None, n_tokens=None):
+        """record one call of a phase
+
+        args:
+            phase (str) phase name
+            elapsed (float) wall time in seconds
+            model_name (str, optional) the model the phase is attributed to
+            batch_size (int, optional) number of items (e.g., sentences) processed
+            n_tokens (int, optional) number of tokens processed
+        """
+        with self._lock:
+            stats = self._stats.setdefault((phase, model_name), [0, 0.0, 0, 0])
+            stats[0] += 1
+            stats[1] += elapsed
+            stats[2] += batch_size if batch_size is not None else 0
+            stats[3] += n_tokens if n_tokens is not None else 0
+            if self._trace_file is not None:
+                trace_record = {
+                    "time": time.perf_counter() - self.start_time - elapsed,
+                    "phase": phase,
+                    "elapsed": elapsed,
+                }
+                if model_name is not None:
+                    trace_record["model"] = model_name
+                if batch_size is not None:
+                    trace_record["batch_size"] = int(batch_size)
+                if n_tokens is not None:
+                    trace_record["n_tokens"] = int(n_tokens)
+                self._trace_file.write(json.dumps(trace_record) + "\n")
+
+    @contextlib.contextmanager
+    def phase(self, phase, model_name=None, batch_size=None, n_tokens=None):
+        """a context manager recording the wall time of its body (see record)"""
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(
+                phase,
+                time.perf_counter() - start_time,
+                model_name=model_name,
+                batch_size=batch_size,
+                n_tokens=n_tokens,
+            )
+
+    def summary(self):
+        """return a dictionary summarizing the records:
+
+        'wall_time': seconds since the profiler was created
+        'phases': {phase: stats} totals over models
+        'models': {model_name: {phase: stats}} for phases attributed to a model
+        where stats is a dictionary with n_calls, total_time, mean_time, total_batch_size, mean_batch_size and n_tokens.
+        """
+
+        def to_dict(n_calls, total_time, total_batch_size, n_tokens):
+            return {
+                "n_calls": n_calls,
+                "total_time": total_time,
+                "mean_time": total_time / n_calls,
+                "total_batch_size": total_batch_size,
+                "mean_batch_size": total_batch_size / n_calls,
+                "n_tokens": n_tokens,
+            }
+
+        with self._lock:
+            phase_totals = dict()
+            models = dict()
+            for (phase, model_name), stats in self._stats.items():
+                totals = phase_totals.setdefault(phase, [0, 0.0, 0, 0])
+                for i, value in enumerate(stats):
+                    totals[i] += value
+                if model_name is not None:
+                    models.setdefault(model_name, dict())[phase] = to_dict(*stats)
+            return {
+                "wall_time": time.perf_counter() - self.start_time,
+                "phases": {phase: to_dict(*totals) for phase, totals in phase_totals.items()},
+                "models": models,
+            }
+
+    def flush(self):
+        if self._trace_file is not None:
+            with self._lock:
+                self._trace_file.flush()
+
+    def close(self):
+        """flush and close the trace file"""
+        if self._trace_file is not None:
+            with self._lock:
+                self._trace_file.close()
+                self._trace_file = None
+
+
+def profiled(profiler, phase, model_name=None, batch_size=None, n_tokens=None):
+    """return profiler.phase(...) or, if profiler is None, a context manager that does nothing"""
+    if profiler is None:
+        return contextlib.nullcontext()
+    return profiler.phase(
+        phase, model_name=model_name, batch_size=batch_size, n_tokens=n_tokens
+    )
+
+
+def print_profile_summary(summary):
+    """print a profiler summary (see Profiler.summary) as a table"""
+    print("profile (wall time: {:.1f}s):".format(summary["wall_time"]))
+    rows = [(phase, "", stats) for phase, stats in summary["phases"].items()]
+    for model_name, model_phases in summary["models"].items():
+        rows += [(phase, model_name, stats) for phase, stats in model_phases.items()]
+    print(
+        "{:<24} {:<24} {:>8} {:>10} {:>10} {:>10} {:>12}".format(
+            "phase", "model", "calls", "total [s]", "mean [ms]", "batch", "tokens"
+        )
+    )
+    for phase, model_name, stats in sorted(rows, key=lambda row: (row[0], row[1])):
+        print(
+            "{:<24} {:<24} {:>8} {:>10.2f} {:>10.2f} {:>10} {:>12}".format(
+                phase,
+                model_name,
+                stats["n_calls"],
+                stats["total_time"],
+                stats["mean_time"] * 1000,
+                "{:.1f}".format(stats["mean_batch_size"]) if stats["total_batch_size"] > 0 else "",
+                stats["n_tokens"] if stats["n_tokens"] > 0 else "",
+            )
+        )
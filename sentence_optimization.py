@@ -1,13 +1,29 @@
 #!/usr/bin/env python
 # coding: utf-8
 
+import time
 import random
+import concurrent.futures
 
 import numpy as np
 import pandas as pd
 
-from interpolation_search import SetInterpolationSearchPandas
-from vocabulary import vocab_low, vocab_low_freqs, vocab_cap, vocab_cap_freqs
+from interpolation_search import SetInterpolationSearch
+from optimization_history import OptimizationHistory
+from profiling import profiled, print_profile_summary
+from vocabulary import (
+    vocab_low,
+    vocab_low_freqs,
+    vocab_cap,
+    vocab_cap_freqs,
+    vocab_low_index,
+    vocab_cap_index,
+    lowercase_word_ids,
+    vocab_low_lowercase_ids,
+    vocab_cap_lowercase_ids,
+    vocab_low_lengths,
+    vocab_cap_lengths,
+)
 
 
 def controversiality_loss_func(sentences_log_p, **kwargs):
@@ -74,14 +90,20 @@ def get_word_prob_from_model(model, words, wordi):
     #TODO: move this into the models' word_prob methods.
     """
 
+    output = model.word_probs(
+        words.copy(), wordi
+    )  # copying ensures words remains unchanged regardless of the model code
+    return word_probs_output_to_word_list(output, wordi)
+
+
+def word_probs_output_to_word_list(output, wordi):
+    """convert the output of model.word_probs(words, wordi) to a (word_list, model_word_probs) tuple (see get_word_prob_from_model)"""
+
     if wordi == 0:
         vocab = vocab_cap
     else:
         vocab = vocab_low
 
-    output = model.word_probs(
-        words.copy(), wordi
-    )  # copying ensures words remains unchanged regardless of the model code
     if len(output) == 2 and isinstance(
         output, tuple
     ):  # model returns indecis and probabilities
@@ -96,6 +118,103 @@ def get_word_prob_from_model(model, words, wordi):
     return word_list, model_word_probs
 
 
+class CandidateWordTable:
+    """Candidate replacement words for one word location, indexed by vocabulary id.
+
+    For each candidate, holds the exact and approximate sentence log-probabilities assigned by each model
+    to the sentence resulting from the replacement.
+
+    attributes:
+        vocab (list) the vocabulary of the word location (vocab_cap for the first word, vocab_low otherwise)
+        cur_word (str) the current word (id len(vocab) stands for it if it is not in the vocabulary)
+        word_ids (np.Array) (N,) vocabulary ids of the candidates
+        approximate (np.Array) (N, n_models) approximate log-probabilities (NaN where unavailable)
+        exact (np.Array) (N, n_models) exact log-probabilities (NaN where not evaluated yet)
+    """
+
+    def __init__(self, wordi, cur_word, word_probs_outputs, is_word_prob_exact, cur_log_p):
+        """build the table of replacement words available from all models.
+
+        args:
+            wordi (int) word location
+            cur_word (str) the current word at wordi
+            word_probs_outputs (list) model.word_probs(words, wordi) output for each model
+            is_word_prob_exact (list of bool) for each model, whether its word_probs are exact
+            cur_log_p (np.Array) (n_models,) exact log-probabilities of the current sentence
+        """
+        if wordi == 0:
+            self.vocab, vocab_index = vocab_cap, vocab_cap_index
+            self._lowercase_ids, self._lengths = vocab_cap_lowercase_ids, vocab_cap_lengths
+        else:
+            self.vocab, vocab_index = vocab_low, vocab_low_index
+            self._lowercase_ids, self._lengths = vocab_low_lowercase_ids, vocab_low_lengths
+        self.cur_word = cur_word
+        n_vocab = len(self.vocab)
+        n_models = len(word_probs_outputs)
+        cur_word_id = vocab_index.get(cur_word, n_vocab)
+
+        # one row per vocabulary word, plus a row for an out-of-vocabulary current word
+        approximate = np.full((n_vocab + 1, n_models), np.nan)
+        exact = np.full((n_vocab + 1, n_models), np.nan)
+        is_available = np.zeros((n_vocab + 1, n_models), dtype=bool)
+        for i_model, output in enumerate(word_probs_outputs):
+            if len(output) == 2 and isinstance(
+                output, tuple
+            ):  # model returns probabilities and vocabulary indecis
+                model_word_probs = np.asarray(output[0], dtype=float)
+                model_word_ids = np.asarray(output[1], dtype=np.int64)
+            else:  # probabilities are returned for all vocab
+                model_word_probs = np.asarray(output, dtype=float)
+                assert len(model_word_probs) == n_vocab
+                model_word_ids = np.arange(n_vocab)
+            if is_word_prob_exact[i_model]:
+                exact[model_word_ids, i_model] = model_word_probs
+            else:
+                approximate[model_word_ids, i_model] = model_word_probs
+            is_available[model_word_ids, i_model] = True
+
+            # make sure the exact probability for the current word is included (we already have it from the previous round)
+            exact[cur_word_id, i_model] = cur_log_p[i_model]
+            is_available[cur_word_id, i_model] = True
+
+        # keep only the intersection of the candidates of all models
+        # (if we have neither approximate nor exact log-prob of a word for one of the models, we don't consider it).
+        self.word_ids = np.flatnonzero(is_available.all(axis=1))
+        self.approximate = approximate[self.word_ids]
+        self.exact = exact[self.word_ids]
+
+    def __len__(self):
+        return len(self.word_ids)
+
+    def get_word(self, idx):
+        """return the word of candidate idx"""
+        word_id = self.word_ids[idx]
+        if word_id == len(self.vocab):
+            return self.cur_word
+        return self.vocab[word_id]
+
+    def _select(self, mask):
+        self.word_ids = self.word_ids[mask]
+        self.approximate = self.approximate[mask]
+        self.exact = self.exact[mask]
+
+    def remove_words(self, words):
+        """remove candidates that are equal (ignoring case) to one of words"""
+        words = set(w.lower() for w in words)
+        excluded_ids = [lowercase_word_ids[w] for w in words if w in lowercase_word_ids]
+        lowercase_ids = self._lowercase_ids[np.minimum(self.word_ids, len(self.vocab) - 1)]
+        is_excluded = np.isin(lowercase_ids, excluded_ids)
+        is_cur_word = self.word_ids == len(self.vocab)
+        is_excluded[is_cur_word] = self.cur_word.lower() in words
+        self._select(~is_excluded)
+
+    def get_n_characters(self, sentence):
+        """return the length (in characters) of the sentence resulting from each replacement of cur_word in sentence"""
+        lengths = self._lengths[np.minimum(self.word_ids, len(self.vocab) - 1)]
+        lengths = np.where(self.word_ids == len(self.vocab), len(self.cur_word), lengths)
+        return len(sentence) - len(self.cur_word) + lengths
+
+
 def get_loss_fun_with_respect_to_sentence_i(
     sentences_log_p, i_sentence, loss_func, n_characters=None
 ):
@@ -223,7 +342,8 @@ def update_history(
 ):
     """update the history of sentence optimization
     args:
-        history (pd.DataFrame) history of sentence optimization
+        history (pd.DataFrame or OptimizationHistory) history of sentence optimization.
+            An OptimizationHistory is appended to in place (pd.DataFrame histories are copied on every update).
         sentences (list of strings)
         sentences_log_p (numpy.array, optional) sentence_log_p[m,s] is the log-probabilitiy assigned to sentence s by model m.
         loss (float), optional
@@ -232,6 +352,10 @@ def update_history(
     return updated history
     """
 
+    if isinstance(history, OptimizationHistory):
+        history.append(sentences, sentences_log_p=sentences_log_p, loss=loss)
+        return history
+
     n_sentences = len(sentences)
     new_row = pd.DataFrame()
 
@@ -258,6 +382,170 @@ def update_history(
     return history
 
 
+def run_model_requests(
+    models, requests, executor=None, model_times=None, profiler=None
+):
+    """evaluate a list of model requests.
+
+    args:
+        models (list) model objects
+        requests (list) of tuples, either ("sent_prob", i_model, sentence) or ("word_probs", i_model, words, wordi)
+        executor (concurrent.futures.Executor, optional) if provided, the requests of different models are evaluated
+            concurrently (e.g., models placed on different GPUs compute at the same time).
+        model_times (np.Array, optional) (n_models,) the time spent evaluating each model is added to this vector.
+        profiler (profiling.Profiler, optional) records the 'sent_prob' and 'word_probs' phases of each model.
+
+    returns:
+        a list of results (one per request): sentence log-probabilities for "sent_prob" requests,
+        model.word_probs outputs for "word_probs" requests.
+
+    sent_prob requests to the same model are evaluated together with a single model.sent_probs call,
+    and identical requests are evaluated only once.
+    """
+    results = [None] * len(requests)
+
+    def evaluate_model_requests(i_model):
+        start_time = time.perf_counter()
+        model = models[i_model]
+        model_name = getattr(model, "name", f"m{i_model}")
+
+        # sent_prob requests, batched per model
+        request_indices = [
+            i
+            for i, request in enumerate(requests)
+            if request[0] == "sent_prob" and request[1] == i_model
+        ]
+        uq_sentences = list(dict.fromkeys(requests[i][2] for i in request_indices))
+        if len(uq_sentences) > 0:
+            with profiled(
+                profiler, "sent_prob", model_name=model_name, batch_size=len(uq_sentences)
+            ):
+                if len(uq_sentences) == 1:
+                    log_probs = {uq_sentences[0]: model.sent_prob(uq_sentences[0])}
+                else:
+                    log_probs = dict(zip(uq_sentences, model.sent_probs(uq_sentences)))
+        for i in request_indices:
+            results[i] = float(log_probs[requests[i][2]])
+
+        # word_probs requests
+        word_probs_outputs = dict()
+        for i, request in enumerate(requests):
+            if request[0] == "word_probs" and request[1] == i_model:
+                words, wordi = request[2], request[3]
+                key = (tuple(words), wordi)
+                if key not in word_probs_outputs:
+                    with profiled(
+                        profiler, "word_probs", model_name=model_name, batch_size=1
+                    ):
+                        word_probs_outputs[key] = model.word_probs(
+                            list(words).copy(), wordi
+                        )  # copying ensures words remains unchanged regardless of the model code
+                results[i] = word_probs_outputs[key]
+        return time.perf_counter() - start_time
+
+    def evaluate_model_group(i_models):
+        return [evaluate_model_requests(i_model) for i_model in i_models]
+
+    # a model object listed more than once is never called from two threads at the same time
+    model_groups = dict()
+    for i_model, model in enumerate(models):
+        model_groups.setdefault(id(model), []).append(i_model)
+    model_groups = list(model_groups.values())
+
+    if executor is not None and len(model_groups) > 1:
+        elapsed_per_group = list(executor.map(evaluate_model_group, model_groups))
+    else:
+        elapsed_per_group = [evaluate_model_group(i_models) for i_models in model_groups]
+
+    if model_times is not None:
+        for i_models, elapsed in zip(model_groups, elapsed_per_group):
+            model_times[i_models] += elapsed
+    return results
+
+
+def run_optimization_steps(
+    optimization_steps, models, concurrent_models=True, profiler=None
+):
+    """run sentence optimization generators (see sentence_set_optimization_steps) in lock-step.
+
+    At each round, the model requests of all unfinished optimizations are pooled and evaluated together
+    by run_model_requests, so sent_prob requests from different optimizations share batches.
+
+    args:
+        optimization_steps (list) of sentence_set_optimization_steps generators
+        models (list) model objects
+        concurrent_models (bool) if True, evaluate the requests of different models concurrently (in threads)
+        profiler (profiling.Profiler, optional) records the model evaluations (see run_model_requests)
+
+    returns a list of optimization results (one per generator).
+    Completed optimizations' results include the model evaluation time:
+        'model_time': (n_models,) seconds spent evaluating each model
+        'model_wall_time': seconds spent waiting for the models (for each round, the maximum over models if concurrent_models,
+            otherwise the sum).
+        'profile': the profiler summary (see profiling.Profiler.summary), if a profiler is provided.
+    In lock-step, these are the times of the whole run, shared by all of the optimizations.
+    """
+    results = [None] * len(optimization_steps)
+    model_times = np.zeros(len(models))
+    model_wall_time = 0.0
+    if concurrent_models and len(models) > 1:
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=len(models))
+    else:
+        executor = None
+
+    pending_requests = dict()
+    for i, steps in enumerate(optimization_steps):
+        try:
+            pending_requests[i] = next(steps)
+        except StopIteration as e:
+            results[i] = e.value
+
+    try:
+        while len(pending_requests) > 0:
+            pooled_requests = []
+            for i, requests in pending_requests.items():
+                pooled_requests.extend(requests)
+            round_model_times = np.zeros(len(models))
+            pooled_results = run_model_requests(
+                models,
+                pooled_requests,
+                executor=executor,
+                model_times=round_model_times,
+                profiler=profiler,
+            )
+            model_times += round_model_times
+            if executor is not None:
+                model_wall_time += round_model_times.max()
+            else:
+                model_wall_time += round_model_times.sum()
+
+            next_pending_requests = dict()
+            offset = 0
+            for i, requests in pending_requests.items():
+                try:
+                    next_pending_requests[i] = optimization_steps[i].send(
+                        pooled_results[offset : offset + len(requests)]
+                    )
+                except StopIteration as e:
+                    results[i] = e.value
+                offset += len(requests)
+            pending_requests = next_pending_requests
+    finally:
+        if executor is not None:
+            executor.shutdown(wait=True)
+
+    if profiler is not None:
+        profiler.flush()
+        profile = profiler.summary()
+    for result in results:
+        if isinstance(result, dict):
+            result["model_time"] = model_times
+            result["model_wall_time"] = model_wall_time
+            if profiler is not None:
+                result["profile"] = profile
+    return results
+
+
 def optimize_sentence_set(
     n_sentences,
     models,
@@ -271,15 +559,24 @@ def optimize_sentence_set(
     max_steps=10000,
     internal_stopping_condition=lambda loss: False,
     external_stopping_check=lambda: False,
+    max_opt_hours=None,
     max_replacement_attempts_per_word=50,
     max_non_decreasing_loss_attempts_per_word=5,
     keep_words_unique=False,
     allowed_repeating_words=None,
     monitoring_func=None,
     save_history=False,
+    history_fname=None,
+    checkpoint=None,
     model_names=None,
     do_pass_n_words=False,
     do_pass_n_characters=False,
+    concurrent_models=True,
+    n_speculative_candidates=1,
+    speculative_candidates_diversity=0.0,
+    h_method="LinearRegression",
+    skip_unchanged_word_locations=True,
+    profiler=None,
     verbose=3,
 ):
     """Optimize a sentence set of n_sentences.
@@ -298,6 +595,8 @@ def optimize_sentence_set(
         max_steps (int) maximum total number of word replacement attempts
         internal_stopping_condition (function) function for internal stopping condition. args: loss - finish optimization if True
         external_stopping_check (function) if this function returns True, abort the optimization (no args) - used to check if other process finished the same optimization task
+        max_opt_hours (float) if not None, stop the optimization after this many hours. The time spent before resuming from a checkpoint is included,
+            so restarting a job doesn't extend its time limit.
     # word replacement-level stopping conditions:
         max_replacement_attempts_per_word (int) if not None, stop trying to replace a word after max_replacement_attempts_per_word alternative sentences were evaluated
         max_non_decreasing_loss_attempts_per_word (int) if not None, stop trying to replace a word after max_non_decreasing_loss_attempts_per_word sentences did not show decreasing loss
@@ -305,10 +604,197 @@ def optimize_sentence_set(
         keep_words_unique (bool) all words must be unique (within sentence)
         allowed_repeating_words (list) if keep_words_unique is True, these words are excluded from the uniqueness constrain. The words should be lower-case.
     # monitoring:
-        save_history (bool) if True, save the history of the optimization
+        save_history (bool) if True, save the history of the optimization (results["history"] is an OptimizationHistory, use .to_pandas() for a DataFrame)
+        history_fname (str) if not None, stream the history rows to this file as they are produced (.parquet for Parquet, otherwise CSV)
+    # checkpointing:
+        checkpoint (checkpointing.OptimizationCheckpoint) if not None, the optimization state (sentences, log-probabilities,
+            word location dispenser, random number generator states and elapsed time) is saved periodically,
+            and a previously saved state is resumed. The checkpoint is removed when the optimization completes
+            (but not when it is aborted by external_stopping_check, since another worker may own the job by then).
         model_names (list of strings) used to for history column headers
         monitoring_func (function) function for online user feedback. args: (sentences, sentences_log_p)
         verbose (int)
+    # performance:
+        concurrent_models (bool) if True, the models are evaluated concurrently (in threads), so models placed on different devices compute at the same time.
+        n_speculative_candidates (int) number of predicted replacement words whose exact sentence log-probabilities are evaluated together
+            (in one batched call per model) at each replacement attempt. 1 evaluates a single candidate at a time.
+            Values > 1 may waste some model evaluations but require far fewer round trips.
+        speculative_candidates_diversity (float) when n_speculative_candidates > 1, don't evaluate together words whose predicted
+            sentence log-probabilities are all within this distance of those of a better predicted word (0: no constraint).
+        h_method (str) the surrogate predicting exact from approximate sentence log-probabilities:
+            'LinearRegression', 'IsotonicRegression', 'HuberRegression' or 'KNeighborsRegression' (see interpolation_search.SetInterpolationSearch)
+        skip_unchanged_word_locations (bool) if True, don't repeat a failed replacement attempt of a word location
+            unless one of the sentences has changed since the failure.
+        profiler (profiling.Profiler) if not None, record the wall time, call counts and batch sizes of the optimization phases
+            ('word_probs' and 'sent_prob' per model, 'candidate_table', 'surrogate_search', 'history', 'checkpoint', 'monitoring').
+            results["profile"] holds the summary. Pass the same profiler to model_factory to also record tokens per model.
+    """
+
+    steps = sentence_set_optimization_steps(
+        n_sentences,
+        models,
+        loss_func,
+        sent_length_in_words=sent_length_in_words,
+        sentences_to_change=sentences_to_change,
+        replacement_strategy=replacement_strategy,
+        sentences=sentences,
+        initial_sampling=initial_sampling,
+        start_with_identical_sentences=start_with_identical_sentences,
+        max_steps=max_steps,
+        internal_stopping_condition=internal_stopping_condition,
+        external_stopping_check=external_stopping_check,
+        max_opt_hours=max_opt_hours,
+        max_replacement_attempts_per_word=max_replacement_attempts_per_word,
+        max_non_decreasing_loss_attempts_per_word=max_non_decreasing_loss_attempts_per_word,
+        keep_words_unique=keep_words_unique,
+        allowed_repeating_words=allowed_repeating_words,
+        monitoring_func=monitoring_func,
+        save_history=save_history,
+        history_fname=history_fname,
+        checkpoint=checkpoint,
+        model_names=model_names,
+        do_pass_n_words=do_pass_n_words,
+        do_pass_n_characters=do_pass_n_characters,
+        n_speculative_candidates=n_speculative_candidates,
+        speculative_candidates_diversity=speculative_candidates_diversity,
+        h_method=h_method,
+        skip_unchanged_word_locations=skip_unchanged_word_locations,
+        profiler=profiler,
+        verbose=verbose,
+    )
+    results = run_optimization_steps(
+        [steps], models, concurrent_models=concurrent_models, profiler=profiler
+    )[0]
+    if verbose >= 2 and results is not False:
+        print_model_times(results, models)
+        if profiler is not None:
+            print_profile_summary(results["profile"])
+    return results
+
+
+def print_model_times(results, models):
+    print(
+        "model wall time: {:.1f}s ({})".format(
+            results["model_wall_time"],
+            ", ".join(
+                "{}: {:.1f}s".format(model.name, model_time)
+                for model, model_time in zip(models, results["model_time"])
+            ),
+        )
+    )
+
+
+def optimize_sentence_sets(
+    initial_sentence_sets,
+    models,
+    loss_func,
+    external_stopping_checks=None,
+    checkpoints=None,
+    concurrent_models=True,
+    profiler=None,
+    **kwargs
+):
+    """Optimize several sentence sets in lock-step.
+
+    Each sentence set is optimized exactly as by optimize_sentence_set, but the optimizations advance together,
+    so the exact sent_prob evaluations requested by all of them at each round are pooled into shared batches.
+    Each optimization stops independently (when its own stopping conditions are met).
+    The optimizations share the process-global random number generators, so unlike a single optimization,
+    optimizations resumed from checkpoints don't restore their random states (and don't resume exactly).
+    A single sentence set is resumed exactly.
+
+    args:
+        initial_sentence_sets (list) of lists of initial sentences (e.g., [[natural_sentence_1]*2, [natural_sentence_2]*2])
+        models (list) a list of model objects
+        loss_func (function) see optimize_sentence_set
+        external_stopping_checks (list of functions, optional) an external_stopping_check function for each sentence set
+        checkpoints (list of checkpointing.OptimizationCheckpoint, optional) a checkpoint for each sentence set
+        concurrent_models (bool) if True, the models are evaluated concurrently (in threads)
+        profiler (profiling.Profiler, optional) shared by all of the optimizations (see optimize_sentence_set)
+        **kwargs: other keyword arguments of optimize_sentence_set
+
+    returns a list of optimize_sentence_set results (one per sentence set, False for aborted optimizations).
+    """
+    assert (
+        kwargs.get("history_fname") is None
+    ), "streaming histories is not supported for lock-step optimization, use save_history"
+    if external_stopping_checks is None:
+        external_stopping_checks = [lambda: False] * len(initial_sentence_sets)
+    assert len(external_stopping_checks) == len(initial_sentence_sets)
+    if checkpoints is None:
+        checkpoints = [None] * len(initial_sentence_sets)
+    assert len(checkpoints) == len(initial_sentence_sets)
+
+    all_steps = [
+        sentence_set_optimization_steps(
+            len(sentences),
+            models,
+            loss_func,
+            sentences=list(sentences),
+            external_stopping_check=external_stopping_check,
+            checkpoint=checkpoint,
+            profiler=profiler,
+            restore_random_state=len(initial_sentence_sets) == 1,
+            **kwargs,
+        )
+        for sentences, external_stopping_check, checkpoint in zip(
+            initial_sentence_sets, external_stopping_checks, checkpoints
+        )
+    ]
+    all_results = run_optimization_steps(
+        all_steps, models, concurrent_models=concurrent_models, profiler=profiler
+    )
+    if kwargs.get("verbose", 3) >= 2:
+        completed_results = [r for r in all_results if r is not False]
+        if len(completed_results) > 0:
+            print_model_times(completed_results[0], models)
+            if profiler is not None:
+                print_profile_summary(completed_results[0]["profile"])
+    return all_results
+
+
+def sentence_set_optimization_steps(
+    n_sentences,
+    models,
+    loss_func,
+    sent_length_in_words=8,
+    sentences_to_change=None,
+    replacement_strategy="cyclic",
+    sentences=None,
+    initial_sampling="uniform",
+    start_with_identical_sentences=True,
+    max_steps=10000,
+    internal_stopping_condition=lambda loss: False,
+    external_stopping_check=lambda: False,
+    max_opt_hours=None,
+    max_replacement_attempts_per_word=50,
+    max_non_decreasing_loss_attempts_per_word=5,
+    keep_words_unique=False,
+    allowed_repeating_words=None,
+    monitoring_func=None,
+    save_history=False,
+    history_fname=None,
+    checkpoint=None,
+    model_names=None,
+    do_pass_n_words=False,
+    do_pass_n_characters=False,
+    n_speculative_candidates=1,
+    speculative_candidates_diversity=0.0,
+    h_method="LinearRegression",
+    skip_unchanged_word_locations=True,
+    profiler=None,
+    restore_random_state=True,
+    verbose=3,
+):
+    """A generator implementing optimize_sentence_set (see its docstring for the arguments).
+
+    Instead of calling the models directly, the generator yields lists of model requests
+    (see run_model_requests) and expects to be sent the list of their results.
+    It returns the optimization results (or False if the optimization was aborted).
+    This allows running many optimizations in lock-step (see run_optimization_steps).
+
+    restore_random_state (bool) if True, resuming from a checkpoint restores the (process-global) random and numpy.random
+    states. Optimizations run in lock-step share these generators, so they resume without restoring them.
     """
 
     if replacement_strategy == "cyclic":
@@ -351,15 +837,29 @@ def optimize_sentence_set(
     # get initial sentence probabilities
     def get_sentence_log_probabilities(models, sentences):
         """Return a (model x sentence) log_probability numpy matrix"""
-        log_p = np.empty(shape=(len(models), len(sentences)))
-        log_p[:] = np.nan
-        for i_model, model in enumerate(models):
-            for i_sentence, sentence in enumerate(sentences):
-                log_p[i_model, i_sentence] = model.sent_prob(sentence)
-        return log_p
+        requests = [
+            ("sent_prob", i_model, sentence)
+            for i_model in range(len(models))
+            for sentence in sentences
+        ]
+        request_results = yield requests
+        return np.asarray(request_results, dtype=float).reshape(
+            len(models), len(sentences)
+        )
 
-    # sentence_log_p[m,s] is the log-probabilitiy assigned to sentence s by model m.
-    sentences_log_p = get_sentence_log_probabilities(models, sentences)
+    checkpoint_state = checkpoint.load() if checkpoint is not None else None
+
+    if checkpoint_state is None:
+        # sentence_log_p[m,s] is the log-probabilitiy assigned to sentence s by model m.
+        sentences_log_p = yield from get_sentence_log_probabilities(models, sentences)
+    else:
+        # resume a previous run of the same job
+        sentences = checkpoint_state["sentences"]
+        sentences_log_p = checkpoint_state["sentences_log_p"]
+        word_location_dispenser = checkpoint_state["word_location_dispenser"]
+        if restore_random_state:
+            random.setstate(checkpoint_state["random_state"])
+            np.random.set_state(checkpoint_state["np_random_state"])
 
     if do_pass_n_characters:
         n_characters = np.array([len(sentence) for sentence in sentences])
@@ -369,33 +869,102 @@ def optimize_sentence_set(
     current_loss = loss_func(sentences_log_p, n_characters=n_characters).item()
 
     if verbose >= 2:
-        print("initialized:")
+        if checkpoint_state is None:
+            print("initialized:")
+        else:
+            print("resumed at step {}:".format(checkpoint_state["step"]))
         for sentence in sentences:
             print(sentence)
         print("loss:", current_loss)
 
     termination_reason = ""
 
-    if save_history:
-        history = pd.DataFrame()
-        history = update_history(
-            history,
-            sentences,
-            sentences_log_p=sentences_log_p,
+    # for each (sentence, word location), the sentences at which its last replacement attempt failed,
+    # and the number of model calls this attempt required.
+    failed_word_locations = dict()
+    n_model_calls = 0
+    n_skipped_word_locations = 0
+    n_saved_model_calls = 0
+    first_step = 0
+    elapsed_time_before_resume = 0.0  # seconds spent on this optimization by previous runs of the job
+    if checkpoint_state is not None:
+        failed_word_locations = checkpoint_state["failed_word_locations"]
+        n_model_calls = checkpoint_state["n_model_calls"]
+        n_skipped_word_locations = checkpoint_state["n_skipped_word_locations"]
+        n_saved_model_calls = checkpoint_state["n_saved_model_calls"]
+        first_step = checkpoint_state["step"]
+        elapsed_time_before_resume = checkpoint_state["elapsed_time_in_seconds"]
+
+    if save_history or history_fname is not None:
+        history = OptimizationHistory(
+            n_sentences,
+            len(models),
             model_names=model_names,
-            loss=current_loss,
+            stream_fname=history_fname,
+            keep_in_memory=save_history
+            or checkpoint is not None,  # checkpoints include the history
+        )
+        if checkpoint_state is None:
+            history.append(
+                sentences, sentences_log_p=sentences_log_p, loss=current_loss
+            )
+        else:
+            for row in checkpoint_state["history_rows"]:
+                history.append(*row)
+    else:
+        history = None
+
+    start_time = time.time()
+
+    def get_elapsed_time_in_seconds():
+        return elapsed_time_before_resume + time.time() - start_time
+
+    def save_checkpoint(step):
+        checkpoint.save(
+            {
+                "sentences": list(sentences),
+                "sentences_log_p": sentences_log_p.copy(),
+                "word_location_dispenser": word_location_dispenser,
+                "random_state": random.getstate(),
+                "np_random_state": np.random.get_state(),
+                "failed_word_locations": failed_word_locations,
+                "n_model_calls": n_model_calls,
+                "n_skipped_word_locations": n_skipped_word_locations,
+                "n_saved_model_calls": n_saved_model_calls,
+                "step": step,
+                "elapsed_time_in_seconds": get_elapsed_time_in_seconds(),
+                "history_rows": history.get_rows() if history is not None else [],
+            }
         )
-    for step in range(max_steps):
+
+    step = first_step
+    for step in range(first_step, max_steps):
 
         # check stopping conditions
         if external_stopping_check():
-            # abort optimization (e.g., another worker completed the sentence).
+            # abort optimization (e.g., another worker completed the sentence, or took over the job).
+            # the checkpoint is left in place: it may now belong to the worker that took over the job.
+            if history is not None:
+                history.close()
             return False
 
+        if checkpoint is not None and checkpoint.is_due():
+            with profiled(profiler, "checkpoint"):
+                save_checkpoint(step)
+
         if internal_stopping_condition(current_loss):
             termination_reason = "internal_stopping_condition"
             break
 
+        if max_opt_hours is not None:
+            time_elapsed_in_hours = get_elapsed_time_in_seconds() / 3600
+            if time_elapsed_in_hours > max_opt_hours:
+                print(
+                    f"time exceeded ({time_elapsed_in_hours:.2f} hours), stopping optimization"
+                )
+                termination_reason = "time exceeded"
+                break
+
         # determine which word are we trying to replace at this step.
         wordi = word_location_dispenser.get_next_word_location()
         if wordi is None:
@@ -411,60 +980,50 @@ def optimize_sentence_set(
             words = sentence.split(" ")  # break the sentences into words
             cur_word = words[wordi]  # current word to replace
 
-            def prepare_word_prob_df(models, words, wordi):
-                # get word-based log-probs for potential replacement of words[wordi], from each model.
-                # some of the models return exact sentence-log-probability for each potential replacement word,
-                # others return an approximation.
-
-                all_models_word_df = None
-                for i_model, model in enumerate(models):
-
-                    # get a list of potential replacement words. For each word, we have the corresponding sentence log probability.
-                    word_list, model_word_probs = get_word_prob_from_model(
-                        model, words, wordi
-                    )
-
-                    model_words_df = pd.DataFrame(index=word_list)
-                    if model.is_word_prob_exact:
-                        model_words_df["exact_" + str(i_model)] = model_word_probs
-                        model_words_df["approximate_" + str(i_model)] = np.nan
-                    else:
-                        model_words_df["approximate_" + str(i_model)] = model_word_probs
-                        model_words_df["exact_" + str(i_model)] = np.nan
-
-                    # make sure the exact probability for the current word is included (we already have it from the previous round)
-                    model_words_df.at[
-                        cur_word, "exact_" + str(i_model)
-                    ] = sentences_log_p[i_model, i_sentence]
-
-                    # accumulate replacement words and associated probabilities across models
-                    if all_models_word_df is None:
-                        all_models_word_df = model_words_df
-                    else:
-                        all_models_word_df = all_models_word_df.join(
-                            model_words_df, how="inner"
-                        )  # this keeps only the intersecion of the word_lists!
-                        # (if we have neither approximate nor exact log-prob of a word for one of the models, we don't consider it).
-                return all_models_word_df
-
-            all_models_word_df = prepare_word_prob_df(models, words, wordi)
-
-            if (
-                keep_words_unique
-            ):  # filter out replacements that would lead to repeating word
-                other_words_in_sentence = set(
-                    [w.lower() for w in (words[:wordi] + words[wordi + 1 :])]
+            if skip_unchanged_word_locations:
+                failed_state, failed_attempt_n_model_calls = failed_word_locations.get(
+                    (i_sentence, wordi), (None, 0)
                 )
-                if allowed_repeating_words is not None:
-                    other_words_in_sentence = other_words_in_sentence - set(
-                        allowed_repeating_words
-                    )
-                candidate_word_is_already_in_sentence = (
-                    all_models_word_df.index.str.lower().isin(other_words_in_sentence)
+                if failed_state == tuple(sentences):
+                    # this location already failed with exactly the same sentences, so it would fail again.
+                    n_skipped_word_locations += 1
+                    n_saved_model_calls += failed_attempt_n_model_calls
+                    if verbose >= 4:
+                        print(
+                            "sentence {}: skipped {} (unchanged since the last failed attempt)".format(
+                                i_sentence, cur_word
+                            )
+                        )
+                    continue
+            n_model_calls_before_attempt = n_model_calls
+
+            # get word-based log-probs for potential replacement of words[wordi], from each model.
+            # some of the models return exact sentence-log-probability for each potential replacement word,
+            # others return an approximation.
+            word_probs_outputs = yield [
+                ("word_probs", i_model, words, wordi) for i_model in range(len(models))
+            ]
+            n_model_calls += len(models)
+            with profiled(profiler, "candidate_table"):
+                candidates = CandidateWordTable(
+                    wordi,
+                    cur_word,
+                    word_probs_outputs,
+                    [model.is_word_prob_exact for model in models],
+                    sentences_log_p[:, i_sentence],
                 )
-                all_models_word_df = all_models_word_df[
-                    ~candidate_word_is_already_in_sentence
-                ]
+
+                if (
+                    keep_words_unique
+                ):  # filter out replacements that would lead to repeating word
+                    other_words_in_sentence = set(
+                        [w.lower() for w in (words[:wordi] + words[wordi + 1 :])]
+                    )
+                    if allowed_repeating_words is not None:
+                        other_words_in_sentence = other_words_in_sentence - set(
+                            allowed_repeating_words
+                        )
+                    candidates.remove_words(other_words_in_sentence)
 
             models_with_approximate_probs = [
                 i for i, model in enumerate(models) if not model.is_word_prob_exact
@@ -475,65 +1034,82 @@ def optimize_sentence_set(
             # approximate log probs to exact log probs.
             #
             # We'll evaluate the exact probabilties for the words with the maximal
-            # and minimal approximate probabilities for these models.
+            # and minimal approximate probabilities for these models (all in one round of requests).
+            evaluations = []
             for i_model in models_with_approximate_probs:
-                words_to_evaluate = [
-                    all_models_word_df["approximate_" + str(i_model)].idxmax(),
-                    all_models_word_df["approximate_" + str(i_model)].idxmin(),
+                idxs_to_evaluate = [
+                    np.nanargmax(candidates.approximate[:, i_model]),
+                    np.nanargmin(candidates.approximate[:, i_model]),
                 ]
-                for word_to_evaluate in words_to_evaluate:
-                    if not np.isnan(
-                        all_models_word_df.at[word_to_evaluate, "exact_" + str(i_model)]
-                    ):
+                for idx_to_evaluate in idxs_to_evaluate:
+                    if not np.isnan(candidates.exact[idx_to_evaluate, i_model]):
                         continue  # don't waste time evaluating the word if we already have its exact log prob.
                         # (this might happen if the max probability word is also the current word).
+                    if (i_model, idx_to_evaluate) not in evaluations:
+                        evaluations.append((i_model, idx_to_evaluate))
+            if len(evaluations) > 0:
+                modified_sents = []
+                for i_model, idx_to_evaluate in evaluations:
                     modified_words = words.copy()
-                    modified_words[wordi] = word_to_evaluate
-                    modified_sent = " ".join(modified_words)
-                    modified_sent_prob = models[i_model].sent_prob(modified_sent)
-
-                    all_models_word_df.at[
-                        word_to_evaluate, "exact_" + str(i_model)
-                    ] = modified_sent_prob
+                    modified_words[wordi] = candidates.get_word(idx_to_evaluate)
+                    modified_sents.append(" ".join(modified_words))
+                modified_sent_probs = yield [
+                    ("sent_prob", i_model, modified_sent)
+                    for (i_model, idx_to_evaluate), modified_sent in zip(
+                        evaluations, modified_sents
+                    )
+                ]
+                n_model_calls += len(evaluations)
+                for (i_model, idx_to_evaluate), modified_sent_prob in zip(
+                    evaluations, modified_sent_probs
+                ):
+                    candidates.exact[idx_to_evaluate, i_model] = modified_sent_prob
                     if verbose >= 4:
                         print(
                             "sentence {}: evaluated {:<30} for model {}".format(
                                 i_sentence,
-                                cur_word + "→ " + word_to_evaluate,
+                                cur_word + "→ " + candidates.get_word(idx_to_evaluate),
                                 models[i_model].name,
                             )
                         )
 
-            word_list = list(all_models_word_df.index)
-
+            g = candidates.approximate
+            initial_observed_ys = candidates.exact
             if do_pass_n_characters:
-                all_models_word_df["exact_n_characters"] = (
-                    len(sentence) - len(cur_word) + all_models_word_df.index.str.len()
+                n_characters_column = candidates.get_n_characters(sentence)[:, None]
+                g = np.concatenate([g, np.full(n_characters_column.shape, np.nan)], axis=1)
+                initial_observed_ys = np.concatenate(
+                    [initial_observed_ys, n_characters_column], axis=1
                 )
-                all_models_word_df["approximate_n_characters"] = np.nan
 
             # define loss function for updating sentence_i, with the other sentences fixed.
             loss_func_i = get_loss_fun_with_respect_to_sentence_i(
                 sentences_log_p, i_sentence, loss_func, n_characters=n_characters
             )
 
-            opt = SetInterpolationSearchPandas(
-                loss_fun=loss_func_i, df=all_models_word_df, h_method="LinearRegression"
-            )
+            with profiled(profiler, "surrogate_search"):
+                is_observed = np.logical_not(np.isnan(initial_observed_ys)).any(axis=1)
+                opt = SetInterpolationSearch(
+                    loss_fun=loss_func_i,
+                    g=g,
+                    initial_observed_xs=np.flatnonzero(is_observed),
+                    initial_observed_ys=initial_observed_ys[is_observed],
+                    h_method=h_method,
+                )
 
-            # search for the best replacement word
+                # search for the best replacement word
 
-            # first, we'll see if any of words for which we already have exact sentence probabilities improves the loss
-            (
-                candidate_word_idx,
-                candidate_exact_loss,
-                new_sent_info,
-            ) = opt.get_observed_loss_minimum()
+                # first, we'll see if any of words for which we already have exact sentence probabilities improves the loss
+                (
+                    candidate_word_idx,
+                    candidate_exact_loss,
+                    new_sent_info,
+                ) = opt.get_observed_loss_minimum()
             found_useful_replacement = (
                 candidate_word_idx is not None
             ) and candidate_exact_loss < current_loss
             if found_useful_replacement:
-                candidate_replacement_word = word_list[candidate_word_idx]
+                candidate_replacement_word = candidates.get_word(candidate_word_idx)
 
             if not found_useful_replacement:
                 # none of the replacement words with observed exact sentence log-probabilities improve the current loss.
@@ -542,14 +1118,52 @@ def optimize_sentence_set(
                 best_approximate_loss = np.inf
                 n_non_decreasing_loss_attempts_per_word = 0
 
-                for word_iteration in range(max_replacement_attempts_per_word):
-                    # find the best word according to approximate sentence probabilities
-                    (
-                        candidate_word_idx,
-                        candidate_approximate_loss,
-                        missing_models,
-                    ) = opt.get_unobserved_loss_minimum()
-                    if candidate_word_idx is None:
+                n_attempts = 0
+                while n_attempts < max_replacement_attempts_per_word:
+                    # find the best word(s) according to approximate sentence probabilities
+                    n_proposals = min(
+                        n_speculative_candidates,
+                        max_replacement_attempts_per_word - n_attempts,
+                    )
+                    with profiled(profiler, "surrogate_search"):
+                        if n_proposals == 1:
+                            (
+                                candidate_word_idx,
+                                candidate_approximate_loss,
+                                missing_models,
+                            ) = opt.get_unobserved_loss_minimum()
+                            if candidate_word_idx is None:
+                                proposals = []
+                            else:
+                                proposals = [
+                                    (
+                                        candidate_word_idx,
+                                        candidate_approximate_loss,
+                                        missing_models,
+                                    )
+                                ]
+                        else:
+                            # speculative mode: evaluate the top n_proposals predicted words together
+                            (
+                                candidate_word_idxs,
+                                candidate_approximate_losses,
+                                is_model_missing,
+                            ) = opt.get_unobserved_loss_minima(
+                                n_proposals, diversity=speculative_candidates_diversity
+                            )
+                            proposals = [
+                                (
+                                    candidate_word_idx,
+                                    candidate_approximate_loss,
+                                    np.flatnonzero(is_missing),
+                                )
+                                for candidate_word_idx, candidate_approximate_loss, is_missing in zip(
+                                    candidate_word_idxs,
+                                    candidate_approximate_losses,
+                                    is_model_missing,
+                                )
+                            ]
+                    if len(proposals) == 0:
                         if verbose >= 4:
                             print(
                                 "sentence {}: word replacements exhausted.".format(
@@ -557,47 +1171,77 @@ def optimize_sentence_set(
                                 )
                             )
                         break
-                    candidate_replacement_word = word_list[candidate_word_idx]
-
-                    # for the best word, we'd like to know the exact sentence log probailities for all of the models
-                    modified_words = words.copy()
-                    modified_words[wordi] = candidate_replacement_word
-                    modified_sent = " ".join(modified_words)
-                    for i_model in missing_models:
-                        modified_sent_prob = models[i_model].sent_prob(modified_sent)
+                    n_attempts += len(proposals)
+
+                    # for the proposed words, we'd like to know the exact sentence log probailities for all of the models
+                    evaluations = []
+                    for candidate_word_idx, _, missing_models in proposals:
+                        modified_words = words.copy()
+                        modified_words[wordi] = candidates.get_word(candidate_word_idx)
+                        modified_sent = " ".join(modified_words)
+                        for i_model in missing_models:
+                            evaluations.append((candidate_word_idx, i_model, modified_sent))
+                    modified_sent_probs = []
+                    if len(evaluations) > 0:
+                        modified_sent_probs = yield [
+                            ("sent_prob", i_model, modified_sent)
+                            for _, i_model, modified_sent in evaluations
+                        ]
+                        n_model_calls += len(evaluations)
+                    for (candidate_word_idx, i_model, _), modified_sent_prob in zip(
+                        evaluations, modified_sent_probs
+                    ):
                         if verbose >= 4:
                             print(
                                 "sentence {}: evaluated {:<30} for model {}".format(
                                     i_sentence,
-                                    cur_word + "→ " + candidate_replacement_word,
+                                    cur_word + "→ " + candidates.get_word(candidate_word_idx),
                                     models[i_model].name,
                                 )
                             )
                         # update the optimizer
-                        opt.update_query_result(
-                            xs=[candidate_word_idx], ys=[modified_sent_prob], k=i_model
-                        )
+                        with profiled(profiler, "surrogate_search"):
+                            opt.update_query_result(
+                                xs=[candidate_word_idx], ys=[modified_sent_prob], k=i_model
+                            )
 
-                    # get loss for this word using exact estimates
-                    candidate_exact_loss, new_sent_info = opt.get_loss_for_x(
-                        candidate_word_idx
-                    )
+                    # get loss for the proposed words using exact estimates
+                    proposal_exact_losses = []
+                    for candidate_word_idx, candidate_approximate_loss, _ in proposals:
+                        with profiled(profiler, "surrogate_search"):
+                            candidate_exact_loss, new_sent_info = opt.get_loss_for_x(
+                                candidate_word_idx
+                            )
+                        proposal_exact_losses.append((candidate_exact_loss, new_sent_info))
 
-                    if verbose >= 3:
-                        print(
-                            "sentence {}: considered {:<30} | loss (current→ approximate/exact): {:.3E}→ {:.3E}/{:.3E}".format(
-                                i_sentence,
-                                cur_word + "→ " + candidate_replacement_word,
-                                current_loss,
-                                candidate_approximate_loss,
-                                candidate_exact_loss,
+                        if verbose >= 3:
+                            print(
+                                "sentence {}: considered {:<30} | loss (current→ approximate/exact): {:.3E}→ {:.3E}/{:.3E}".format(
+                                    i_sentence,
+                                    cur_word + "→ " + candidates.get_word(candidate_word_idx),
+                                    current_loss,
+                                    candidate_approximate_loss,
+                                    candidate_exact_loss,
+                                )
                             )
-                        )
 
-                    if candidate_exact_loss < current_loss:
+                    i_best_proposal = int(
+                        np.argmin([loss for loss, _ in proposal_exact_losses])
+                    )
+                    if proposal_exact_losses[i_best_proposal][0] < current_loss:
+                        candidate_word_idx = proposals[i_best_proposal][0]
+                        candidate_exact_loss, new_sent_info = proposal_exact_losses[
+                            i_best_proposal
+                        ]
+                        candidate_replacement_word = candidates.get_word(
+                            candidate_word_idx
+                        )
                         found_useful_replacement = True
                         break
-                    else:
+
+                    # none of the proposed words decreased the loss
+                    too_many_failures = False
+                    for candidate_exact_loss, _ in proposal_exact_losses:
                         if candidate_exact_loss < best_approximate_loss:
                             best_approximate_loss = candidate_exact_loss
                             n_non_decreasing_loss_attempts_per_word = 0
@@ -607,14 +1251,17 @@ def optimize_sentence_set(
                                 n_non_decreasing_loss_attempts_per_word
                                 > max_non_decreasing_loss_attempts_per_word
                             ):
-                                if verbose >= 4:
-                                    print(
-                                        "sentence {}: {} word replacement failures.".format(
-                                            i_sentence,
-                                            n_non_decreasing_loss_attempts_per_word,
-                                        )
-                                    )
+                                too_many_failures = True
                                 break
+                    if too_many_failures:
+                        if verbose >= 4:
+                            print(
+                                "sentence {}: {} word replacement failures.".format(
+                                    i_sentence,
+                                    n_non_decreasing_loss_attempts_per_word,
+                                )
+                            )
+                        break
 
             if found_useful_replacement:
                 if verbose >= 2:
@@ -636,23 +1283,25 @@ def optimize_sentence_set(
                 # update the sentence log probabilities
                 if do_pass_n_characters:
                     sentences_log_p[:, i_sentence] = new_sent_info[..., :-1]
-                    n_characters[i_sentence] = new_sent_info[..., -1]
+                    n_characters[i_sentence] = new_sent_info[..., -1].item()
                 else:
                     sentences_log_p[:, i_sentence] = new_sent_info
                 found_replacement_for_at_least_one_sentence = True
 
-                if save_history:
-                    history = update_history(
-                        history,
-                        sentences,
-                        sentences_log_p=sentences_log_p,
-                        model_names=model_names,
-                        loss=current_loss,
-                    )
-                display_sentences_with_highlighted_word(sentences, i_sentence, wordi)
-                if monitoring_func is not None:
-                    monitoring_func(sentences, sentences_log_p)
+                if history is not None:
+                    with profiled(profiler, "history"):
+                        history.append(
+                            sentences, sentences_log_p=sentences_log_p, loss=current_loss
+                        )
+                with profiled(profiler, "monitoring"):
+                    display_sentences_with_highlighted_word(sentences, i_sentence, wordi)
+                    if monitoring_func is not None:
+                        monitoring_func(sentences, sentences_log_p)
             else:
+                failed_word_locations[(i_sentence, wordi)] = (
+                    tuple(sentences),
+                    n_model_calls - n_model_calls_before_attempt,
+                )
                 if verbose >= 2:
                     print(
                         "sentence {}: no useful replacement for ".format(i_sentence)
@@ -679,7 +1328,19 @@ def optimize_sentence_set(
         "loss": current_loss,
         "step": step,
         "termination_reason": termination_reason,
+        "n_skipped_word_locations": n_skipped_word_locations,
+        "n_saved_model_calls": n_saved_model_calls,
     }
+    if verbose >= 2 and n_skipped_word_locations > 0:
+        print(
+            "skipped {} unchanged word locations ({} model calls saved).".format(
+                n_skipped_word_locations, n_saved_model_calls
+            )
+        )
+    if history is not None:
+        history.close()
     if save_history:
         results["history"] = history
+    if checkpoint is not None:
+        checkpoint.remove()
     return results
@@ -0,0 +1,289 @@
+# A disk-backed store of sentence log-probabilities, shared across processes, HPC workers and scripts.
+#
+# Each entry is keyed by (model name, checkpoint hash, scoring implementation, sentence),
+# so results computed by a different checkpoint or a different sent_prob implementation are never mixed.
+#
+# Example:
+#
+# store = SentenceProbabilityStore("sentence_log_probs.db")
+# model = model_factory("gpt2", 0, sent_prob_store=store)  # sent_prob now consults the store first
+#
+# export the store to the layout read by select_natural_controversial_pairs.py:
+# python sentence_prob_store.py --db_path sentence_log_probs.db --model gpt2
+
+import os
+import sqlite3
+import hashlib
+import threading
+import pathlib
+import argparse
+
+import numpy as np
+
+from caching import normalize_sentence
+
+# pretrained checkpoints (transformers) or local checkpoint files used by each model_factory model
+model_checkpoints = {
+    "bert": ["bert-large-cased"],
+    "bert_new_implementation": ["bert-large-cased"],
+    "bert_has_a_mouth": ["bert-large-cased"],
+    "bert_whole_word": ["bert-large-cased-whole-word-masking"],
+    "bert_whole_word_has_a_mouth": ["bert-large-cased-whole-word-masking"],
+    "roberta": ["roberta-large"],
+    "roberta_new_implementation": ["roberta-large"],
+    "roberta_has_a_mouth": ["roberta-large"],
+    "xlm": ["xlm-mlm-en-2048"],
+    "electra": ["google/electra-large-generator"],
+    "electra_new_implementation": ["google/electra-large-generator"],
+    "electra_has_a_mouth": ["google/electra-large-generator"],
+    "gpt2": ["gpt2-xl"],
+    "naive_gpt2": ["gpt2-xl"],
+    "plain_gpt2": ["gpt2-xl"],
+    "bilstm": [
+        os.path.join("model_checkpoints", "bilstm_state_dict.pt"),
+        os.path.join("model_checkpoints", "neuralnet_word2id_dict.pkl"),
+    ],
+    "lstm": [
+        os.path.join("model_checkpoints", "lstm_state_dict.pt"),
+        os.path.join("model_checkpoints", "neuralnet_word2id_dict.pkl"),
+    ],
+    "rnn": [
+        os.path.join("model_checkpoints", "rnn_state_dict.pt"),
+        os.path.join("model_checkpoints", "neuralnet_word2id_dict.pkl"),
+    ],
+    "trigram": [
+        os.path.join("model_checkpoints", "trigram.model.mdl"),
+        os.path.join("model_checkpoints", "trigram.model.dict"),
+    ],
+    "bigram": [
+        os.path.join("model_checkpoints", "bigram.model.mdl"),
+        os.path.join("model_checkpoints", "bigram.model.dict"),
+    ],
+}
+
+_checkpoint_hashes = {}
+
+
+def get_checkpoint_path(checkpoint, checkpoint_folder=None):
+    """return the path a checkpoint (an entry of model_checkpoints) is loaded from.
+
+    if checkpoint_folder is None, this is the checkpoint itself. otherwise, it is the local copy of the checkpoint
+    in checkpoint_folder (e.g., the randomly initialized stand-ins built by tiny_models.py):
+    pretrained transformers are in subfolders named as the pretrained checkpoint (e.g., 'google/electra-large-generator'),
+    and the files of model_checkpoints are in checkpoint_folder itself.
+    """
+    if checkpoint_folder is None:
+        return checkpoint
+    if os.path.dirname(checkpoint) == "model_checkpoints":
+        checkpoint = os.path.basename(checkpoint)
+    return os.path.join(checkpoint_folder, checkpoint)
+
+
+def get_checkpoint_hash(model_name, checkpoint_folder=None):
+    """return a short hash identifying the checkpoint of model_name.
+
+    local checkpoint files (and the files of local copies of pretrained checkpoints) are hashed by content (md5),
+    pretrained transformers checkpoints by their name.
+    """
+    if (model_name, checkpoint_folder) in _checkpoint_hashes:
+        return _checkpoint_hashes[(model_name, checkpoint_folder)]
+    if model_name not in model_checkpoints:
+        raise ValueError(f"Model {model_name} not found")
+    md5 = hashlib.md5()
+    for checkpoint in model_checkpoints[model_name]:
+        checkpoint = get_checkpoint_path(checkpoint, checkpoint_folder)
+        if os.path.isdir(checkpoint):
+            checkpoint_files = sorted(
+                os.path.join(folder, fname)
+                for folder, _, fnames in os.walk(checkpoint)
+                for fname in fnames
+            )
+        else:
+            checkpoint_files = [checkpoint]
+        for checkpoint_file in checkpoint_files:
+            if os.path.isfile(checkpoint_file):
+                with open(checkpoint_file, "rb") as f:
+                    for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                        md5.update(chunk)
+            else:
+                md5.update(checkpoint_file.encode("utf-8"))
+    _checkpoint_hashes[(model_name, checkpoint_folder)] = md5.hexdigest()[:16]
+    return _checkpoint_hashes[(model_name, checkpoint_folder)]
+
+
+def get_model_key(model_name, checkpoint_folder=None):
+    """return the (model name, checkpoint hash, scoring implementation) key of model_name"""
+    from model_functions import get_sent_prob_function
+
+    return (
+        model_name,
+        get_checkpoint_hash(model_name, checkpoint_folder),
+        get_sent_prob_function(model_name).__name__,
+    )
+
+
+class SentenceProbabilityStore:
+    """A sqlite key-value store of sentence log-probabilities.
+
+    Safe for concurrent use by many processes and threads: writes are done in short transactions
+    and readers wait (up to timeout seconds) for writers instead of failing.
+    """
+
+    max_sqlite_variables = 500  # sqlite limits the number of '?' parameters per statement
+
+    def __init__(self, db_path="sentence_log_probs.db", timeout=600, journal_mode="WAL"):
+        """Initialize the store
+
+        args:
+            db_path: path of the sqlite database (created if it does not exist)
+            timeout: seconds to wait for a lock held by another process
+            journal_mode: sqlite journal mode. 'WAL' allows reading while another process writes,
+                but requires a file system with working shared memory. Use 'DELETE' on network file systems.
+        """
+        self.db_path = db_path
+        self.timeout = timeout
+        self.journal_mode = journal_mode
+        self._local = threading.local()
+
+        if os.path.dirname(db_path) != "":
+            pathlib.Path(os.path.dirname(db_path)).mkdir(parents=True, exist_ok=True)
+
+        conn = self._connect()
+        with conn:
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS sentence_log_probs
+                 (model_name TEXT, checkpoint_hash TEXT, implementation TEXT, sentence TEXT, log_prob REAL,
+                 PRIMARY KEY (model_name, checkpoint_hash, implementation, sentence))"""
+            )
+
+    def _connect(self):
+        # one connection per process and thread (sqlite connections must not be shared across forked processes,
+        # and python's sqlite3 refuses to use a connection in a thread other than the one that created it)
+        local = self._local
+        if getattr(local, "conn", None) is None or local.pid != os.getpid():
+            local.conn = sqlite3.connect(self.db_path, timeout=self.timeout)
+            local.conn.execute(f"PRAGMA journal_mode={self.journal_mode}")
+            local.pid = os.getpid()
+        return local.conn
+
+    def close(self):
+        """close the connection of the calling thread"""
+        local = self._local
+        if getattr(local, "conn", None) is not None and local.pid == os.getpid():
+            local.conn.close()
+        local.conn = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_local"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._local = threading.local()
+
+    def get(self, model_key, sentence):
+        """return the stored log-probability of sentence (or None if it is not stored)"""
+        log_probs = self.get_many(model_key, [sentence])
+        return None if np.isnan(log_probs[0]) else float(log_probs[0])
+
+    def get_many(self, model_key, sentences):
+        """return the stored log-probabilities of sentences as a numpy array (NaN for sentences not stored)
+
+        args:
+            model_key: (model name, checkpoint hash, scoring implementation) tuple, see get_model_key
+            sentences: list of strings
+        """
+        sentences = [normalize_sentence(s) for s in sentences]
+        found = dict()
+        uq_sentences = list(set(sentences))
+        conn = self._connect()
+        for i in range(0, len(uq_sentences), self.max_sqlite_variables):
+            chunk = uq_sentences[i : i + self.max_sqlite_variables]
+            placeholders = ",".join(["?"] * len(chunk))
+            rows = conn.execute(
+                "SELECT sentence, log_prob FROM sentence_log_probs "
+                "WHERE model_name = ? AND checkpoint_hash = ? AND implementation = ? "
+                f"AND sentence IN ({placeholders})",
+                tuple(model_key) + tuple(chunk),
+            ).fetchall()
+            found.update(rows)
+        return np.asarray([found.get(s, np.nan) for s in sentences], dtype=float)
+
+    def put(self, model_key, sentence, log_prob):
+        self.put_many(model_key, [sentence], [log_prob])
+
+    def put_many(self, model_key, sentences, log_probs):
+        """store the log-probabilities of sentences (in a single transaction)"""
+        assert len(sentences) == len(log_probs)
+        rows = [
+            tuple(model_key) + (normalize_sentence(s), float(p))
+            for s, p in zip(sentences, log_probs)
+            if not np.isnan(p)
+        ]
+        conn = self._connect()
+        with conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO sentence_log_probs "
+                "(model_name, checkpoint_hash, implementation, sentence, log_prob) VALUES (?, ?, ?, ?, ?)",
+                rows,
+            )
+
+    def count(self, model_key=None):
+        """return the number of stored log-probabilities (for model_key, or in total)"""
+        conn = self._connect()
+        if model_key is None:
+            return conn.execute("SELECT COUNT(*) FROM sentence_log_probs").fetchone()[0]
+        return conn.execute(
+            "SELECT COUNT(*) FROM sentence_log_probs "
+            "WHERE model_name = ? AND checkpoint_hash = ? AND implementation = ?",
+            tuple(model_key),
+        ).fetchone()[0]
+
+    def export_to_npy(self, model_key, sentences, output_file):
+        """save the log-probabilities of sentences as a numpy vector aligned with sentences.
+
+        sentences missing from the store are saved as NaN.
+        returns the number of missing sentences.
+        """
+        log_probs = self.get_many(model_key, sentences)
+        target_folder = os.path.dirname(output_file)
+        if target_folder != "":
+            pathlib.Path(target_folder).mkdir(parents=True, exist_ok=True)
+        np.save(output_file, log_probs)
+        return int(np.isnan(log_probs).sum())
+
+
+if __name__ == "__main__":
+    # export stored sentence probabilities to resources/precomputed_sentence_probabilities/*.npy
+    default_txt_fname = os.path.join(
+        "resources",
+        "sentence_corpora",
+        "natural_sentences_for_natural_controversial_sentence_pair_selection.txt",
+    )
+
+    default_output_file = os.path.join(
+        "resources",
+        "precomputed_sentence_probabilities",
+        "natural_sentences_for_natural_controversial_sentence_pair_selection_probs",
+    )
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--db_path", type=str, default="sentence_log_probs.db")
+    parser.add_argument("--natural_sentences_file", type=str, default=default_txt_fname)
+    parser.add_argument("--model", type=str, required=True)
+    parser.add_argument("--output_file", type=str, default=default_output_file)
+    args = parser.parse_args()
+
+    with open(args.natural_sentences_file, "r") as f:
+        sentences = [s.strip() for s in f.readlines()]
+
+    store = SentenceProbabilityStore(args.db_path)
+    n_missing = store.export_to_npy(
+        get_model_key(args.model),
+        sentences,
+        args.output_file + "_" + args.model + ".npy",
+    )
+    print(
+        f"exported {len(sentences)-n_missing}/{len(sentences)} sentence log-probabilities for {args.model}."
+    )
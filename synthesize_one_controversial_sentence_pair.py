@@ -6,6 +6,7 @@ import torch
 from model_functions import model_factory
 from sentence_optimization import optimize_sentence_set, controversiality_loss_func
 from utils import exclusive_write_line
+from profiling import Profiler
 
 
 def synthesize_controversial_sentence_pair(
@@ -14,6 +15,7 @@ def synthesize_controversial_sentence_pair(
     initial_sentence,
     results_csv_fname=None,
     history_csv_fname=None,
+    profile_trace_fname=None,
     allow_only_prepositions_to_repeat=True,
     replacement_strategy="cyclic",
     max_replacement_attempts_per_word=50,
@@ -29,6 +31,7 @@ def synthesize_controversial_sentence_pair(
         initial_sentence (str): the initial (natural) sentence to use for sentence initalization
         results_csv_fname: string, path to a file where the resulting sentence pair will be saved (it is appended to the file if it already exists)
         history_csv_fname: string, path to a file where the optimization history of sentence pairs will be saved
+        profile_trace_fname: string, if not None, profile the optimization and write a JSONL trace of its phases to this file
         allow_only_prepositions_to_repeat: bool, if True, only prepositions can be repeated in the sentence
         replacement_strategy: string, one of "cyclic" (as in the preprint,) "exhaustive" (try all possible replacements)
         verbose: int, verbosity level.
@@ -72,6 +75,8 @@ def synthesize_controversial_sentence_pair(
             model_GPU_IDs.append(0)
     models_loaded = False
 
+    profiler = Profiler(trace_fname=profile_trace_fname) if profile_trace_fname is not None else None
+
     print(
         "optimizing sentence {} for {} vs {}".format(
             initial_sentence, model1_name, model2_name
@@ -92,7 +97,7 @@ def synthesize_controversial_sentence_pair(
                 + "...",
                 end="",
             )
-            models.append(model_factory(model_name, model_GPU_ID))
+            models.append(model_factory(model_name, model_GPU_ID, profiler=profiler))
             print("done.")
             models_loaded = True
 
@@ -117,14 +122,12 @@ def synthesize_controversial_sentence_pair(
     sent_len = len(initial_sentence.split())
     initial_sentences = [initial_sentence] * n_sentences
 
-    save_history = history_csv_fname is not None
-
     results = optimize_sentence_set(
         n_sentences,
         models=models,
         loss_func=controversiality_loss_func,
         sentences=initial_sentences,
-        sent_len=sent_len,
+        sent_length_in_words=sent_len,
         initial_sampling=None,
         replacement_strategy=replacement_strategy,
         monitoring_func=monitoring_func,
@@ -132,12 +135,15 @@ def synthesize_controversial_sentence_pair(
         keep_words_unique=keep_words_unique,
         allowed_repeating_words=allowed_repeating_words,
         sentences_to_change=sentences_to_change,
-        save_history=save_history,
+        history_fname=history_csv_fname,  # history rows are written as they are produced
         model_names=model_name_pair,
         max_replacement_attempts_per_word=max_replacement_attempts_per_word,
         max_non_decreasing_loss_attempts_per_word=max_non_decreasing_loss_attempts_per_word,
+        profiler=profiler,
         verbose=verbose,
     )
+    if profiler is not None:
+        profiler.close()
 
     sentences = results["sentences"]
     sentences_log_p = results["sentences_log_p"]
@@ -152,9 +158,6 @@ def synthesize_controversial_sentence_pair(
         line = ",".join(map(str, outputs))
         exclusive_write_line(results_csv_fname, line)
 
-    if history_csv_fname is not None:
-        results["history"].to_csv(history_csv_fname)
-
 
 if __name__ == "__main__":
     all_model_names = [
@@ -205,6 +208,12 @@ if __name__ == "__main__":
         help="The file to save the optimization history to (optional).",
     )
 
+    parser.add_argument(
+        "--profile_trace_fname",
+        type=str,
+        help="Profile the optimization and write a JSONL trace of its phases to this file (optional).",
+    )
+
     args = parser.parse_args()
 
     synthesize_controversial_sentence_pair(
@@ -213,4 +222,5 @@ if __name__ == "__main__":
         initial_sentence=args.initial_sentence,
         results_csv_fname=args.results_csv_fname,
         history_csv_fname=args.history_csv_fname,
+        profile_trace_fname=args.profile_trace_fname,
     )
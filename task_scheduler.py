@@ -11,10 +11,10 @@
 ## A simple example (uncomment the code below to try it out)
 #
 ## We start a new database.
-## Here, we define that if a job runs for more than 6 hours it is considered lost and is restarted.
+## Here, we define that if a job's lease is not renewed for 15 minutes, the job is considered lost and is restarted.
 #
 # import numpy as np
-# sch=TaskScheduler(db_path='/home/tal/scheduler.db',max_job_time_in_seconds=6*3600)
+# sch=TaskScheduler(db_path='/home/tal/scheduler.db',lease_time_in_seconds=15*60)
 #
 # for gamma in [-1e3,1,1e5]:
 #    for category in ['cats','dogs']:
@@ -24,112 +24,367 @@
 #            # the job already started / completed. skip to the next loop
 #            continue
 #
-#        # computation comes here
+#        # computation comes here. a long computation should renew the job's lease periodically:
+#        # sch.renew_leases([job_id]) (or call a JobLeaseHeartbeat's stopping check, see below)
 #        results=np.random.uniform(size=(4,2))
 #
 #        # we are done. let's set the 'done' flag.
 #        sch.job_done(job_id,results=results) # saving results is optional. they are converted to string.
 #
+## alternatively, claim_next_job picks the next job of the group with the fewest completed or running jobs:
+#
+# candidates={category:[{'gamma':gamma,'category':category} for gamma in [-1e3,1,1e5]] for category in ['cats','dogs']}
+# claimed=sch.claim_next_job(candidates) # (category, job_id), or None if all jobs were started
+#
+## while the job runs, a heartbeat renews its lease, and tells if the lease was lost (e.g., the job was restarted elsewhere).
+## its stopping checks can be passed to optimize_sentence_set as external_stopping_check:
+#
+# heartbeat=JobLeaseHeartbeat(sch,[claimed[1]])
+# external_stopping_check=heartbeat.get_stopping_check(claimed[1]) # renews the leases, returns True if the lease was lost
+#
 ## if we are done, read the table to pandas:
 # DF=sch.to_pandas()
 # print(DF)
 
 import sqlite3
-import json, os, time, math
+import json, os, time, math, random, socket, uuid
 import pandas as pd
 
 
 class TaskScheduler:
-    def __init__(self, db_path="scheduler.db", max_job_time_in_seconds=12 * 3600):
+    def __init__(
+        self,
+        db_path="scheduler.db",
+        lease_time_in_seconds=15 * 60,
+        timeout=600,
+        max_retries=10,
+        journal_mode="WAL",
+    ):
+        """
+        args:
+            db_path: path of the sqlite database (created if it does not exist)
+            lease_time_in_seconds: an incompleted job whose lease was not renewed (see renew_leases) for this long
+                is considered lost and can be restarted
+            timeout: seconds to wait for a lock held by another process (sqlite's busy timeout)
+            max_retries: number of times a transaction that still failed with 'database is locked' is retried
+                (after a random, exponentially growing delay) before the error is raised
+            journal_mode: sqlite journal mode. 'WAL' allows reading while another process writes,
+                but requires a file system with working shared memory. Use 'DELETE' on network file systems.
+        """
         self.db_path = db_path
-        self.max_job_time_in_seconds = max_job_time_in_seconds
+        self.lease_time_in_seconds = lease_time_in_seconds
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.journal_mode = journal_mode
+        self.worker_id = uuid.uuid4().hex  # identifies the leases held by this scheduler
+        self._conn = None
+        self._conn_pid = None
+
+        def create_table(conn):
+            # also adds the columns missing from a table created by an older version
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS jobs
+                 (job_id TEXT UNIQUE, is_completed BOOLEAN, time_started INTEGER, results TEXT, job_group TEXT,
+                 time_renewed INTEGER, lease_owner TEXT)"""
+            )
+            columns = [row[1] for row in conn.execute("PRAGMA table_info(jobs)")]
+            for column, column_type in [
+                ("job_group", "TEXT"),
+                ("time_renewed", "INTEGER"),
+                ("lease_owner", "TEXT"),
+            ]:
+                if column not in columns:
+                    conn.execute(f"ALTER TABLE jobs ADD COLUMN {column} {column_type}")
+            if "job_group" not in columns:
+                # jobs started by an older version have no group. jobs of model pairs (job ids with model_1 and model_2
+                # fields, as started by batch_synthesize_controversial_pairs.py) get the group key the batch script
+                # passes to claim_next_jobs, so they are counted as served.
+                rows = []
+                for rowid, job_id_json in conn.execute("SELECT rowid, job_id FROM jobs"):
+                    try:
+                        job_id = json.loads(job_id_json)
+                    except ValueError:
+                        continue
+                    if (
+                        isinstance(job_id, dict)
+                        and "model_1" in job_id
+                        and "model_2" in job_id
+                    ):
+                        job_group = (job_id["model_1"], job_id["model_2"])
+                        rows.append((json.dumps(job_group), rowid))
+                conn.executemany("UPDATE jobs SET job_group = ? WHERE rowid = ?", rows)
+            # covers the per-group counts of claim_next_jobs, so they don't read the (large) results
+            conn.execute("DROP INDEX IF EXISTS jobs_by_group")
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS jobs_by_group_and_lease ON jobs (job_group, is_completed, time_renewed, time_started)"
+            )
 
-        if not os.path.isfile(self.db_path):
-            conn = sqlite3.connect(self.db_path)
-            c = conn.cursor()
+        # in one transaction, so concurrently starting workers don't race
+        self._run_transaction(create_table)
 
-            # Create table
-            c.execute(
-                """CREATE TABLE jobs
-                 (job_id TEXT UNIQUE, is_completed BOOLEAN, time_started INTEGER, results TEXT)"""
+    def _get_lease_owner(self):
+        # unique per process, in case the scheduler is copied to forked processes
+        return f"{socket.gethostname()}:{os.getpid()}:{self.worker_id}"
+
+    def _connect(self):
+        # one connection per process (sqlite connections must not be shared across forked processes).
+        # transactions are managed explicitly (see _run_transaction).
+        if self._conn is None or self._conn_pid != os.getpid():
+            self._conn = sqlite3.connect(
+                self.db_path, timeout=self.timeout, isolation_level=None
+            )
+            self._run_with_retries(
+                lambda: self._conn.execute(f"PRAGMA journal_mode={self.journal_mode}")
             )
+            self._conn_pid = os.getpid()
+        return self._conn
+
+    def close(self):
+        if self._conn is not None and self._conn_pid == os.getpid():
+            self._conn.close()
+        self._conn = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_conn"] = None
+        state["_conn_pid"] = None
+        return state
+
+    def _run_with_retries(self, func):
+        # sqlite gives up waiting for a lock after the busy timeout, and in some cases (e.g., WAL recovery)
+        # fails with 'database is locked' without waiting at all. such failures are retried.
+        for i_retry in range(self.max_retries + 1):
+            try:
+                return func()
+            except sqlite3.OperationalError as e:
+                is_busy = "locked" in str(e) or "busy" in str(e)
+                if not is_busy or i_retry == self.max_retries:
+                    raise
+                time.sleep(random.uniform(0, min(0.05 * 2 ** i_retry, 10.0)))
 
-            conn.commit()  # Save (commit) the changes
-            conn.close()
+    def _run_transaction(self, func):
+        """run func(conn) in a BEGIN IMMEDIATE transaction (retried if the database is locked), return its output"""
+
+        def transaction():
+            conn = self._connect()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                output = func(conn)
+                conn.execute("COMMIT")
+            except BaseException:
+                if conn.in_transaction:
+                    conn.execute("ROLLBACK")
+                raise
+            return output
+
+        return self._run_with_retries(transaction)
 
     def _execute_sqlite(self, query, parameters=None):
         if parameters is None:
             parameters = ()
-        conn = sqlite3.connect(self.db_path)
-        c = conn.cursor()
         try:
-            c.execute(query, parameters)
-            conn.commit()  # Save (commit) the changes
+            self._run_transaction(lambda conn: conn.execute(query, parameters))
             success = True
-        except Exception as e:
+        except sqlite3.IntegrityError as e:
             if (
                 str(e) != "UNIQUE constraint failed: jobs.job_id"
             ):  # show error, unless it's a duplicate unique job_id
                 print("sqlite error:", str(e))
-                print(str(e))
             success = False
-        finally:
-            conn.close()
         return success
 
     def _sqlite_fetchone(self, query, parameters=None):
         if parameters is None:
             parameters = ()
-        conn = sqlite3.connect(self.db_path)
-        c = conn.cursor()
-        try:
-            c.execute(query, parameters)
-            fetched = c.fetchone()[0]
-        except Exception as e:
-            print("sqlite error:", str(e))
-            fetched = None
-        finally:
-            conn.close()
-        return fetched
+        conn = self._connect()
+        row = self._run_with_retries(lambda: conn.execute(query, parameters).fetchone())
+        return None if row is None else row[0]
 
     def start_job(self, job_id):
-        job_id_json = json.dumps(job_id)
-        time_started = math.ceil(time.time())
-
-        # delete old incompleted jobs
-        self._execute_sqlite(
-            "DELETE FROM jobs WHERE (job_id = ? AND time_started < ? AND is_completed = 0)",
-            (job_id_json, time_started - self.max_job_time_in_seconds),
-        )
-
-        # try inserting new job
-        success = self._execute_sqlite(
-            "INSERT INTO jobs (job_id, is_completed, time_started) VALUES (?, 0, ?)",
-            (job_id_json, time_started),
-        )
+        success = self.start_jobs([job_id])[0]
 
         # when failed, provide feedback
         if success == False:
             is_completed = self._sqlite_fetchone(
-                "SELECT is_completed FROM jobs WHERE job_id = ?", (job_id_json,)
+                "SELECT is_completed FROM jobs WHERE job_id = ?", (json.dumps(job_id),)
             )
             if is_completed:
-                print("{} job already completed.".format(job_id_json))
+                print("{} job already completed.".format(json.dumps(job_id)))
             else:
-                print("{} job already started.".format(job_id_json))
+                print("{} job already started.".format(json.dumps(job_id)))
         return success
 
+    def start_jobs(self, job_ids, job_group=None):
+        """start several jobs in a single transaction.
+
+        returns a list of bools, False for jobs that are already completed or running.
+        """
+        job_ids_json = [json.dumps(job_id) for job_id in job_ids]
+        job_group_json = None if job_group is None else json.dumps(job_group)
+
+        def start(conn):
+            time_started = math.ceil(time.time())
+            successes = []
+            for job_id_json in job_ids_json:
+                # delete incompleted jobs with expired leases
+                conn.execute(
+                    "DELETE FROM jobs WHERE (job_id = ? AND COALESCE(time_renewed, time_started) < ? AND is_completed = 0)",
+                    (job_id_json, time_started - self.lease_time_in_seconds),
+                )
+                # try inserting new job
+                cursor = conn.execute(
+                    "INSERT OR IGNORE INTO jobs (job_id, is_completed, time_started, job_group, time_renewed, lease_owner) "
+                    "VALUES (?, 0, ?, ?, ?, ?)",
+                    (
+                        job_id_json,
+                        time_started,
+                        job_group_json,
+                        time_started,
+                        self._get_lease_owner(),
+                    ),
+                )
+                successes.append(cursor.rowcount == 1)
+            return successes
+
+        return self._run_transaction(start)
+
+    def claim_next_job(self, candidate_filter):
+        """claim the next job of the least-served group of candidate jobs (see claim_next_jobs).
+
+        returns (group key, job id) of the claimed job, or None if all of the candidate jobs are completed or running.
+        """
+        claimed = self.claim_next_jobs(candidate_filter, n_jobs=1)
+        if claimed is None:
+            return None
+        group, job_ids = claimed
+        return group, job_ids[0]
+
+    def claim_next_jobs(self, candidate_filter, n_jobs=1):
+        """claim the next jobs (up to n_jobs, all of the same group) of the least-served group of candidate jobs.
+
+        the groups are counted, and the jobs are selected and reserved, in a single (BEGIN IMMEDIATE) transaction,
+        so concurrent workers never claim the same job.
+
+        args:
+            candidate_filter (dict) mapping group keys (JSONable, e.g., model pairs) to sequences of candidate job ids,
+                in order of preference. groups with equally many completed or running jobs are tried in the dict's order.
+            n_jobs (int) maximal number of jobs to claim
+
+        returns (group key, list of job ids) of the claimed jobs, or None if all of the candidate jobs are completed or running.
+        """
+
+        def claim(conn):
+            time_started = math.ceil(time.time())
+            expiry_time = time_started - self.lease_time_in_seconds
+            n_jobs_per_group = {}
+            for group in candidate_filter:
+                n_jobs_per_group[group] = conn.execute(
+                    "SELECT COUNT(*) FROM jobs WHERE "
+                    "(job_group = ? AND (is_completed = 1 OR COALESCE(time_renewed, time_started) >= ?))",
+                    (json.dumps(group), expiry_time),
+                ).fetchone()[0]
+            groups = sorted(candidate_filter, key=lambda group: n_jobs_per_group[group])
+            for group in groups:
+                claimed_job_ids = []
+                for job_id in candidate_filter[group]:
+                    job_id_json = json.dumps(job_id)
+                    row = conn.execute(
+                        "SELECT is_completed, COALESCE(time_renewed, time_started) FROM jobs WHERE job_id = ?",
+                        (job_id_json,),
+                    ).fetchone()
+                    if row is not None:
+                        is_completed, job_time_renewed = row
+                        if (
+                            is_completed
+                            or job_time_renewed is None
+                            or job_time_renewed >= expiry_time
+                        ):
+                            continue  # completed or running
+                        # an incompleted job with an expired lease
+                        conn.execute("DELETE FROM jobs WHERE job_id = ?", (job_id_json,))
+                    conn.execute(
+                        "INSERT INTO jobs (job_id, is_completed, time_started, job_group, time_renewed, lease_owner) "
+                        "VALUES (?, 0, ?, ?, ?, ?)",
+                        (
+                            job_id_json,
+                            time_started,
+                            json.dumps(group),
+                            time_started,
+                            self._get_lease_owner(),
+                        ),
+                    )
+                    claimed_job_ids.append(job_id)
+                    if len(claimed_job_ids) >= n_jobs:
+                        break
+                if len(claimed_job_ids) > 0:
+                    return group, claimed_job_ids
+            return None
+
+        return self._run_transaction(claim)
+
+    def renew_leases(self, job_ids):
+        """renew the leases of running jobs started by this scheduler (in a single transaction).
+
+        returns a list of the job ids whose lease was lost: the job was completed, or its lease expired and it was
+        restarted by another worker (or deleted). such jobs should be abandoned.
+        """
+        job_ids_json = [json.dumps(job_id) for job_id in job_ids]
+
+        def renew(conn):
+            time_renewed = math.ceil(time.time())
+            lost_job_ids = []
+            for job_id, job_id_json in zip(job_ids, job_ids_json):
+                cursor = conn.execute(
+                    "UPDATE jobs SET time_renewed = ? WHERE (job_id = ? AND is_completed = 0 AND lease_owner = ?)",
+                    (time_renewed, job_id_json, self._get_lease_owner()),
+                )
+                if cursor.rowcount == 0:
+                    lost_job_ids.append(job_id)
+            return lost_job_ids
+
+        return self._run_transaction(renew)
+
     def job_done(self, job_id, results=None):
+        """mark a job as completed. returns False if its lease was lost (see jobs_done)"""
+        lost_job_ids = self.jobs_done([job_id], None if results is None else [results])
+        return len(lost_job_ids) == 0
+
+    def jobs_done(self, job_ids, results=None):
+        """mark several jobs as completed in a single transaction (results: None, or a list aligned with job_ids).
+
+        a job is only marked as completed while this scheduler holds its lease (or if it was never started).
+        returns a list of the job ids whose lease was lost (completed or restarted by another worker): they are
+        not marked as completed, so the results of the worker that holds the job are not overwritten.
+        """
         if results is None:
-            self._execute_sqlite(
-                "INSERT OR REPLACE INTO jobs (job_id,is_completed) VALUES(?, 1)",
-                (json.dumps(job_id),),
-            )
-        else:
-            self._execute_sqlite(
-                "INSERT OR REPLACE INTO jobs (job_id,is_completed,results) VALUES(?, 1,?)",
-                (json.dumps(job_id), str(results)),
-            )
+            results = [None] * len(job_ids)
+        assert len(results) == len(job_ids)
+
+        def mark_done(conn):
+            lost_job_ids = []
+            for job_id, job_results in zip(job_ids, results):
+                job_id_json = json.dumps(job_id)
+                job_results = None if job_results is None else str(job_results)
+                # jobs started by an older version have no lease owner
+                cursor = conn.execute(
+                    "UPDATE jobs SET is_completed = 1, results = ? WHERE "
+                    "(job_id = ? AND is_completed = 0 AND (lease_owner = ? OR lease_owner IS NULL))",
+                    (job_results, job_id_json, self._get_lease_owner()),
+                )
+                if cursor.rowcount == 1:
+                    continue
+                cursor = conn.execute(
+                    "INSERT OR IGNORE INTO jobs (job_id, is_completed, results) VALUES (?, 1, ?)",
+                    (job_id_json, job_results),
+                )
+                if cursor.rowcount == 0:
+                    lost_job_ids.append(job_id)
+            return lost_job_ids
+
+        lost_job_ids = self._run_transaction(mark_done)
+        for job_id in lost_job_ids:
+            print("{} job lease lost, not marked as completed.".format(json.dumps(job_id)))
+        return lost_job_ids
 
     def delete_job(self, job_id):
         self._execute_sqlite(
@@ -144,16 +399,61 @@ class TaskScheduler:
     def to_pandas(
         self,
     ):
-        conn = sqlite3.connect(self.db_path)
-        try:
-            df = pd.read_sql_query("SELECT * FROM jobs", conn)
-        except Exception as e:
-            print("sqlite error:", str(e))
-            df = None
-        finally:
-            conn.close()
+        def read_jobs():
+            cursor = self._connect().execute("SELECT * FROM jobs")
+            rows = cursor.fetchall()
+            return pd.DataFrame(rows, columns=[d[0] for d in cursor.description])
+
+        df = self._run_with_retries(read_jobs)
         try:
             df["job_id"] = [json.loads(s) for s in df["job_id"]]
         except:
             pass
         return df
+
+
+class JobLeaseHeartbeat:
+    """Renews the leases of running jobs, at most once every interval_in_seconds.
+
+    Its stopping checks (see get_stopping_check) are meant to be called frequently (e.g., as the external_stopping_check
+    of optimize_sentence_set, which is called at every optimization step), so the leases are kept alive for as long
+    as the jobs are running, and a job whose lease was lost is abandoned instead of being run twice.
+    """
+
+    def __init__(self, scheduler, job_ids, interval_in_seconds=None):
+        """
+        args:
+            scheduler: the TaskScheduler that started the jobs
+            job_ids: list of job ids
+            interval_in_seconds: minimal time between renewals (default: a fifth of the scheduler's lease time)
+        """
+        if interval_in_seconds is None:
+            interval_in_seconds = scheduler.lease_time_in_seconds / 5
+        self.scheduler = scheduler
+        self.job_ids = list(job_ids)
+        self.interval_in_seconds = interval_in_seconds
+        self.lost_job_ids = set()
+        self.last_renewal_time = time.monotonic()  # the jobs were just started
+
+    def renew(self):
+        """renew the leases now. returns a list of the job ids whose lease was lost"""
+        job_ids = [job_id for job_id in self.job_ids if not self.is_lost(job_id)]
+        lost_job_ids = self.scheduler.renew_leases(job_ids)
+        for job_id in lost_job_ids:
+            print("{} job lease lost.".format(json.dumps(job_id)))
+            self.lost_job_ids.add(json.dumps(job_id))
+        self.last_renewal_time = time.monotonic()
+        return [job_id for job_id in self.job_ids if self.is_lost(job_id)]
+
+    def is_lost(self, job_id):
+        return json.dumps(job_id) in self.lost_job_ids
+
+    def get_stopping_check(self, job_id):
+        """return a function (no args) that renews the leases when due, and returns True if job_id's lease was lost"""
+
+        def stopping_check():
+            if time.monotonic() - self.last_renewal_time >= self.interval_in_seconds:
+                self.renew()
+            return self.is_lost(job_id)
+
+        return stopping_check
@@ -0,0 +1,51 @@
+import os
+import sys
+
+import pytest
+
+repo_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo_root)
+
+pytest.importorskip("torch")
+pytest.importorskip("transformers")
+pytest.importorskip("knlm")
+
+from model_functions import model_factory
+from sentence_optimization import optimize_sentence_set, controversiality_loss_func
+from sentence_prob_store import SentenceProbabilityStore, get_model_key
+from tiny_models import build_tiny_ngrams, default_txt_fname
+
+
+@pytest.fixture(scope="module")
+def tiny_checkpoint_folder(tmp_path_factory):
+    checkpoint_folder = str(tmp_path_factory.mktemp("tiny_model_checkpoints"))
+    build_tiny_ngrams(
+        checkpoint_folder, sentences_file=os.path.join(repo_root, default_txt_fname)
+    )
+    return checkpoint_folder
+
+
+def test_optimize_sentence_set_with_store_and_concurrent_models(
+    tiny_checkpoint_folder, tmp_path
+):
+    # the models are evaluated on worker threads, so the store must not share one sqlite connection across threads
+    store = SentenceProbabilityStore(str(tmp_path / "sentence_log_probs.db"))
+    models = [
+        model_factory(
+            name, None, sent_prob_store=store, checkpoint_folder=tiny_checkpoint_folder
+        )
+        for name in ["bigram", "trigram"]
+    ]
+    results = optimize_sentence_set(
+        2,
+        models,
+        controversiality_loss_func,
+        sent_length_in_words=5,
+        sentences_to_change=[1],
+        max_steps=5,
+        concurrent_models=True,
+        verbose=0,
+    )
+    assert results is not False
+    for name in ["bigram", "trigram"]:
+        assert store.count(get_model_key(name, tiny_checkpoint_folder)) > 0
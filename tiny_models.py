@@ -0,0 +1,568 @@
+# Randomly initialized, small stand-ins for the checkpoints of model_factory, for offline (CPU) development and benchmarks.
+#
+# every architecture family (BERT, RoBERTa, XLM, ELECTRA, GPT-2) gets a small config and a tokenizer built locally from
+# the vocabulary (vocabulary.py), the recurrent models get small state dicts (and a word2id dictionary),
+# and the n-gram models are trained on the natural sentence corpus. nothing is downloaded.
+#
+# build the stand-ins (run from the repository root):
+# python tiny_models.py --checkpoint_folder tiny_model_checkpoints
+#
+# then load them with model_factory(name, gpu_id, checkpoint_folder="tiny_model_checkpoints"),
+# or set the environment variable CONTSTIMLANG_CHECKPOINT_FOLDER=tiny_model_checkpoints.
+#
+# the stand-ins score sentences with the same code paths (tokenization, batching, word_probs and sent_prob implementations)
+# as the real models, but their outputs are meaningless.
+
+import os
+import json
+import math
+import pickle
+import random
+import string
+import pathlib
+import argparse
+import itertools
+
+from vocabulary import vocab_low, vocab_cap
+from sentence_prob_store import get_checkpoint_path
+
+default_txt_fname = os.path.join(
+    "resources",
+    "sentence_corpora",
+    "natural_sentences_for_synthetic_controversial_sentence_pair_optimization.txt",
+)
+
+# characters every tokenizer can represent on their own (in addition to the characters of the vocabulary)
+base_characters = string.ascii_letters + string.digits + string.punctuation
+
+
+def get_word_segments(word, max_segment_length):
+    """split a word into the fewest segments of (nearly) equal length that are at most max_segment_length long.
+
+    segments are the tokens a word is split into, so longer words are split into several tokens (as in the real tokenizers),
+    and the number of tokens per word is bounded (get_token_info enumerates all of the orders of a word's tokens).
+    """
+    n_segments = math.ceil(len(word) / max_segment_length)
+    bounds = [round(i * len(word) / n_segments) for i in range(n_segments + 1)]
+    return [word[start:end] for start, end in zip(bounds[:-1], bounds[1:])]
+
+
+def bytes_to_unicode():
+    """the byte -> unicode character map of GPT-2's byte-level BPE (printable characters represent themselves)"""
+    bs = (
+        list(range(ord("!"), ord("~") + 1))
+        + list(range(ord("¡"), ord("¬") + 1))
+        + list(range(ord("®"), ord("ÿ") + 1))
+    )
+    cs = bs[:]
+    n = 0
+    for b in range(2 ** 8):
+        if b not in bs:
+            bs.append(b)
+            cs.append(2 ** 8 + n)
+            n += 1
+    return dict(zip(bs, [chr(c) for c in cs]))
+
+
+def bpe(symbols, merge_ranks):
+    """apply BPE merges to a sequence of symbols, as the GPT-2 and XLM tokenizers do (lowest-ranked pair first)"""
+    word = tuple(symbols)
+    while len(word) > 1:
+        pairs = set(zip(word[:-1], word[1:]))
+        first, second = min(pairs, key=lambda pair: merge_ranks.get(pair, math.inf))
+        if (first, second) not in merge_ranks:
+            break
+        new_word = []
+        i = 0
+        while i < len(word):
+            if i < len(word) - 1 and word[i] == first and word[i + 1] == second:
+                new_word.append(first + second)
+                i += 2
+            else:
+                new_word.append(word[i])
+                i += 1
+        word = tuple(new_word)
+    return word
+
+
+def learn_bpe_merges(segmented_words):
+    """learn BPE merges under which each word is split into at most as many tokens as it has segments.
+
+    each word is tokenized with the merges learned so far, and merges are appended until it is split finely enough.
+    appended merges have the lowest priority, so they can only join the tokens of previously processed words further.
+
+    args:
+        segmented_words (list) of words, each given as a list of segments, each a tuple of symbols
+
+    returns a list of merges (pairs of symbols), by priority
+    """
+    merges = []
+    merge_ranks = dict()
+    for segments in segmented_words:
+        symbols = tuple(itertools.chain(*segments))
+        boundaries = set(
+            itertools.accumulate(len("".join(segment)) for segment in segments[:-1])
+        )  # in characters
+        tokens = bpe(symbols, merge_ranks)
+        while len(tokens) > len(segments):
+            # join the last pair of adjacent tokens that are in the same segment (or the last pair, if there is none)
+            token_ends = list(itertools.accumulate(len(token) for token in tokens))
+            i_token = next(
+                (
+                    i
+                    for i in range(len(tokens) - 2, -1, -1)
+                    if token_ends[i] not in boundaries
+                ),
+                len(tokens) - 2,
+            )
+            pair = (tokens[i_token], tokens[i_token + 1])
+            merge_ranks[pair] = len(merges)
+            merges.append(pair)
+            tokens = bpe(symbols, merge_ranks)
+    return merges
+
+
+def wordpiece_tokenize(word, vocab):
+    """greedy longest-match-first tokenization of a word, as the BERT tokenizer does (returns None for an unknown word)"""
+    tokens = []
+    start = 0
+    while start < len(word):
+        end = len(word)
+        while end > start:
+            token = word[start:end] if start == 0 else "##" + word[start:end]
+            if token in vocab:
+                break
+            end -= 1
+        if end == start:
+            return None
+        tokens.append(token)
+        start = end
+    return tokens
+
+
+def build_wordpiece_vocab(words, max_segment_length=8, max_passes=10):
+    """build a WordPiece vocabulary (a list of tokens) in which each word is split into its segments (see get_word_segments)
+
+    a word can be tokenized into a longer first token than its first segment (another word that is a prefix of it),
+    leaving a remainder without a matching token. such remainders are added until every word is split into at most
+    as many tokens as it has segments.
+    """
+    vocab = ["[PAD]", "[UNK]", "[CLS]", "[SEP]", "[MASK]"]
+    characters = sorted(set(base_characters) | set("".join(words)))
+    vocab += characters + ["##" + c for c in characters]
+    for word in words:
+        segments = get_word_segments(word, max_segment_length)
+        vocab += [segments[0]] + ["##" + segment for segment in segments[1:]]
+    vocab = list(dict.fromkeys(vocab))  # unique, in order
+
+    vocab_set = set(vocab)
+    for _ in range(max_passes):
+        n_added_tokens = 0
+        for word in words:
+            n_segments = len(get_word_segments(word, max_segment_length))
+            tokens = wordpiece_tokenize(word, vocab_set)
+            if len(tokens) > n_segments:
+                remainder = "".join(
+                    token.lstrip("#") for token in tokens[n_segments - 1 :]
+                )
+                token = remainder if n_segments == 1 else "##" + remainder
+                if token not in vocab_set:
+                    vocab.append(token)
+                    vocab_set.add(token)
+                    n_added_tokens += 1
+        if n_added_tokens == 0:
+            break
+    return vocab
+
+
+def build_byte_level_bpe(words, max_segment_length=8):
+    """build the vocabulary (a list of tokens) and merges of a byte-level BPE tokenizer (GPT-2 and RoBERTa)
+
+    both the words and the words preceded by a space are split into their segments (see get_word_segments):
+    GPT-2 scores words following a space, and RoBERTa also tokenizes the words on their own (see get_token_info).
+    """
+    byte_encoder = bytes_to_unicode()
+    space = byte_encoder[ord(" ")]
+    segmented_words = []
+    for word in words:
+        segments = [
+            tuple(byte_encoder[b] for b in segment.encode("utf-8"))
+            for segment in get_word_segments(word, max_segment_length)
+        ]
+        segmented_words.append(segments)
+        segmented_words.append([(space,) + segments[0]] + segments[1:])
+    # the words on their own first, so the merges forming them can be reused by the words preceded by a space
+    segmented_words = segmented_words[0::2] + segmented_words[1::2]
+    merges = learn_bpe_merges(segmented_words)
+    vocab = list(byte_encoder.values()) + [first + second for first, second in merges]
+    return list(dict.fromkeys(vocab)), merges
+
+
+def build_xlm_bpe(words, max_segment_length=8):
+    """build the vocabulary (a list of tokens) and merges of an XLM BPE tokenizer (the last symbol of a word ends with '</w>')"""
+    segmented_words = []
+    for word in words:
+        segments = [
+            tuple(segment) for segment in get_word_segments(word, max_segment_length)
+        ]
+        segments[-1] = segments[-1][:-1] + (segments[-1][-1] + "</w>",)
+        segmented_words.append(segments)
+    merges = learn_bpe_merges(segmented_words)
+    characters = sorted(set(base_characters) | set("".join(words)))
+    vocab = (
+        characters
+        + [c + "</w>" for c in characters]
+        + [first + second for first, second in merges]
+    )
+    return list(dict.fromkeys(vocab)), merges
+
+
+def write_json(obj, fname):
+    with open(fname, "w", encoding="utf-8") as f:
+        json.dump(obj, f, ensure_ascii=False)
+
+
+def write_lines(lines, fname, header=None):
+    with open(fname, "w", encoding="utf-8") as f:
+        if header is not None:
+            f.write(header + "\n")
+        for line in lines:
+            f.write(line + "\n")
+
+
+def build_tokenizer(family, target_folder, words, max_segment_length=8):
+    """build the tokenizer of an architecture family from a list of words, and save it to target_folder.
+
+    returns the tokenizer
+    """
+    from transformers import (
+        BertTokenizer,
+        ElectraTokenizer,
+        GPT2Tokenizer,
+        RobertaTokenizer,
+        XLMTokenizer,
+    )
+
+    pathlib.Path(target_folder).mkdir(parents=True, exist_ok=True)
+    vocab_file = os.path.join(target_folder, "vocab.txt")
+    vocab_json_file = os.path.join(target_folder, "vocab.json")
+    merges_file = os.path.join(target_folder, "merges.txt")
+
+    if family == "bert":  # cased
+        write_lines(build_wordpiece_vocab(words, max_segment_length), vocab_file)
+        tokenizer = BertTokenizer(vocab_file, do_lower_case=False)
+    elif family == "electra":  # uncased
+        words = sorted(set(word.lower() for word in words))
+        write_lines(build_wordpiece_vocab(words, max_segment_length), vocab_file)
+        tokenizer = ElectraTokenizer(vocab_file, do_lower_case=True)
+    elif family in ["gpt2", "roberta"]:
+        vocab, merges = build_byte_level_bpe(words, max_segment_length)
+        if family == "gpt2":
+            vocab = vocab + ["<|endoftext|>"]
+        else:
+            vocab = ["<s>", "<pad>", "</s>", "<unk>"] + vocab + ["<mask>"]
+        write_json({token: i for i, token in enumerate(vocab)}, vocab_json_file)
+        write_lines(
+            [" ".join(merge) for merge in merges], merges_file, header="#version: 0.2"
+        )
+        if family == "gpt2":
+            tokenizer = GPT2Tokenizer(vocab_json_file, merges_file)
+        else:
+            tokenizer = RobertaTokenizer(vocab_json_file, merges_file)
+    elif family == "xlm":  # lowercased (and accents removed) before BPE, as xlm-mlm-en-2048
+        words = sorted(set(word.lower() for word in words))
+        vocab, merges = build_xlm_bpe(words, max_segment_length)
+        special_tokens = ["<s>", "</s>", "<pad>", "<unk>"] + [
+            f"<special{i}>" for i in range(10)
+        ]
+        write_json(
+            {token: i for i, token in enumerate(special_tokens + vocab)},
+            vocab_json_file,
+        )
+        write_lines([" ".join(merge) for merge in merges], merges_file)
+        tokenizer = XLMTokenizer(
+            vocab_json_file, merges_file, do_lowercase_and_remove_accent=True
+        )
+    else:
+        raise ValueError(f"Architecture family {family} not found")
+
+    tokenizer.save_pretrained(target_folder)
+    return tokenizer
+
+
+def build_transformer(
+    family,
+    tokenizer,
+    hidden_size=64,
+    n_layers=2,
+    n_heads=2,
+    max_length=128,
+    init_std=0.5,
+):
+    """return a randomly initialized model of an architecture family with a small config
+
+    args:
+        family (str) 'bert', 'electra', 'roberta', 'xlm' or 'gpt2'
+        tokenizer: the tokenizer of the model (see build_tokenizer)
+        hidden_size, n_layers, n_heads (int) size of the model
+        max_length (int) maximal number of tokens in a sequence
+        init_std (float) standard deviation of the initial weights. it is larger than the configs' default (0.02),
+            so the predicted token distributions are about as peaked as those of trained models
+            (an entropy of a few nats rather than a uniform distribution). this matters for performance,
+            since some word_probs implementations only evaluate the words whose first token is probable.
+    """
+    import transformers
+
+    vocab_size = len(tokenizer)
+    if family == "bert":
+        config = transformers.BertConfig(
+            vocab_size=vocab_size,
+            hidden_size=hidden_size,
+            num_hidden_layers=n_layers,
+            num_attention_heads=n_heads,
+            intermediate_size=4 * hidden_size,
+            max_position_embeddings=max_length,
+            initializer_range=init_std,
+        )
+        return transformers.BertForMaskedLM(config)
+    elif family == "electra":
+        config = transformers.ElectraConfig(
+            vocab_size=vocab_size,
+            embedding_size=hidden_size,
+            hidden_size=hidden_size,
+            num_hidden_layers=n_layers,
+            num_attention_heads=n_heads,
+            intermediate_size=4 * hidden_size,
+            max_position_embeddings=max_length,
+            initializer_range=init_std,
+        )
+        return transformers.ElectraForMaskedLM(config)
+    elif family == "roberta":
+        config = transformers.RobertaConfig(
+            vocab_size=vocab_size,
+            hidden_size=hidden_size,
+            num_hidden_layers=n_layers,
+            num_attention_heads=n_heads,
+            intermediate_size=4 * hidden_size,
+            max_position_embeddings=max_length + 2,  # RoBERTa's positions start after the padding index
+            type_vocab_size=1,
+            pad_token_id=tokenizer.pad_token_id,
+            bos_token_id=tokenizer.bos_token_id,
+            eos_token_id=tokenizer.eos_token_id,
+            initializer_range=init_std,
+        )
+        return transformers.RobertaForMaskedLM(config)
+    elif family == "xlm":
+        config = transformers.XLMConfig(
+            vocab_size=vocab_size,
+            emb_dim=hidden_size,
+            n_layers=n_layers,
+            n_heads=n_heads,
+            max_position_embeddings=max_length,
+            bos_index=tokenizer.bos_token_id,
+            eos_index=tokenizer.eos_token_id,
+            pad_index=tokenizer.pad_token_id,
+            unk_index=tokenizer.unk_token_id,
+            mask_index=tokenizer.mask_token_id,
+            embed_init_std=init_std,
+            init_std=init_std,
+        )
+        return transformers.XLMWithLMHeadModel(config)
+    elif family == "gpt2":
+        config = transformers.GPT2Config(
+            vocab_size=vocab_size,
+            n_positions=max_length,
+            n_ctx=max_length,
+            n_embd=hidden_size,
+            n_layer=n_layers,
+            n_head=n_heads,
+            bos_token_id=tokenizer.eos_token_id,
+            eos_token_id=tokenizer.eos_token_id,
+            initializer_range=init_std,
+        )
+        return transformers.GPT2LMHeadModel(config)
+    else:
+        raise ValueError(f"Architecture family {family} not found")
+
+
+# the pretrained checkpoints of model_factory and their architecture families
+pretrained_checkpoint_families = {
+    "bert-large-cased": "bert",
+    "bert-large-cased-whole-word-masking": "bert",
+    "roberta-large": "roberta",
+    "xlm-mlm-en-2048": "xlm",
+    "google/electra-large-generator": "electra",
+    "gpt2-xl": "gpt2",
+}
+
+
+def build_tiny_transformers(
+    checkpoint_folder,
+    hidden_size=64,
+    n_layers=2,
+    n_heads=2,
+    max_segment_length=8,
+    init_std=0.5,
+    seed=0,
+):
+    """save a randomly initialized stand-in (model and tokenizer) for each pretrained checkpoint of model_factory"""
+    import torch
+
+    words = sorted(set(vocab_low) | set(vocab_cap))
+    tokenizers = dict()
+    for i_checkpoint, (checkpoint, family) in enumerate(
+        pretrained_checkpoint_families.items()
+    ):
+        target_folder = get_checkpoint_path(checkpoint, checkpoint_folder)
+        if family not in tokenizers:
+            tokenizers[family] = build_tokenizer(
+                family, target_folder, words, max_segment_length
+            )
+        else:  # checkpoints of the same family share the tokenizer (as bert-large-cased and its whole word masking variant)
+            tokenizers[family].save_pretrained(target_folder)
+        torch.manual_seed(seed + i_checkpoint)
+        model = build_transformer(
+            family,
+            tokenizers[family],
+            hidden_size=hidden_size,
+            n_layers=n_layers,
+            n_heads=n_heads,
+            init_std=init_std,
+        )
+        model.save_pretrained(target_folder)
+        print(
+            "saved {} ({} tokens, {:,} parameters) to {}".format(
+                checkpoint,
+                len(tokenizers[family]),
+                sum(p.numel() for p in model.parameters()),
+                target_folder,
+            )
+        )
+
+
+def build_tiny_rnns(checkpoint_folder, embed_size=16, hidden_size=32, seed=0):
+    """save a word2id dictionary of the vocabulary and randomly initialized bilstm, lstm and rnn state dicts"""
+    import torch
+
+    from recurrent_NNs import RNNLM, RNNLM_bilstm, RNNModel
+
+    pathlib.Path(checkpoint_folder).mkdir(parents=True, exist_ok=True)
+    words = sorted(set(vocab_low) | set(vocab_cap)) + ["."]
+    word2id = {word: i for i, word in enumerate(words)}
+    with open(
+        get_checkpoint_path(
+            os.path.join("model_checkpoints", "neuralnet_word2id_dict.pkl"),
+            checkpoint_folder,
+        ),
+        "wb",
+    ) as f:
+        pickle.dump(word2id, f)
+
+    torch.manual_seed(seed)
+    models = {
+        # the bidirectional model also embeds the [MASK] token, appended by model_functions.get_word2id_dict
+        "bilstm": RNNLM_bilstm(
+            vocab_size=len(word2id) + 1,
+            embed_size=embed_size,
+            hidden_size=hidden_size,
+            num_layers=1,
+        ),
+        "lstm": RNNLM(
+            vocab_size=len(word2id),
+            embed_size=embed_size,
+            hidden_size=hidden_size,
+            num_layers=1,
+        ),
+        "rnn": RNNModel(
+            vocab_size=len(word2id),
+            embed_size=embed_size,
+            hidden_size=hidden_size,
+            num_layers=1,
+        ),
+    }
+    for name, model in models.items():
+        fname = get_checkpoint_path(
+            os.path.join("model_checkpoints", f"{name}_state_dict.pt"), checkpoint_folder
+        )
+        torch.save(model.state_dict(), fname)
+        print("saved {} to {}".format(name, fname))
+
+
+def build_tiny_ngrams(checkpoint_folder, sentences_file=default_txt_fname, seed=0):
+    """train bigram and trigram models on the natural sentences, and on random sentences covering the vocabulary.
+
+    sentences are padded as bigram_sent_prob and trigram_sent_prob pad them.
+    """
+    from knlm import KneserNey
+
+    pathlib.Path(checkpoint_folder).mkdir(parents=True, exist_ok=True)
+    with open(sentences_file) as f:
+        sentences = [l.strip().rstrip(".").split() for l in f]
+    sentences = [sentence for sentence in sentences if len(sentence) > 0]
+
+    # every vocabulary word appears in at least one sentence (capitalized words at the start of a sentence)
+    rng = random.Random(seed)
+    shuffled_vocab_low = rng.sample(vocab_low, len(vocab_low))
+    n_words_per_sentence = 7
+    n_sentences = max(
+        math.ceil(len(vocab_low) / n_words_per_sentence), len(vocab_cap)
+    )
+    for i_sentence in range(n_sentences):
+        i_word = (i_sentence * n_words_per_sentence) % len(vocab_low)
+        sentences.append(
+            [vocab_cap[i_sentence % len(vocab_cap)]]
+            + shuffled_vocab_low[i_word : i_word + n_words_per_sentence]
+        )
+
+    for name, order, padding in [
+        ("bigram", 2, (["<BOS2>"], ["."])),
+        ("trigram", 3, (["<BOS1>", "<BOS2>"], [".", "<EOS1>"])),
+    ]:
+        model = KneserNey(order, 4)
+        for sentence in sentences:
+            model.train(padding[0] + sentence + padding[1])
+        model.optimize()
+        fname = get_checkpoint_path(
+            os.path.join("model_checkpoints", f"{name}.model"), checkpoint_folder
+        )
+        model.save(fname)
+        print("saved {} ({} sentences) to {}".format(name, len(sentences), fname))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--checkpoint_folder", type=str, default="tiny_model_checkpoints")
+    parser.add_argument(
+        "--families",
+        type=str,
+        nargs="+",
+        default=["transformers", "rnns", "ngrams"],
+        choices=["transformers", "rnns", "ngrams"],
+    )
+    parser.add_argument("--hidden_size", type=int, default=64)
+    parser.add_argument("--n_layers", type=int, default=2)
+    parser.add_argument("--n_heads", type=int, default=2)
+    parser.add_argument(
+        "--max_segment_length",
+        type=int,
+        default=8,
+        help="longer words are split into several tokens by the transformers' tokenizers",
+    )
+    parser.add_argument("--init_std", type=float, default=0.5)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    if "transformers" in args.families:
+        build_tiny_transformers(
+            args.checkpoint_folder,
+            hidden_size=args.hidden_size,
+            n_layers=args.n_layers,
+            n_heads=args.n_heads,
+            max_segment_length=args.max_segment_length,
+            init_std=args.init_std,
+            seed=args.seed,
+        )
+    if "rnns" in args.families:
+        build_tiny_rnns(args.checkpoint_folder, seed=args.seed)
+    if "ngrams" in args.families:
+        build_tiny_ngrams(args.checkpoint_folder, seed=args.seed)
@@ -1,6 +1,8 @@
 import pickle
 import os
 
+import numpy as np
+
 folder = os.path.join("resources", "vocabulary")
 # load vocabulary and word probabilities
 with open(os.path.join(folder, "vocab_low.pkl"), "rb") as file:
@@ -15,6 +17,21 @@ with open(os.path.join(folder, "vocab_cap.pkl"), "rb") as file:
 with open(os.path.join(folder, "vocab_cap_freqs.pkl"), "rb") as file:
     vocab_cap_freqs = pickle.load(file)
 
+# vocabulary indices used by the sentence optimizer (candidate replacement words are represented by their index in vocab_cap/vocab_low)
+vocab_low_index = {w: i for i, w in enumerate(vocab_low)}
+vocab_cap_index = {w: i for i, w in enumerate(vocab_cap)}
+
+# integer id of the lowercase form of each vocabulary word (words differing only in case share an id)
+lowercase_word_ids = {}
+for w in list(vocab_low) + list(vocab_cap):
+    lowercase_word_ids.setdefault(w.lower(), len(lowercase_word_ids))
+vocab_low_lowercase_ids = np.asarray([lowercase_word_ids[w.lower()] for w in vocab_low], dtype=np.int64)
+vocab_cap_lowercase_ids = np.asarray([lowercase_word_ids[w.lower()] for w in vocab_cap], dtype=np.int64)
+
+# number of characters of each vocabulary word
+vocab_low_lengths = np.asarray([len(w) for w in vocab_low], dtype=np.int64)
+vocab_cap_lengths = np.asarray([len(w) for w in vocab_cap], dtype=np.int64)
+
 def get_vocabulary():
     return vocab_low, vocab_low_freqs, vocab_cap, vocab_cap_freqs
 